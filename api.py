@@ -0,0 +1,194 @@
+"""Headless HTTP API for the redaction guardrail and the guarded chat flow.
+
+    uvicorn api:app --host 0.0.0.0 --port 8000
+    HISTORY_BACKEND=sqlite uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+
+The default JSONL history log has a single writer thread per process, so
+run one worker with it; several workers (or the API next to the Streamlit
+app) must share the SQLite backend, which is safe across processes.
+Redaction and masking are pure CPU: short texts are answered inline, longer
+ones in a worker thread so one pasted document does not stall the event loop.
+Chat turns await the async inference backend, so one slow completion never
+stalls the event loop for other clients either. When the inference queue is
+full, ``/chat`` answers 503 at once with a Retry-After header; clients may
+send X-Session-Id so queueing is fair per user. ``/history/export`` streams
+the retained history as JSON Lines straight from the log and its segments;
+it is off unless HISTORY_EXPORT_TOKEN is set, and then needs that token as
+``Authorization: Bearer <token>``.
+``/rules`` lists the redaction rules in force with their match counts and
+sampled cost; every worker picks up an edited rules file on its own within
+a few seconds, ``/rules/reload`` loads it now in the worker that answers.
+"""
+import asyncio
+import hmac
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import Literal
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from history_log import get_writer, history_backend, iter_export
+from inference import Busy, InferenceError, get_backend
+from metrics import get_metrics
+from pipeline import PromptTooLarge, arun_chat
+from redaction import get_rules, mask_sensitive_data, redact_sensitive_data, reload_rules, rule_stats
+
+# Largest text /redact and /mask accept (redaction time is linear in it)
+MAX_TEXT_CHARS = int(os.getenv("MAX_TEXT_CHARS", str(1024 * 1024)))
+
+# Texts longer than this are processed off the event loop (about 2ms of redaction)
+INLINE_TEXT_CHARS = 8 * 1024
+
+# Bearer token for /history/export; the endpoint is disabled when unset
+HISTORY_EXPORT_TOKEN = os.getenv("HISTORY_EXPORT_TOKEN", "")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await get_backend().aclose()
+
+
+app = FastAPI(title="Privacy-Preserving Chatbot API", lifespan=lifespan)
+
+
+Sensitivity = Literal["Low", "Medium", "High"]
+
+
+class TextRequest(BaseModel):
+    text: str
+    sensitivity: Sensitivity = "High"
+
+
+class ChatRequest(BaseModel):
+    prompt: str
+    strict_mode: bool = False
+    enable_logging: bool = True
+    sensitivity: Sensitivity = "High"
+
+
+class Alert(BaseModel):
+    severity: str
+    message: str
+    level: str
+
+
+class RedactResponse(BaseModel):
+    text: str
+    alerts: list[Alert]
+
+
+class MaskResponse(BaseModel):
+    text: str
+
+
+class ChatResponse(BaseModel):
+    prompt: str
+    reply: str | None
+    alerts: list[Alert]
+    blocked: bool
+    cached: bool
+
+
+async def _process(func, text: str, sensitivity: str):
+    """Run `func(text, sensitivity)`, in a worker thread when the text is long."""
+    if len(text) > MAX_TEXT_CHARS:
+        raise HTTPException(
+            status_code=413, detail=f"Text is {len(text):,} characters; the limit is {MAX_TEXT_CHARS:,}."
+        )
+    if len(text) <= INLINE_TEXT_CHARS:
+        return func(text, sensitivity)
+    return await asyncio.to_thread(func, text, sensitivity)
+
+
+@app.post("/redact", response_model=RedactResponse)
+async def redact(request: TextRequest):
+    text, alerts = await _process(redact_sensitive_data, request.text, request.sensitivity)
+    return {"text": text, "alerts": alerts}
+
+
+@app.post("/mask", response_model=MaskResponse)
+async def mask(request: TextRequest):
+    return {"text": await _process(mask_sensitive_data, request.text, request.sensitivity)}
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request, x_session_id: str | None = Header(None)):
+    # Queue fairly per caller: the session header, else the client address
+    session = x_session_id or (http_request.client.host if http_request.client else None)
+    try:
+        result = await arun_chat(request.prompt, request.strict_mode, request.enable_logging,
+                                 sensitivity=request.sensitivity, session=session)
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e)) from e
+    except Busy as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)}) from e
+    except InferenceError as e:
+        raise HTTPException(status_code=502, detail=str(e)) from e
+    return {
+        "prompt": result.prompt,
+        "reply": result.reply,
+        "alerts": result.alerts,
+        "blocked": result.blocked,
+        "cached": result.cached,
+    }
+
+
+def _rules_report(rules) -> dict:
+    return {"version": rules.version, "fallbacks": rule_stats.fallbacks, "rules": rules.describe()}
+
+
+@app.get("/rules")
+async def rules():
+    return _rules_report(get_rules())
+
+
+@app.post("/rules/reload")
+async def reload():
+    try:
+        rules = await asyncio.to_thread(reload_rules)
+    except (OSError, ValueError) as e:
+        # The rules in force stay in force
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    return _rules_report(rules)
+
+
+def _check_export_token(authorization: str | None):
+    if not HISTORY_EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="History export is disabled.")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), HISTORY_EXPORT_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="A valid bearer token is required.",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/history/export")
+def export_history(start: date | None = None, end: date | None = None,
+                   authorization: str | None = Header(None)):
+    """Stream the retained history, optionally within a date range, as JSON Lines."""
+    _check_export_token(authorization)
+    get_writer().flush()
+    if history_backend() == "sqlite":
+        from history_db import get_store
+        records = get_store().iter_records(start, end)
+    else:
+        records = iter_export(start=start, end=end)
+    lines = (json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(
+        get_metrics().render_prometheus(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
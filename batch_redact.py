@@ -0,0 +1,251 @@
+"""Offline redaction of large exports (ticket dumps, transcripts).
+
+Streams JSONL, CSV or plain-text input in bounded batches through a
+process pool and writes the scrubbed output in the original order:
+
+    python batch_redact.py tickets.jsonl -o tickets.redacted.jsonl
+    python batch_redact.py transcripts.csv --mode mask --fields body,notes
+    cat dump.txt | python batch_redact.py - --format text > dump.redacted.txt
+
+Plain text is split into windows at boundaries no match runs across (see
+``redaction.iter_windows``), so a card number broken over two lines is
+redacted as it would be in the whole file. A JSONL line that is not valid
+JSON is reported on stderr and left out of the output.
+
+A per-category tally of detections is printed to stderr when the run finishes.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from collections import Counter, deque
+from functools import partial
+from multiprocessing import Pool
+
+from redaction import WINDOW_CHARS, detect, get_rules, iter_windows
+
+FORMATS = ("jsonl", "csv", "text")
+MODES = ("redact", "mask")
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if ext == ".csv":
+        return "csv"
+    return "text"
+
+# ---------------------- Workers ----------------------
+def _scrub(text: str, mode: str, tally: Counter) -> str:
+    detection = detect(text)
+    for span in detection.spans:
+        tally[detection.rules.alerts[span.category]["message"]] += 1
+    if mode == "mask":
+        return detection.masked()
+    return detection.redacted()
+
+
+def _scrub_value(value, mode: str, tally: Counter):
+    """Scrub every string inside a JSON value."""
+    if isinstance(value, str):
+        return _scrub(value, mode, tally)
+    if isinstance(value, list):
+        return [_scrub_value(item, mode, tally) for item in value]
+    if isinstance(value, dict):
+        return {key: _scrub_value(item, mode, tally) for key, item in value.items()}
+    return value
+
+
+# Each returns the output chunks, the tally, the skipped (line number, reason)
+# pairs and the requested fields seen
+def scrub_text_batch(windows: list[str], mode: str) -> tuple[list[str], Counter, list, set]:
+    tally = Counter()
+    return [_scrub(window, mode, tally) for window in windows], tally, [], set()
+
+
+def scrub_jsonl_batch(lines: list[tuple[int, str]], mode: str,
+                      fields: list[str] | None) -> tuple[list[str], Counter, list, set]:
+    tally = Counter()
+    out = []
+    skipped = []
+    seen = set()
+    for number, line in lines:
+        if not line.strip():
+            out.append(line)
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as exc:
+            skipped.append((number, exc.msg))
+            continue
+        if fields and isinstance(record, dict):
+            for field in fields:
+                if field in record:
+                    seen.add(field)
+                    record[field] = _scrub_value(record[field], mode, tally)
+        else:
+            record = _scrub_value(record, mode, tally)
+        out.append(json.dumps(record, ensure_ascii=False) + "\n")
+    return out, tally, skipped, seen
+
+
+def scrub_csv_batch(rows: list[list[str]], mode: str,
+                    columns: list[int] | None) -> tuple[list[str], Counter, list, set]:
+    tally = Counter()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            _scrub(cell, mode, tally) if columns is None or i in columns else cell
+            for i, cell in enumerate(row)
+        ])
+    return [buffer.getvalue()], tally, [], set()
+
+# ---------------------- Streaming ----------------------
+def _batched(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def text_windows(lines, size: int = WINDOW_CHARS):
+    """Regroup lines of text into windows that can be redacted independently.
+
+    A window is only released once the text read extends the longest
+    match past its end, so more input can no longer move its boundary.
+    """
+    registry = get_rules()
+    buffer = ""
+    for line in lines:
+        buffer += line
+        if len(buffer) < 2 * size + registry.max_chars:
+            continue
+        start = 0
+        for window in iter_windows(buffer, size, registry):
+            if len(buffer) - (start + len(window)) <= registry.max_chars:
+                break
+            yield window
+            start += len(window)
+        buffer = buffer[start:]
+    if buffer:
+        yield from iter_windows(buffer, size, registry)
+
+
+def ordered_map(pool, func, batches, max_pending: int):
+    """Like ``pool.imap`` but never reads more than `max_pending` batches ahead.
+
+    ``Pool.imap`` drains its input as fast as it can, which would pull a
+    multi-GB file into memory; this keeps memory bounded by the window.
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(func, (batch,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def run(src, dst, fmt: str, mode: str, fields: list[str] | None,
+        workers: int, batch_size: int) -> tuple[Counter, int]:
+    """Scrub `src` into `dst`; return the tally and the number of lines skipped.
+
+    `batch_size` counts lines or rows; plain text is sent in windows of
+    about WINDOW_CHARS characters instead, a few per batch.
+
+    Raises ValueError, before writing anything, when `fields` names CSV
+    columns the header lacks. JSONL keys that no record had are reported
+    on stderr once the run finishes.
+    """
+    tally = Counter()
+    skipped = 0
+    seen = set()
+
+    if fmt == "csv":
+        reader = csv.reader(src)
+        header = next(reader, None)
+        if header is None:
+            return tally, skipped
+        columns = None
+        if fields:
+            missing = [field for field in fields if field not in header]
+            if missing:
+                raise ValueError(f"--fields not in the CSV header: {', '.join(missing)}")
+            columns = [i for i, name in enumerate(header) if name in fields]
+        header_out = io.StringIO()
+        csv.writer(header_out).writerow(header)
+        dst.write(header_out.getvalue())
+        items = reader
+        func = partial(scrub_csv_batch, mode=mode, columns=columns)
+    elif fmt == "jsonl":
+        items = enumerate(src, 1)
+        func = partial(scrub_jsonl_batch, mode=mode, fields=fields)
+    else:
+        items = text_windows(src)
+        batch_size = 4
+        func = partial(scrub_text_batch, mode=mode)
+
+    with Pool(workers) as pool:
+        batches = ordered_map(pool, func, _batched(items, batch_size), workers * 2)
+        for out, batch_tally, batch_skipped, batch_seen in batches:
+            dst.writelines(out)
+            tally.update(batch_tally)
+            for number, reason in batch_skipped:
+                print(f"line {number}: skipped, not valid JSON ({reason})", file=sys.stderr)
+            skipped += len(batch_skipped)
+            seen |= batch_seen
+    if fmt == "jsonl" and fields:
+        missing = [field for field in fields if field not in seen]
+        if missing:
+            print(f"Warning: no record had --fields {', '.join(missing)}; nothing was scrubbed there",
+                  file=sys.stderr)
+    return tally, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Redact or mask sensitive data in large files.")
+    parser.add_argument("input", help="Input file, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="Output file, or - for stdout (default)")
+    parser.add_argument("--format", choices=FORMATS, help="Input format (default: from the file extension)")
+    parser.add_argument("--mode", choices=MODES, default="redact",
+                        help="redact: replace with [REDACTED_*] tokens; mask: keep partial visibility")
+    parser.add_argument("--fields", help="Comma-separated JSONL keys or CSV columns to scrub (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--batch-size", type=int, default=1000, help="JSONL lines or CSV rows per batch")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(args.input)
+    fields = [field.strip() for field in args.fields.split(",")] if args.fields else None
+    newline = "" if fmt == "csv" else None
+
+    src = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8", newline=newline)
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline=newline)
+    try:
+        tally, skipped = run(src, dst, fmt, args.mode, fields, args.workers, args.batch_size)
+    except ValueError as exc:
+        parser.exit(2, f"{parser.prog}: error: {exc}\n")
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+
+    if skipped:
+        print(f"Skipped {skipped} malformed line(s)", file=sys.stderr)
+    print("Alert tally:", file=sys.stderr)
+    if not tally:
+        print("  no sensitive data found", file=sys.stderr)
+    for message, count in tally.most_common():
+        print(f"  {count:>10}  {message}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
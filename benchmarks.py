@@ -0,0 +1,325 @@
+"""Benchmarks for the redaction, masking and history-logging hot paths.
+
+    python benchmarks.py run -o results.json            # full suite
+    python benchmarks.py run --quick -o results.json    # small inputs only
+    python benchmarks.py run --filter redact/           # one group
+    python benchmarks.py compare baseline.json results.json --threshold 0.15
+
+Inputs come from seeded generators, so every run measures the same text.
+``compare`` exits with status 1 when any benchmark's median time grew by
+more than the threshold, for use as a CI gate.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Keep benchmark runs from writing a metrics file into the working directory
+os.environ.setdefault("METRICS_FILE", "")
+
+from history_db import HistoryStore
+from history_log import HistoryIndex, HistoryWriter
+from redaction import detect, mask_sensitive_data, redact_sensitive_data
+
+SEED = 20240601
+
+KB = 1024
+MB = 1024 * KB
+
+DOCUMENT_SIZES = [KB, 10 * KB, 100 * KB, MB]
+QUICK_DOCUMENT_SIZES = [KB, 10 * KB]
+ADVERSARIAL_SIZES = [KB, 4 * KB, 16 * KB]
+QUICK_ADVERSARIAL_SIZES = [KB, 4 * KB]
+HISTORY_SIZES = [100, 10_000, 1_000_000]
+QUICK_HISTORY_SIZES = [100, 10_000]
+
+# ---------------------- Generators ----------------------
+WORDS = (
+    "the a to and of please help me with my account order refund delivery "
+    "status update question about payment invoice when will it arrive thanks "
+    "could you check why was charged twice last month support team customer"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(6, 16))
+    return " ".join(words).capitalize() + rng.choice([".", "?", "!"])
+
+
+def _digits(rng: random.Random, n: int) -> str:
+    return "".join(rng.choices("0123456789", k=n))
+
+
+def _pii(rng: random.Random) -> str:
+    kind = rng.randrange(7)
+    if kind == 0:
+        return f"my Aadhaar is {_digits(rng, 12)}"
+    if kind == 1:
+        letters = "".join(rng.choices("ABCDEFGHIJKLMNOPQRSTUVWXYZ", k=5))
+        return f"PAN {letters}{_digits(rng, 4)}{rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}"
+    if kind == 2:
+        return "card " + " ".join(_digits(rng, 4) for _ in range(4))
+    if kind == 3:
+        return f"CVV: {_digits(rng, 3)}"
+    if kind == 4:
+        return f"call me on {_digits(rng, 10)}"
+    if kind == 5:
+        user = "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(4, 10)))
+        return f"mail {user}.{_digits(rng, 2)}@example.com"
+    return f"PIN {_digits(rng, 6)}"
+
+
+def _fill(size: int, rng: random.Random, piece) -> str:
+    parts = []
+    length = 0
+    while length < size:
+        part = piece(rng)
+        parts.append(part)
+        length += len(part) + 1
+    return " ".join(parts)[:size]
+
+
+def no_pii(size: int, seed: int = SEED) -> str:
+    """Ordinary support-chat prose without any sensitive data."""
+    return _fill(size, random.Random(seed), _sentence)
+
+
+def dense_pii(size: int, seed: int = SEED) -> str:
+    """Every sentence carries one identifier."""
+    return _fill(size, random.Random(seed), lambda rng: f"{_sentence(rng)} {_pii(rng)}.")
+
+
+def document(size: int, seed: int = SEED) -> str:
+    """A long pasted document: paragraphs with an identifier every few lines."""
+    def paragraph(rng):
+        lines = [_sentence(rng) for _ in range(rng.randint(3, 8))]
+        if rng.random() < 0.5:
+            lines.insert(rng.randrange(len(lines)), _pii(rng) + ".")
+        return "\n".join(lines) + "\n"
+    return _fill(size, random.Random(seed), paragraph)
+
+
+# Inputs that make the email pattern's `[...]+` runs backtrack from every start
+ADVERSARIAL = {
+    "local_run": lambda n: "a" * n,                    # a local part that never reaches "@"
+    "domain_run": lambda n: "a@" + "a" * (n - 2),      # a domain that never reaches "."
+    "dash_run": lambda n: "a@b" + "-" * (n - 3),       # "-" is valid in both domain classes
+    "digit_run": lambda n: "1" * n,                    # digits feed the email and number rules
+}
+
+
+def history_record(i: int) -> dict:
+    return {
+        "timestamp": f"2024-01-01T00:00:{i % 60:02d}.000000",
+        "prompt": f"my phone is 987****{i % 1000:03d}, what's my order status?",
+        "answer": "Your order has shipped and should arrive within 3-5 business days.",
+        "alerts": [{"severity": "🟡", "message": "Phone number detected and redacted", "level": "MEDIUM"}],
+        "severity_summary": {"high": 0, "medium": 1, "low": 0},
+    }
+
+# ---------------------- Timing ----------------------
+def measure(func, min_rounds: int = 3, max_rounds: int = 50, budget: float = 1.0) -> list[float]:
+    """Call `func` repeatedly and return the wall time of each round.
+
+    Runs at least `min_rounds` rounds, then stops once `budget` seconds are
+    spent or `max_rounds` is reached.
+    """
+    times = []
+    spent = 0.0
+    while len(times) < min_rounds or (spent < budget and len(times) < max_rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        spent += elapsed
+    return times
+
+
+def _result(times: list[float], unit: str, amount: int) -> dict:
+    median = statistics.median(times)
+    return {
+        "median_s": median,
+        "min_s": min(times),
+        "rounds": len(times),
+        "unit": unit,
+        "amount": amount,
+        "throughput": amount / median if median else None,
+    }
+
+
+def _size_label(size: int) -> str:
+    return f"{size // MB}MB" if size >= MB else f"{size // KB}KB"
+
+# ---------------------- Benchmarks ----------------------
+def text_benchmarks(quick: bool, wanted=lambda name: True):
+    sizes = QUICK_DOCUMENT_SIZES if quick else DOCUMENT_SIZES
+    for kind, generate in (("no_pii", no_pii), ("dense_pii", dense_pii), ("document", document)):
+        for size in sizes:
+            label = f"{kind}/{_size_label(size)}"
+            if not any(wanted(f"{group}/{label}") for group in ("redact", "mask", "turn")):
+                continue
+            text = generate(size)
+            yield f"redact/{label}", lambda text=text: redact_sensitive_data(text), "bytes", len(text)
+            yield f"mask/{label}", lambda text=text: mask_sensitive_data(text), "bytes", len(text)
+            # What a chat turn needs per text: one scan, every view rendered from it
+            yield f"turn/{label}", lambda text=text: _all_views(text), "bytes", len(text)
+
+    for kind, generate in ADVERSARIAL.items():
+        for size in (QUICK_ADVERSARIAL_SIZES if quick else ADVERSARIAL_SIZES):
+            label = f"adversarial_{kind}/{_size_label(size)}"
+            if not any(wanted(f"{group}/{label}") for group in ("redact", "mask")):
+                continue
+            text = generate(size)
+            yield f"redact/{label}", lambda text=text: redact_sensitive_data(text), "bytes", len(text)
+            yield f"mask/{label}", lambda text=text: mask_sensitive_data(text), "bytes", len(text)
+
+
+def _all_views(text: str):
+    detection = detect(text)
+    return detection.redacted(), detection.masked(), detection.alerts()
+
+
+def _prefill(path: str, count: int):
+    line = json.dumps(history_record(0), ensure_ascii=False) + "\n"
+    with open(path, "w", encoding="utf-8") as f:
+        for start in range(0, count, 10_000):
+            f.write(line * min(10_000, count - start))
+
+
+def history_benchmarks(quick: bool, workdir: str, wanted=lambda name: True, batch: int = 1024):
+    """Log-append throughput, newest-page reads and SQLite searches against histories of growing size.
+
+    A history is only built when one of the benchmarks reading it is `wanted`.
+    """
+    for size in (QUICK_HISTORY_SIZES if quick else HISTORY_SIZES):
+        path = os.path.join(workdir, f"history_{size}.jsonl")
+        if wanted(f"log_append/{size}") or wanted(f"history_page/{size}"):
+            _prefill(path, size)
+        if wanted(f"log_append/{size}"):
+            records = [history_record(i) for i in range(batch)]
+            # A multiple of the writer's batch size, so no round waits on the flush interval
+            writer = HistoryWriter(path, batch_size=64, fsync="never")
+
+            def append(writer=writer, records=records):
+                for record in records:
+                    writer.submit(record)
+                writer.flush()
+
+            try:
+                yield f"log_append/{size}", append, "records", batch
+            finally:
+                writer.close()
+
+        if wanted(f"history_page/{size}"):
+            index = HistoryIndex(path)
+            index.refresh()
+            yield f"history_page/{size}", lambda index=index: index.read_page(0, 25), "records", 25
+        if os.path.exists(path):
+            os.remove(path)
+
+        if wanted(f"history_search/{size}"):
+            store = HistoryStore(os.path.join(workdir, f"history_{size}.db"))
+            for start in range(0, size, 10_000):
+                store.append(history_record(i) for i in range(start, min(size, start + 10_000)))
+            yield (f"history_search/{size}", lambda store=store: store.search("order status", ["MEDIUM"]),
+                   "records", 25)
+
+
+def run(quick: bool = False, pattern: str | None = None, budget: float = 1.0) -> dict:
+    results = {}
+
+    def wanted(name: str) -> bool:
+        return not pattern or pattern in name
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Inputs are built lazily by the suites, and only for the benchmarks that pass the filter
+        for suite in (text_benchmarks(quick, wanted), history_benchmarks(quick, workdir, wanted)):
+            for name, func, unit, amount in suite:
+                if not wanted(name):
+                    continue
+                func()  # warm-up: compiled patterns, page cache, writer thread
+                results[name] = _result(measure(func, budget=budget), unit, amount)
+                print(f"{name:<45} {results[name]['median_s'] * 1000:>10.3f} ms", file=sys.stderr)
+    return {"meta": _meta(quick), "results": results}
+
+
+def _meta(quick: bool) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "seed": SEED,
+    }
+
+# ---------------------- Comparison ----------------------
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Print a side-by-side table and return the names that regressed."""
+    regressions = []
+    print(f"{'benchmark':<45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name in sorted(baseline["results"].keys() & current["results"].keys()):
+        before = baseline["results"][name]["median_s"]
+        after = current["results"][name]["median_s"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<45} {before * 1000:>10.3f}ms {after * 1000:>10.3f}ms {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the redaction, masking and logging hot paths.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the suite and write JSON results")
+    run_parser.add_argument("-o", "--output", default="-", help="Results file, or - for stdout (default)")
+    run_parser.add_argument("--quick", action="store_true", help="Skip the largest inputs and histories")
+    run_parser.add_argument("--filter", help="Only run benchmarks whose name contains this string")
+    run_parser.add_argument("--budget", type=float, default=1.0, help="Seconds to spend per benchmark")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.15,
+                                help="Allowed slowdown of the median before failing (default 0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results = run(args.quick, args.filter, args.budget)
+        data = json.dumps(results, indent=2)
+        if args.output == "-":
+            print(data)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(data + "\n")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than the {args.threshold:.0%} threshold", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4 @@
+import os
+
+# Keep test runs from writing chatbot_metrics.prom into the working directory
+os.environ.setdefault("METRICS_FILE", "")
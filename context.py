@@ -0,0 +1,143 @@
+"""Token-budgeted conversation context for multi-turn chat.
+
+Only redacted text ever enters the context: each turn is the prompt as it
+was sent to the model and the redacted reply, never rendered HTML. Each
+request carries, within `budget` tokens:
+
+1. a system message with a rolling summary of older turns;
+2. as many of the most recent turns as fit, newest first;
+3. the new prompt.
+
+Once the turns kept verbatim pass half the budget, the oldest are folded
+into the summary by the model in the background. Request size stays
+bounded however long the chat runs, and no turn waits for a summary.
+"""
+import logging
+import os
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+
+# Tokens for the summary, the recent turns and the new prompt together
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2048"))
+
+# Framing the chat template adds around each message
+MESSAGE_OVERHEAD = 5
+
+SUMMARY_MAX_TOKENS = 192
+
+# Backstop for a backend that ignores max_tokens
+SUMMARY_MAX_CHARS = SUMMARY_MAX_TOKENS * 6
+
+SUMMARY_INSTRUCTION = (
+    "Summarize the conversation below for an assistant that will continue it. Keep names of "
+    "products, orders, issues and anything the user asked to remember; drop small talk. "
+    "Placeholders such as [REDACTED_PHONE] stand for removed data: keep them as they are and "
+    f"never guess what they hide. Reply with the summary only, in at most {SUMMARY_MAX_TOKENS} tokens."
+)
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of one message: about four characters per token."""
+    return (len(text) + 3) // 4 + MESSAGE_OVERHEAD
+
+
+@dataclass
+class Turn:
+    prompt: str                 # redacted prompt, as sent to the model
+    reply: str                  # redacted reply
+    tokens: int = field(init=False)
+
+    def __post_init__(self):
+        self.tokens = estimate_tokens(self.prompt) + estimate_tokens(self.reply)
+
+
+def summary_messages(summary: str, turns: list[Turn]) -> list[dict]:
+    """Request that folds `turns` into the running `summary`."""
+    lines = [f"Earlier summary: {summary}"] if summary else []
+    for turn in turns:
+        lines.append(f"User: {turn.prompt}")
+        lines.append(f"Assistant: {turn.reply}")
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+
+class ChatContext:
+    """Redacted turns of one conversation and a rolling summary of the older ones.
+
+    Not thread-safe: keep one per session and call it from that session
+    only. A summary running in the background is picked up by the next
+    ``add`` or ``messages`` call once it has finished.
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.summary = ""
+        self.turns: list[Turn] = []     # turns not folded into the summary yet
+        self._pending: tuple[Future, int] | None = None
+
+    def add(self, prompt: str, reply: str):
+        """Record a completed turn."""
+        self._collect()
+        self.turns.append(Turn(prompt, reply))
+
+    def messages(self, prompt: str) -> list[dict]:
+        """Messages for the next request: summary, recent turns that fit, then `prompt`.
+
+        A prompt that fills the budget on its own is sent without context.
+        """
+        self._collect()
+        remaining = self.budget - estimate_tokens(prompt)
+        summary = f"Summary of the conversation so far: {self.summary}" if self.summary else ""
+        if summary and estimate_tokens(summary) <= remaining:
+            remaining -= estimate_tokens(summary)
+        else:
+            summary = ""
+
+        recent = []
+        for turn in reversed(self.turns):
+            if turn.tokens > remaining:
+                break
+            remaining -= turn.tokens
+            recent.append(turn)
+
+        messages = [{"role": "system", "content": summary}] if summary else []
+        for turn in reversed(recent):
+            messages.append({"role": "user", "content": turn.prompt})
+            messages.append({"role": "assistant", "content": turn.reply})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def fold(self, summarize: Callable[[str, list[Turn]], Future]):
+        """Start folding the oldest turns into the summary if they fill half the budget.
+
+        `summarize(summary, turns)` returns a Future of the new summary. The
+        newest quarter of the budget stays verbatim, so a fold happens every
+        few turns rather than every turn; at most one runs at a time.
+        """
+        self._collect()
+        if self._pending is not None or sum(turn.tokens for turn in self.turns) <= self.budget // 2:
+            return
+        # Fold everything older than the newest turns that fit in a quarter of the budget
+        count = len(self.turns)
+        kept = 0
+        while count > 1 and kept + self.turns[count - 1].tokens <= self.budget // 4:
+            count -= 1
+            kept += self.turns[count].tokens
+        self._pending = (summarize(self.summary, self.turns[:count]), count)
+
+    def _collect(self):
+        if self._pending is None or not self._pending[0].done():
+            return
+        future, count = self._pending
+        self._pending = None
+        try:
+            self.summary = future.result()[:SUMMARY_MAX_CHARS]
+        except Exception as exc:
+            # The folded turns are dropped either way, so memory stays bounded
+            logger.warning("Failed to summarize %d turns, dropping them from the context: %r", count, exc)
+        del self.turns[:count]
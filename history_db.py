@@ -0,0 +1,395 @@
+"""SQLite history store: searchable, filterable alternative to the JSONL log.
+
+Enabled with HISTORY_BACKEND=sqlite. Records land in one table with indexes
+on timestamp and alert level, plus an FTS5 index over the masked prompt
+and answer, so the history viewer can search and filter a million
+conversations without reading them all.
+
+The database runs in WAL mode: readers never block the writer or each
+other, and several processes (Streamlit, API workers) can log to the same
+file.
+"""
+import atexit
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator
+
+from history_log import HISTORY_FILE, HistoryWriter, empty_stats, iter_export, update_stats
+from metrics import get_metrics
+
+HISTORY_DB = "chatbot_history.db"
+
+# Highest alert level of a conversation, as stored in the `level` column
+LEVELS = ("HIGH", "MEDIUM", "LOW", "SAFE")
+
+# Matches counted per search; beyond this the viewer shows "10,000+"
+SEARCH_COUNT_LIMIT = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    level TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    extra TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_timestamp ON conversations (timestamp);
+CREATE INDEX IF NOT EXISTS conversations_level ON conversations (level);
+CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5 (
+    prompt, answer, content='conversations', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS conversations_insert AFTER INSERT ON conversations BEGIN
+    INSERT INTO conversations_fts (rowid, prompt, answer) VALUES (new.id, new.prompt, new.answer);
+END;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+DELETE_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS conversations_delete AFTER DELETE ON conversations BEGIN
+    INSERT INTO conversations_fts (conversations_fts, rowid, prompt, answer)
+    VALUES ('delete', old.id, old.prompt, old.answer);
+END
+"""
+
+_COLUMNS = ("timestamp", "prompt", "answer")
+
+_INSERT = "INSERT INTO conversations (timestamp, level, prompt, answer, extra) VALUES (?, ?, ?, ?, ?)"
+
+
+def record_level(record: dict) -> str:
+    """Highest alert level in a record's severity summary, or "SAFE"."""
+    summary = record.get("severity_summary", {})
+    for level in ("high", "medium", "low"):
+        if summary.get(level):
+            return level.upper()
+    return "SAFE"
+
+
+def match_query(text: str) -> str | None:
+    """FTS5 query that matches every word of `text` as a prefix.
+
+    Only word characters reach FTS5, so user input can never be a syntax
+    error. Returns None when `text` has no words.
+    """
+    terms = re.findall(r"\w+", text)
+    return " ".join(f'"{term}"*' for term in terms) or None
+
+
+def _row(record: dict) -> tuple:
+    extra = {key: value for key, value in record.items() if key not in _COLUMNS}
+    return (
+        str(record.get("timestamp", "")),
+        record_level(record),
+        str(record.get("prompt", "")),
+        str(record.get("answer", "")),
+        json.dumps(extra, ensure_ascii=False),
+    )
+
+
+def _date_range(start: date | None, end: date | None) -> tuple[list[str], list[str]]:
+    """WHERE clauses and parameters for an inclusive range of days."""
+    clauses, params = [], []
+    if start:
+        clauses.append("timestamp >= ?")
+        params.append(start.isoformat())
+    if end:
+        clauses.append("timestamp < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    return clauses, params
+
+
+def _record(timestamp: str, prompt: str, answer: str, extra: str) -> dict:
+    return {"timestamp": timestamp, "prompt": prompt, "answer": answer, **json.loads(extra)}
+
+# ---------------------- Store ----------------------
+class HistoryStore:
+    """Conversation records in a SQLite database at `path`.
+
+    Every call opens its own short-lived connection, so the store can be
+    shared freely between threads.
+    """
+
+    def __init__(self, path: str = HISTORY_DB, synchronous: str = "NORMAL"):
+        self.path = path
+        self.synchronous = synchronous
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA + DELETE_TRIGGER + ";")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit; writes go through _transaction
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute(f"PRAGMA synchronous={self.synchronous}")
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the lock up front and rolls back on error."""
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def append(self, records: Iterable[dict]) -> int:
+        """Insert `records` and fold them into the stored statistics, atomically."""
+        records = list(records)
+        if not records:
+            return 0
+        with self._transaction() as db:
+            db.executemany(_INSERT, map(_row, records))
+            self._save_stats(db, update_stats(self._load_stats(db), records))
+        return len(records)
+
+    def prune(self, retention_days: float) -> int:
+        """Delete conversations older than `retention_days`; 0 keeps everything."""
+        if retention_days <= 0:
+            return 0
+        cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+        with self._transaction() as db:
+            removed = db.execute("DELETE FROM conversations WHERE timestamp < ?", (cutoff,)).rowcount
+            if removed:
+                self._save_stats(db, self._aggregate(db))
+        return removed
+
+    def clear(self) -> bool:
+        """Delete every conversation. Returns whether there were any."""
+        with self._transaction() as db:
+            existed = db.execute("SELECT EXISTS (SELECT 1 FROM conversations)").fetchone()[0]
+            # Emptying the FTS index in one statement beats a delete trigger per row
+            db.execute("DROP TRIGGER conversations_delete")
+            db.execute("DELETE FROM conversations")
+            db.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('delete-all')")
+            db.execute("DELETE FROM meta WHERE key = 'stats'")
+            db.execute(DELETE_TRIGGER)
+        return bool(existed)
+
+    def count(self) -> int:
+        return self.stats()["conversations"]
+
+    def stats(self) -> dict:
+        """Running aggregates in the same shape as the JSONL sidecar."""
+        with closing(self._connect()) as db:
+            return self._load_stats(db)
+
+    def search(self, query: str = "", levels: Iterable[str] | None = None,
+               start: date | None = None, end: date | None = None,
+               limit: int = 25, offset: int = 0,
+               count_limit: int = SEARCH_COUNT_LIMIT) -> tuple[int, list[tuple[int, dict]]]:
+        """Return the match count and one newest-first page of ``(id, record)`` pairs.
+
+        `query` matches word prefixes in the masked prompt or answer, `levels`
+        keeps conversations whose highest alert is one of LEVELS, and
+        `start`/`end` bound the day of the timestamp (inclusive). Counting
+        stops after `count_limit` matches, so a broad search costs no more
+        than a narrow one; a count above `count_limit` means "at least".
+        """
+        clauses, params = _date_range(start, end)
+        if levels is not None:
+            levels = list(levels)
+            clauses.append(f"level IN ({', '.join('?' * len(levels))})" if levels else "0")
+            params.extend(levels)
+        match = match_query(query)
+        if match:
+            # Driven from the FTS index, which hands back rowids newest first
+            source = "conversations_fts CROSS JOIN conversations ON conversations.id = conversations_fts.rowid"
+            clauses.insert(0, "conversations_fts MATCH ?")
+            params.insert(0, match)
+            order = "conversations_fts.rowid DESC"
+        else:
+            source = "conversations"
+            order = "id DESC"
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        started = time.perf_counter()
+        with closing(self._connect()) as db:
+            if clauses:
+                total = db.execute(
+                    f"SELECT count(*) FROM (SELECT 1 FROM {source} {where} LIMIT ?)", params + [count_limit + 1]
+                ).fetchone()[0]
+            else:
+                total = self._load_stats(db)["conversations"]
+            rows = db.execute(
+                "SELECT conversations.id, timestamp, conversations.prompt, conversations.answer, extra "
+                f"FROM {source} {where} "
+                f"ORDER BY {order} LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        get_metrics().observe("history_search", time.perf_counter() - started)
+        return total, [(row[0], _record(*row[1:])) for row in rows]
+
+    def iter_records(self, start: date | None = None, end: date | None = None) -> Iterator[dict]:
+        """Yield records oldest first, optionally within a date range, one row at a time."""
+        clauses, params = _date_range(start, end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with closing(self._connect()) as db:
+            for row in db.execute(
+                f"SELECT timestamp, prompt, answer, extra FROM conversations {where} ORDER BY id",
+                params,
+            ):
+                yield _record(*row)
+
+    @staticmethod
+    def _load_stats(db: sqlite3.Connection) -> dict:
+        row = db.execute("SELECT value FROM meta WHERE key = 'stats'").fetchone()
+        return json.loads(row[0]) if row else empty_stats()
+
+    @staticmethod
+    def _save_stats(db: sqlite3.Connection, stats: dict):
+        db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('stats', ?)",
+            (json.dumps(stats, ensure_ascii=False),),
+        )
+
+    @staticmethod
+    def _aggregate(db: sqlite3.Connection) -> dict:
+        """Recompute the statistics from the table (after a bulk delete)."""
+        stats = empty_stats()
+        count, first, last, high, medium, low = db.execute(
+            "SELECT count(*), min(timestamp), max(timestamp), "
+            "total(json_extract(extra, '$.severity_summary.high')), "
+            "total(json_extract(extra, '$.severity_summary.medium')), "
+            "total(json_extract(extra, '$.severity_summary.low')) FROM conversations"
+        ).fetchone()
+        stats["conversations"] = count
+        stats["first_timestamp"], stats["last_timestamp"] = first, last
+        stats["alerts"] = {"high": int(high), "medium": int(medium), "low": int(low)}
+        stats["alert_types"] = dict(db.execute(
+            "SELECT coalesce(json_extract(alert.value, '$.message'), ''), count(*) "
+            "FROM conversations, json_each(conversations.extra, '$.alerts') AS alert GROUP BY 1"
+        ).fetchall())
+        return stats
+
+    def rebuild_stats(self) -> dict:
+        """Recompute and save the statistics from the table."""
+        with self._transaction() as db:
+            stats = self._aggregate(db)
+            self._save_stats(db, stats)
+        return stats
+
+    def import_log(self, path: str = HISTORY_FILE) -> int:
+        """Copy a JSONL log (and its rotated segments) into the store, once.
+
+        Runs as one transaction, so an interrupted import leaves nothing
+        behind. The JSONL files are left untouched. Returns the number of
+        records imported; 0 if this store has imported before.
+        """
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                return 0
+            imported = db.executemany(_INSERT, map(_row, iter_export(path))).rowcount
+            if imported:
+                self._save_stats(db, self._aggregate(db))
+            db.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                       (json.dumps({"path": path, "records": imported}),))
+        return imported
+
+# ---------------------- Background Writer ----------------------
+class HistoryStoreWriter(HistoryWriter):
+    """HistoryWriter that appends each batch to a HistoryStore.
+
+    Batching, flushing and shutdown are inherited; one transaction is
+    committed per batch. Conversations older than `retention_days` are
+    deleted at most once every `prune_interval` seconds.
+    """
+
+    def __init__(self, store: HistoryStore, batch_size: int = 64, flush_interval: float = 0.5,
+                 retention_days: float = 0, prune_interval: float = 3600.0):
+        self.store = store
+        self.prune_interval = prune_interval
+        self._last_prune = time.monotonic()
+        super().__init__(store.path, batch_size=batch_size, flush_interval=flush_interval,
+                         fsync="never", retention_days=retention_days)
+
+    def _write(self, records: list[dict]):
+        start = time.perf_counter()
+        try:
+            self.store.append(records)
+        except sqlite3.Error as e:
+            # Reported like a failed JSONL append
+            raise OSError(str(e)) from e
+        get_metrics().observe("history_write", time.perf_counter() - start)
+
+        if self.retention_days and time.monotonic() - self._last_prune >= self.prune_interval:
+            self._last_prune = time.monotonic()
+            self.store.prune(self.retention_days)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str | None = None) -> HistoryStore:
+    """Return the process-wide store for `path` (default: HISTORY_DB env or chatbot_history.db).
+
+    HISTORY_FSYNC=batch makes every commit durable (synchronous=FULL);
+    otherwise a power cut may lose the last few batches, never corrupt the
+    database.
+    """
+    path = path or os.getenv("HISTORY_DB", HISTORY_DB)
+    with _stores_lock:
+        if path not in _stores:
+            synchronous = "FULL" if os.getenv("HISTORY_FSYNC", "batch") == "batch" else "NORMAL"
+            _stores[path] = HistoryStore(path, synchronous)
+        return _stores[path]
+
+
+def open_writer(log_path: str = HISTORY_FILE) -> HistoryStoreWriter:
+    """Build the writer ``history_log.get_writer`` returns for HISTORY_BACKEND=sqlite.
+
+    Imports any existing JSONL history at `log_path` the first time, then
+    applies HISTORY_RETENTION_DAYS (default 0 keeps everything). The start
+    that imports does not prune, so the import never deletes what it just
+    copied; the writer's periodic pruning applies retention later. Batching
+    follows HISTORY_BATCH_SIZE and HISTORY_FLUSH_INTERVAL.
+    """
+    store = get_store()
+    imported = store.import_log(log_path)
+    retention_days = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+    if not imported:
+        store.prune(retention_days)
+    writer = HistoryStoreWriter(
+        store,
+        batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "64")),
+        flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5")),
+        retention_days=retention_days,
+    )
+    atexit.register(writer.close)
+    return writer
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance commands for the SQLite history store.")
+    parser.add_argument("--db", default=os.getenv("HISTORY_DB", HISTORY_DB), help="Path to the database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Copy a JSONL log and its segments into the store")
+    import_parser.add_argument("--log", default=HISTORY_FILE, help="Path to the JSONL history log")
+    subparsers.add_parser("rebuild-stats", help="Recompute the statistics from the table")
+    search_parser = subparsers.add_parser("search", help="Print the newest matching conversations")
+    search_parser.add_argument("query", nargs="?", default="")
+    search_parser.add_argument("--level", action="append", choices=LEVELS, help="Repeat for several levels")
+    search_parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    store = HistoryStore(args.db)
+    if args.command == "import":
+        print(f"Imported {store.import_log(args.log)} records into {args.db}")
+    elif args.command == "rebuild-stats":
+        print(f"Rebuilt statistics from {store.rebuild_stats()['conversations']} records")
+    elif args.command == "search":
+        total, page = store.search(args.query, args.level, limit=args.limit)
+        print(f"{SEARCH_COUNT_LIMIT}+ matches" if total > SEARCH_COUNT_LIMIT else f"{total} match(es)")
+        for number, record in page:
+            print(json.dumps({"id": number, **record}, ensure_ascii=False))
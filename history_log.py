@@ -0,0 +1,659 @@
+import atexit
+import gzip
+import json
+from array import array
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import Iterable, Iterator
+
+from metrics import get_metrics
+
+# Append-only JSON Lines log: one record per line, never rewritten in place.
+HISTORY_FILE = "chatbot_history.jsonl"
+
+# Pre-JSONL history (a single JSON array), migrated once on first use.
+LEGACY_LOG_FILE = "chatbot_history.json"
+
+# "jsonl": this module's append-only log; "sqlite": the indexed, searchable
+# store in history_db
+HISTORY_BACKENDS = ("jsonl", "sqlite")
+
+# "never": leave flushing to the OS, "batch": fsync after every batch,
+# "interval": fsync at most once every `fsync_interval` seconds.
+FSYNC_POLICIES = ("never", "batch", "interval")
+
+# Rotated segments are named after their first and last record timestamps:
+# chatbot_history.20240101T000000-20240101T235959.jsonl.gz
+SEGMENT_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+_singleton_lock = threading.Lock()
+
+# ---------------------- Migration ----------------------
+def migrate_legacy_log(legacy_path: str = LEGACY_LOG_FILE, path: str = HISTORY_FILE) -> int:
+    """Convert a JSON-array history file into JSON Lines, once.
+
+    The legacy file is renamed to ``<name>.migrated`` afterwards so the
+    conversion never runs twice. Returns the number of records migrated.
+    """
+    if not os.path.exists(legacy_path):
+        return 0
+
+    try:
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    except json.JSONDecodeError:
+        records = []
+    if not isinstance(records, list):
+        records = []
+
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(legacy_path, legacy_path + ".migrated")
+    rebuild_stats(path)
+    return len(records)
+
+# ---------------------- Reader ----------------------
+def _parse_lines(f) -> Iterator[dict]:
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # A crash mid-write can leave a partial last line
+            continue
+
+
+def iter_records(path: str = HISTORY_FILE) -> Iterator[dict]:
+    """Yield logged records oldest first, skipping blank or torn lines."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from _parse_lines(f)
+    except FileNotFoundError:
+        return
+
+
+def iter_segment(segment: str) -> Iterator[dict]:
+    """Yield the records of a compressed segment, oldest first."""
+    try:
+        with gzip.open(segment, "rt", encoding="utf-8") as f:
+            yield from _parse_lines(f)
+    except FileNotFoundError:
+        # Pruned while being read
+        return
+
+# ---------------------- Rotation and Retention ----------------------
+def _segment_pattern(path: str) -> re.Pattern:
+    base = re.escape(os.path.basename(os.path.splitext(path)[0]))
+    return re.compile(base + r"\.(\d{8}T\d{6})-(\d{8}T\d{6})(?:\.\d+)?\.jsonl(\.gz)?")
+
+
+def list_segments(path: str = HISTORY_FILE, compressed: bool = True) -> list[tuple[str, str, str]]:
+    """Rotated segments of the log at `path`, oldest first.
+
+    Returns ``(first, last, segment_path)`` with the first and last record
+    times in SEGMENT_TIME_FORMAT. With ``compressed=False``, lists segments
+    whose compression was interrupted instead.
+    """
+    directory = os.path.dirname(path) or "."
+    pattern = _segment_pattern(path)
+    segments = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return segments
+    for name in names:
+        match = pattern.fullmatch(name)
+        if match and bool(match.group(3)) == compressed:
+            segments.append((match.group(1), match.group(2), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def _segment_time(timestamp: str | None) -> str:
+    try:
+        return datetime.fromisoformat(timestamp).strftime(SEGMENT_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.utcnow().strftime(SEGMENT_TIME_FORMAT)
+
+
+def compress_segment(pending: str) -> str:
+    """Gzip a rotated-out log file in place and return the ``.gz`` path."""
+    target = pending + ".gz"
+    tmp = target + ".tmp"
+    with open(pending, "rb") as src, gzip.open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, target)
+    os.remove(pending)
+    return target
+
+
+def rotate_log(path: str = HISTORY_FILE) -> str | None:
+    """Move the current log into a compressed segment and start a new one.
+
+    Must not run concurrently with a HistoryWriter on the same log; the
+    writer calls it from its own thread. Returns the segment path, or None
+    when there is nothing to rotate.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    stats = read_stats(path)
+    base = os.path.splitext(path)[0]
+    name = f"{base}.{_segment_time(stats['first_timestamp'])}-{_segment_time(stats['last_timestamp'])}"
+    pending = name + ".jsonl"
+    suffix = 1
+    while os.path.exists(pending) or os.path.exists(pending + ".gz"):
+        pending = f"{name}.{suffix}.jsonl"
+        suffix += 1
+    # The rename is atomic: the next batch starts a new file
+    os.replace(path, pending)
+    save_stats(empty_stats(), path)
+    segment = compress_segment(pending)
+    archived = read_segment_stats(path)
+    archived[os.path.basename(segment)] = stats
+    save_segment_stats(archived, path)
+    return segment
+
+
+def prune_segments(path: str = HISTORY_FILE, retention_days: float = 0) -> int:
+    """Delete segments whose newest record is older than `retention_days`.
+
+    Returns the number of segments removed; 0 days keeps everything.
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime(SEGMENT_TIME_FORMAT)
+    removed = 0
+    for _, last, segment in list_segments(path):
+        if last < cutoff:
+            os.remove(segment)
+            removed += 1
+    if removed:
+        # Drops the pruned segments' entries
+        save_segment_stats(read_segment_stats(path), path)
+    return removed
+
+
+def read_segment_page(segment: str, page: int, page_size: int, total: int) -> list[tuple[int, dict]]:
+    """One newest-first page of a segment holding `total` records, like ``HistoryIndex.read_page``.
+
+    Segments are gzipped, so this decompresses up to the end of the page.
+    """
+    stop = total - page * page_size
+    start = max(stop - page_size, 0)
+    records = islice(iter_segment(segment), start, max(stop, 0))
+    return list(reversed(list(enumerate(records, start + 1))))
+
+
+def recover_segments(path: str = HISTORY_FILE) -> int:
+    """Finish compressing segments left behind by an interrupted rotation."""
+    pending = list_segments(path, compressed=False)
+    for _, _, segment in pending:
+        compress_segment(segment)
+    return len(pending)
+
+
+def clear_history(path: str = HISTORY_FILE) -> bool:
+    """Delete the log, its sidecar and every segment. Returns whether anything existed."""
+    files = [path, stats_path(path), segment_stats_path(path)] + [
+        segment for compressed in (True, False) for _, _, segment in list_segments(path, compressed)
+    ]
+    removed = False
+    for file in files:
+        try:
+            os.remove(file)
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+# ---------------------- Export ----------------------
+def iter_export(path: str = HISTORY_FILE, start: date | None = None,
+                end: date | None = None) -> Iterator[dict]:
+    """Yield every retained record, oldest first, optionally within a date range.
+
+    Segments are read one line at a time and skipped outright when their
+    name shows they fall outside the range, so memory use does not depend
+    on how much history there is.
+    """
+    first_day = start.strftime("%Y%m%d") if start else None
+    last_day = end.strftime("%Y%m%d") if end else None
+    start_iso = start.isoformat() if start else None
+    end_iso = end.isoformat() if end else None
+
+    def in_range(record: dict) -> bool:
+        day = str(record.get("timestamp", ""))[:10]
+        return (start_iso is None or day >= start_iso) and (end_iso is None or day <= end_iso)
+
+    for first, last, segment in list_segments(path):
+        if (first_day and last[:8] < first_day) or (last_day and first[:8] > last_day):
+            continue
+        for record in iter_segment(segment):
+            if in_range(record):
+                yield record
+    for record in iter_records(path):
+        if in_range(record):
+            yield record
+
+
+def iter_json_array(records: Iterable[dict]) -> Iterator[str]:
+    """Chunks of `records` as one JSON array, formatted like ``json.dumps(indent=4)``."""
+    yield "["
+    separator = "\n"
+    for record in records:
+        yield separator + "    " + json.dumps(record, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+        separator = ",\n"
+    yield "\n]" if separator != "\n" else "]"
+
+# ---------------------- Statistics Sidecar ----------------------
+def stats_path(path: str = HISTORY_FILE) -> str:
+    """Location of the running-aggregates sidecar for the log at `path`."""
+    return os.path.splitext(path)[0] + ".stats.json"
+
+
+def empty_stats() -> dict:
+    return {
+        "conversations": 0,
+        "alerts": {"high": 0, "medium": 0, "low": 0},
+        "alert_types": {},
+        "first_timestamp": None,
+        "last_timestamp": None,
+    }
+
+
+def update_stats(stats: dict, records: list[dict]) -> dict:
+    """Fold `records` into `stats` in place and return it."""
+    for record in records:
+        stats["conversations"] += 1
+        summary = record.get("severity_summary", {})
+        for level in ("high", "medium", "low"):
+            stats["alerts"][level] += summary.get(level, 0)
+        for alert in record.get("alerts", []):
+            message = alert.get("message", "")
+            stats["alert_types"][message] = stats["alert_types"].get(message, 0) + 1
+        timestamp = record.get("timestamp")
+        if timestamp:
+            if stats["first_timestamp"] is None:
+                stats["first_timestamp"] = timestamp
+            stats["last_timestamp"] = timestamp
+    return stats
+
+
+def rebuild_stats(path: str = HISTORY_FILE) -> dict:
+    """Recompute the sidecar from the raw log and save it."""
+    stats = update_stats(empty_stats(), iter_records(path))
+    save_stats(stats, path)
+    return stats
+
+
+def save_stats(stats: dict, path: str = HISTORY_FILE):
+    target = stats_path(path)
+    tmp = target + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False)
+    os.replace(tmp, target)
+
+
+def read_stats(path: str = HISTORY_FILE) -> dict:
+    """Return the running aggregates, rebuilding the sidecar if it is missing."""
+    try:
+        with open(stats_path(path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        if os.path.exists(path):
+            return rebuild_stats(path)
+        return empty_stats()
+
+
+def merge_stats(stats: dict, other: dict) -> dict:
+    """Add the aggregates in `other` to `stats` in place and return it."""
+    stats["conversations"] += other["conversations"]
+    for level in ("high", "medium", "low"):
+        stats["alerts"][level] += other["alerts"][level]
+    for message, count in other["alert_types"].items():
+        stats["alert_types"][message] = stats["alert_types"].get(message, 0) + count
+    if other["first_timestamp"] and (stats["first_timestamp"] is None
+                                     or other["first_timestamp"] < stats["first_timestamp"]):
+        stats["first_timestamp"] = other["first_timestamp"]
+    if other["last_timestamp"] and (stats["last_timestamp"] is None
+                                    or other["last_timestamp"] > stats["last_timestamp"]):
+        stats["last_timestamp"] = other["last_timestamp"]
+    return stats
+
+
+def segment_stats_path(path: str = HISTORY_FILE) -> str:
+    """Location of the per-segment aggregates for the log at `path`."""
+    return os.path.splitext(path)[0] + ".segments.json"
+
+
+def save_segment_stats(archived: dict, path: str = HISTORY_FILE):
+    target = segment_stats_path(path)
+    tmp = target + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(archived, f, ensure_ascii=False)
+    os.replace(tmp, target)
+
+
+def read_segment_stats(path: str = HISTORY_FILE) -> dict:
+    """Aggregates of every retained segment, keyed by segment file name.
+
+    Entries for pruned segments are dropped; segments without an entry
+    (rotated before the sidecar existed, or a lost update) are rescanned.
+    """
+    try:
+        with open(segment_stats_path(path), "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved = {}
+    archived = {}
+    rebuilt = False
+    for _, _, segment in list_segments(path):
+        name = os.path.basename(segment)
+        if name not in saved:
+            saved[name] = update_stats(empty_stats(), iter_segment(segment))
+            rebuilt = True
+        archived[name] = saved[name]
+    if rebuilt:
+        save_segment_stats(archived, path)
+    return archived
+
+
+def read_total_stats(path: str = HISTORY_FILE) -> dict:
+    """Aggregates over all retained history: every segment plus the current log."""
+    stats = empty_stats()
+    for segment in read_segment_stats(path).values():
+        merge_stats(stats, segment)
+    return merge_stats(stats, read_stats(path))
+
+# ---------------------- Offset Index ----------------------
+class HistoryIndex:
+    """Byte offset of every complete line in the log, for random-access paging.
+
+    The index is extended incrementally: each refresh only scans bytes
+    appended since the previous one. If the file is replaced (cleared or
+    rotated) or shrinks, the index is rebuilt from scratch.
+    """
+
+    def __init__(self, path: str = HISTORY_FILE):
+        self.path = path
+        self._offsets = array("Q")
+        self._scanned = 0
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Index any newly appended lines and return the record count."""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+                size, inode = stat.st_size, stat.st_ino
+            except FileNotFoundError:
+                size, inode = 0, None
+            if size < self._scanned or inode != self._inode:
+                self._offsets = array("Q")
+                self._scanned = 0
+                self._inode = inode
+            if size > self._scanned:
+                with open(self.path, "rb") as f:
+                    f.seek(self._scanned)
+                    pos = self._scanned
+                    for line in f:
+                        # Stop at a torn last line; it is picked up once complete
+                        if not line.endswith(b"\n"):
+                            break
+                        if line.strip():
+                            self._offsets.append(pos)
+                        pos += len(line)
+                    self._scanned = pos
+            return len(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def read_range(self, start: int, stop: int) -> list[dict]:
+        """Return records ``start`` up to ``stop`` (oldest-first indices)."""
+        records = []
+        with self._lock:
+            offsets = self._offsets[max(start, 0):max(stop, 0)]
+        if not offsets:
+            return records
+        with open(self.path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                try:
+                    records.append(json.loads(f.readline()))
+                except json.JSONDecodeError:
+                    records.append({})
+        return records
+
+    def read_page(self, page: int, page_size: int) -> list[tuple[int, dict]]:
+        """Return one newest-first page as ``(record_number, record)`` pairs.
+
+        Page 0 holds the most recent records; record numbers start at 1 for
+        the oldest record in the log.
+        """
+        total = self.refresh()
+        stop = total - page * page_size
+        start = max(stop - page_size, 0)
+        records = self.read_range(start, stop)
+        return list(reversed(list(enumerate(records, start + 1))))
+
+
+_indexes = {}
+
+
+def get_index(path: str = HISTORY_FILE) -> HistoryIndex:
+    """Return the process-wide offset index for `path`."""
+    with _singleton_lock:
+        if path not in _indexes:
+            _indexes[path] = HistoryIndex(path)
+        return _indexes[path]
+
+# ---------------------- Background Writer ----------------------
+class HistoryWriter:
+    """Single background thread that appends queued records in batches.
+
+    Sessions only enqueue; the writer thread is the only code that touches
+    the file, so concurrent sessions can no longer overwrite each other.
+    That holds within one process only: the stats sidecar and rotation are
+    not coordinated across processes, so several processes logging to one
+    place need HISTORY_BACKEND=sqlite.
+
+    After a batch, the log is rotated into a compressed segment once it
+    reaches `max_bytes` or its oldest record is `max_age` seconds old, and
+    segments older than `retention_days` are deleted. Zero disables each.
+    """
+
+    def __init__(self, path: str = HISTORY_FILE, batch_size: int = 64,
+                 flush_interval: float = 0.5, fsync: str = "batch",
+                 fsync_interval: float = 5.0, max_bytes: int = 0,
+                 max_age: float = 0, retention_days: float = 0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retention_days = retention_days
+        self._queue = queue.Queue()
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record: dict):
+        """Queue a record for appending. Never blocks on disk I/O."""
+        if self._closed:
+            raise RuntimeError("HistoryWriter is closed")
+        self._queue.put(record)
+
+    @property
+    def backlog(self) -> int:
+        """Records queued but not written yet."""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Block until every record submitted so far is written."""
+        self._queue.join()
+
+    def close(self):
+        """Write out anything still queued and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            records = [record for record in batch if record is not _STOP]
+            try:
+                if records:
+                    self._write(records)
+            except OSError:
+                logger.exception("Failed to append %d history records", len(records))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if batch[-1] is _STOP:
+                return
+
+    def _write(self, records: list[dict]):
+        start = time.perf_counter()
+        # Read before appending so a missing sidecar is rebuilt without this batch
+        stats = read_stats(self.path)
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        # Opened per batch so the file can be removed or rotated underneath us
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            size = f.tell()
+            now = time.monotonic()
+            if self.fsync == "batch" or (
+                self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(f.fileno())
+                self._last_fsync = now
+        save_stats(update_stats(stats, records), self.path)
+        get_metrics().observe("history_write", time.perf_counter() - start)
+
+        if self._rotation_due(stats, size):
+            start = time.perf_counter()
+            rotate_log(self.path)
+            prune_segments(self.path, self.retention_days)
+            get_metrics().observe("history_rotate", time.perf_counter() - start)
+
+    def _rotation_due(self, stats: dict, size: int) -> bool:
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        if self.max_age and stats["first_timestamp"]:
+            try:
+                first = datetime.fromisoformat(stats["first_timestamp"])
+            except ValueError:
+                return False
+            return (datetime.utcnow() - first).total_seconds() >= self.max_age
+        return False
+
+
+_writer = None
+
+
+def history_backend() -> str:
+    """The storage backend selected with HISTORY_BACKEND (default jsonl)."""
+    backend = os.getenv("HISTORY_BACKEND", "jsonl")
+    if backend not in HISTORY_BACKENDS:
+        raise ValueError(f"HISTORY_BACKEND must be one of {HISTORY_BACKENDS}, got {backend!r}")
+    return backend
+
+
+def get_writer(path: str = HISTORY_FILE) -> HistoryWriter:
+    """Return the process-wide writer, migrating the legacy log on first use.
+
+    Settings come from HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL,
+    HISTORY_FSYNC, HISTORY_FSYNC_INTERVAL and, for rotation,
+    HISTORY_MAX_BYTES, HISTORY_MAX_AGE_HOURS and HISTORY_RETENTION_DAYS
+    (default 0: history is kept until deleted by hand).
+    With HISTORY_BACKEND=sqlite, records go to the SQLite store instead
+    (see ``history_db.open_writer``), importing the log at `path` once.
+    """
+    global _writer
+    with _singleton_lock:
+        if _writer is None:
+            migrate_legacy_log(path=path)
+            if history_backend() == "sqlite":
+                from history_db import open_writer
+                _writer = open_writer(path)
+                return _writer
+            retention_days = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+            recover_segments(path)
+            prune_segments(path, retention_days)
+            _writer = HistoryWriter(
+                path=path,
+                batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "64")),
+                flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5")),
+                fsync=os.getenv("HISTORY_FSYNC", "batch"),
+                fsync_interval=float(os.getenv("HISTORY_FSYNC_INTERVAL", "5.0")),
+                max_bytes=int(os.getenv("HISTORY_MAX_BYTES", str(16 * 1024 * 1024))),
+                max_age=float(os.getenv("HISTORY_MAX_AGE_HOURS", "24")) * 3600,
+                retention_days=retention_days,
+            )
+            atexit.register(_writer.close)
+        return _writer
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance commands for the chat history log.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild-stats", help="Recompute the statistics sidecars from the raw log and segments")
+    rebuild.add_argument("--log", default=HISTORY_FILE, help="Path to the JSONL history log")
+    rotate = subparsers.add_parser("rotate", help="Compress the current log into a segment (app stopped)")
+    rotate.add_argument("--log", default=HISTORY_FILE, help="Path to the JSONL history log")
+    rotate.add_argument("--retention-days", type=float, default=float(os.getenv("HISTORY_RETENTION_DAYS", "0")),
+                        help="Also delete segments older than this (0 keeps everything)")
+    args = parser.parse_args()
+
+    if args.command == "rebuild-stats":
+        stats = rebuild_stats(args.log)
+        print(f"Rebuilt {stats_path(args.log)} from {stats['conversations']} records")
+        save_segment_stats({}, args.log)
+        archived = read_segment_stats(args.log)
+        print(f"Rebuilt {segment_stats_path(args.log)} from {len(archived)} segment(s)")
+    elif args.command == "rotate":
+        segment = rotate_log(args.log)
+        print(f"Rotated into {segment}" if segment else "Nothing to rotate")
+        removed = prune_segments(args.log, args.retention_days)
+        if removed:
+            print(f"Deleted {removed} segment(s) past retention")
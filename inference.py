@@ -0,0 +1,554 @@
+"""Chat completion backends with deadlines, retries and admission control.
+
+Every backend shares the same policy, implemented once in InferenceBackend:
+
+* each attempt runs under a deadline (`timeout` seconds for the whole call,
+  or between two streamed chunks);
+* transient failures (timeouts, dropped connections, 408/429/5xx) are
+  retried up to `max_retries` times with full-jitter exponential backoff;
+* at most `max_concurrency` calls are in flight per process, so a burst of
+  sessions queues here instead of tripping upstream rate limits;
+* at most `max_queue` more calls wait for a slot, served round-robin across
+  sessions so one busy session cannot starve the others. Past that, calls
+  fail at once with ``Busy`` and a retry hint rather than waiting.
+
+ModelRouter sits on top: it tries an ordered list of models or endpoint
+URLs, hedges a slow call with the next one after that model's observed p90
+latency, and skips an endpoint that keeps failing for a cool-down period.
+
+A backend is bound to the event loop it first runs on. Synchronous callers
+(the Streamlit script) go through ``run_sync``, which drives one long-lived
+background loop so connections are reused across reruns.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from httpx2 import TransportError
+
+from metrics import get_metrics
+
+# Tried in order; Hugging Face model ids or URLs of compatible chat endpoints
+MODEL_NAME = "meta-llama/Llama-3.2-3B-Instruct"
+
+# Upstream statuses worth retrying; anything else (401, 404, 422, ...) fails fast
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class InferenceError(RuntimeError):
+    """Raised when a completion fails for good (after any retries)."""
+
+
+class Busy(InferenceError):
+    """Raised when the admission queue is full; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"The assistant is busy, retry in {retry_after} s.")
+        self.retry_after = retry_after
+
+
+def _status_code(exc: BaseException) -> int | None:
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether `exc` is worth retrying."""
+    status = _status_code(exc)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError, TransportError))
+
+# ---------------------- Admission ----------------------
+class AdmissionController:
+    """Concurrency cap with a bounded wait queue, fair across sessions.
+
+    Waiting calls are grouped by session and the groups take turns: when a
+    slot frees up it goes to the oldest waiter of the next session in line,
+    so a session with many queued calls gets one slot per round. Calls
+    without a session share one group. Must be used from one event loop.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 32):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._waiters: OrderedDict[str | None, deque[asyncio.Future]] = OrderedDict()
+        self._hold = 1.0    # moving average of seconds a slot is held
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained, rounded up."""
+        return max(1, math.ceil(self._hold * (self.queued + 1) / max(self.max_concurrency, 1)))
+
+    async def acquire(self, session: str | None = None, queue: bool = True):
+        """Take a slot, waiting in line if none is free.
+
+        Raises Busy when the queue is full. With ``queue=False`` the call
+        waits regardless: a retry of an admitted call is not turned away.
+        """
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            return
+        if queue and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise Busy(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()          # the slot was handed over just as we gave up
+            else:
+                self._discard(session, waiter)
+            raise
+
+    def release(self):
+        """Hand the slot to the next session in line, or free it."""
+        while self._waiters:
+            session, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(session)
+            else:
+                del self._waiters[session]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, session: str | None = None, queue: bool = True):
+        await self.acquire(session, queue)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold += (time.perf_counter() - start - self._hold) * 0.2
+            self.release()
+
+    def _discard(self, session, waiter):
+        waiters = self._waiters.get(session)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[session]
+
+# ---------------------- Backends ----------------------
+class InferenceBackend:
+    """Base class: subclasses implement ``_chat`` and ``_stream`` only.
+
+    `session` identifies the caller for fair queueing; a full queue raises
+    Busy before any attempt is made.
+    """
+
+    def __init__(self, timeout: float = 30.0, max_retries: int = 2, backoff: float = 0.5,
+                 max_backoff: float = 8.0, max_concurrency: int = 8, max_queue: int = 32):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.retries = 0
+        self.failures = 0
+        self.admission = AdmissionController(max_concurrency, max_queue)
+
+    async def chat(self, messages: list[dict], model: str, max_tokens: int, temperature: float,
+                   session: str | None = None) -> str:
+        """Return the full reply text."""
+        attempt = 0
+        while True:
+            async with self.admission.slot(session, queue=attempt == 0):
+                try:
+                    return await asyncio.wait_for(
+                        self._chat(messages, model, max_tokens, temperature), self.timeout
+                    )
+                except Exception as exc:
+                    failure = exc
+            attempt += 1
+            await self._backoff_or_raise(failure, attempt)
+
+    async def stream(self, messages: list[dict], model: str, max_tokens: int,
+                     temperature: float, session: str | None = None) -> AsyncIterator[str]:
+        """Yield reply text deltas as they arrive.
+
+        A failed attempt is only retried if nothing has been yielded yet;
+        restarting midway would repeat text the caller already consumed.
+        """
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self.admission.slot(session, queue=attempt == 0):
+                    chunks = self._stream(messages, model, max_tokens, temperature).__aiter__()
+                    while True:
+                        try:
+                            delta = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                        except StopAsyncIteration:
+                            return
+                        started = True
+                        yield delta
+            except Busy:
+                raise
+            except Exception as exc:
+                if started:
+                    self.failures += 1
+                    raise InferenceError(f"Stream interrupted: {exc!r}") from exc
+                attempt += 1
+                await self._backoff_or_raise(exc, attempt)
+
+    async def aclose(self):
+        """Release pooled connections."""
+
+    def stats(self) -> dict:
+        return {
+            "retries": self.retries,
+            "failures": self.failures,
+            "active": self.admission.active,
+            "queued": self.admission.queued,
+            "rejected": self.admission.rejected,
+        }
+
+    async def _backoff_or_raise(self, exc: Exception, attempt: int):
+        if attempt > self.max_retries or not is_transient(exc):
+            self.failures += 1
+            raise InferenceError(f"Inference failed after {attempt} attempt(s): {exc!r}") from exc
+        self.retries += 1
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        await asyncio.sleep(delay)
+
+    async def _chat(self, messages, model, max_tokens, temperature) -> str:
+        raise NotImplementedError
+
+    def _stream(self, messages, model, max_tokens, temperature) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+
+class HuggingFaceBackend(InferenceBackend):
+    """Hugging Face Inference API through one pooled ``AsyncInferenceClient``."""
+
+    def __init__(self, token: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        from huggingface_hub import AsyncInferenceClient
+
+        self._client = AsyncInferenceClient(token=token, timeout=self.timeout)
+
+    async def _chat(self, messages, model, max_tokens, temperature) -> str:
+        response = await self._client.chat_completion(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return response.choices[0].message.content
+
+    async def _stream(self, messages, model, max_tokens, temperature) -> AsyncIterator[str]:
+        chunks = await self._client.chat_completion(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        async for chunk in chunks:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+
+    async def aclose(self):
+        await self._client.close()
+
+
+class FakeUpstreamError(ConnectionError):
+    """What FakeBackend raises for a simulated upstream 503."""
+
+    response = type("Response", (), {"status_code": 503})()
+
+
+class FakeBackend(InferenceBackend):
+    """Offline stand-in for tests, demos and benchmarks.
+
+    Replies after `latency` (+ up to `jitter`) seconds, echoing the last user
+    message unless a fixed `reply` is given. `failure_rate` makes that share
+    of attempts fail with a retryable 503.
+    """
+
+    def __init__(self, reply: str | None = None, latency: float = 0.05, jitter: float = 0.0,
+                 failure_rate: float = 0.0, chunk_size: int = 4, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    def _reply(self, messages: list[dict]) -> str:
+        if self.reply is not None:
+            return self.reply
+        return f"You said: {messages[-1]['content']}" if messages else ""
+
+    async def _wait(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.failure_rate:
+            raise FakeUpstreamError()
+
+    async def _chat(self, messages, model, max_tokens, temperature) -> str:
+        await self._wait()
+        return self._reply(messages)
+
+    async def _stream(self, messages, model, max_tokens, temperature) -> AsyncIterator[str]:
+        await self._wait()
+        text = self._reply(messages)
+        for i in range(0, len(text), self.chunk_size):
+            yield text[i:i + self.chunk_size]
+            await asyncio.sleep(0)
+
+
+# ---------------------- Model Routing ----------------------
+class ModelRouter:
+    """Ordered models with hedged requests and a cool-down for failing ones.
+
+    A call goes to the first model not cooling down. If it has not answered
+    (or, streamed, sent its first chunk) within the p90 of that model's
+    recent latencies, the same request is also sent to the next model and
+    the first answer wins; the other call is cancelled. Hedges are only sent
+    while the backend has a free slot, so they never queue behind real
+    traffic. A model whose call fails for good is skipped for `cooldown`
+    seconds and the next one is tried at once.
+    """
+
+    def __init__(self, models: list[str], hedge_delay: float = 2.0, min_hedge_delay: float = 0.1,
+                 cooldown: float = 30.0, window: int = 200, min_samples: int = 20):
+        if not models:
+            raise ValueError("ModelRouter needs at least one model")
+        self.models = list(models)
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        # Recent latencies per call kind: full replies for "chat", first chunks for "stream"
+        self._latencies = {kind: {model: deque(maxlen=window) for model in self.models}
+                           for kind in ("chat", "stream")}
+        self._cooling: dict[str, float] = {}    # model -> monotonic time it may be used again
+
+    @property
+    def key(self) -> str:
+        """Identifies the model list, e.g. for cache keys."""
+        return ",".join(self.models)
+
+    def delay(self, model: str, kind: str = "chat") -> float:
+        """Seconds to wait on `model` before hedging: its p90, once enough calls were seen."""
+        samples = self._latencies[kind][model]
+        if len(samples) < self.min_samples:
+            return self.hedge_delay
+        return max(self.min_hedge_delay, sorted(samples)[int(len(samples) * 0.9)])
+
+    def candidates(self) -> list[str]:
+        """Models to try, in order; cooling ones go last so a call always has one."""
+        now = time.monotonic()
+        ready = [model for model in self.models if self._cooling.get(model, 0) <= now]
+        cooling = sorted((model for model in self.models if model not in ready), key=self._cooling.get)
+        return ready + cooling
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            model: {
+                "hedge_delay": round(self.delay(model), 3),
+                "stream_hedge_delay": round(self.delay(model, "stream"), 3),
+                "cooling": max(0.0, round(self._cooling.get(model, 0) - now, 1)),
+            }
+            for model in self.models
+        }
+
+    async def chat(self, backend: InferenceBackend, messages: list[dict], max_tokens: int,
+                   temperature: float, session: str | None = None) -> str:
+        """``backend.chat`` with hedging and fallback across the models."""
+        async def attempt(model):
+            return await backend.chat(messages, model, max_tokens, temperature, session)
+
+        return (await self._race(backend, attempt, "chat"))[1]
+
+    async def stream(self, backend: InferenceBackend, messages: list[dict], max_tokens: int,
+                     temperature: float, session: str | None = None) -> AsyncIterator[str]:
+        """``backend.stream`` with hedging and fallback on the first chunk.
+
+        Once a model has sent its first chunk the stream is committed to it.
+        """
+        streams = []
+
+        async def attempt(model):
+            chunks = backend.stream(messages, model, max_tokens, temperature, session)
+            streams.append(chunks)
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return chunks, None
+
+        try:
+            model, (chunks, first) = await self._race(backend, attempt, "stream")
+            if first is None:
+                return
+            yield first
+            try:
+                async for delta in chunks:
+                    yield delta
+            except InferenceError as exc:
+                self._failed(model, exc)
+                raise
+        finally:
+            # Losing streams were cancelled mid-__anext__; close them so they free their slots
+            for chunks in streams:
+                await chunks.aclose()
+
+    async def _race(self, backend: InferenceBackend, attempt, kind: str) -> tuple:
+        """Run `attempt(model)` down the candidates with hedging; return (model, result)."""
+        metrics = get_metrics()
+        models = self.candidates()
+        tried = 0
+        pending: dict[asyncio.Task, tuple[str, float]] = {}
+        failure = None
+
+        def launch():
+            nonlocal tried
+            model = models[tried]
+            tried += 1
+            task = asyncio.create_task(attempt(model))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            pending[task] = (model, time.perf_counter())
+
+        launch()
+        try:
+            while pending:
+                hedge = (len(pending) == 1 and tried < len(models)
+                         and backend.admission.active < backend.admission.max_concurrency)
+                timeout = self.delay(next(iter(pending.values()))[0], kind) if hedge else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    metrics.inc("hedged_requests", help="Slow calls duplicated to the next model.")
+                    launch()
+                    continue
+                for task in done:
+                    model, start = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Busy as exc:
+                        # The queue is shared by every model; a hedge turned away is simply dropped
+                        failure = failure or exc
+                        continue
+                    except InferenceError as exc:
+                        self._failed(model, exc)
+                        failure = exc
+                        continue
+                    self._latencies[kind][model].append(time.perf_counter() - start)
+                    if model != models[0]:
+                        metrics.inc("fallback_answers", model=model,
+                                    help="Answers from a model other than the first choice.")
+                    return model, result
+                if not pending and tried < len(models) and not isinstance(failure, Busy):
+                    launch()
+            raise failure
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def _failed(self, model: str, exc: Exception):
+        self._cooling[model] = time.monotonic() + self.cooldown
+        get_metrics().inc("model_failures", model=model, help="Calls that failed for good, by model.")
+
+# ---------------------- Process-wide Backend ----------------------
+BACKENDS = {"hf": HuggingFaceBackend, "fake": FakeBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> InferenceBackend:
+    """Return the process-wide backend.
+
+    Selected with INFERENCE_BACKEND (hf or fake) and tuned with
+    INFERENCE_TIMEOUT, INFERENCE_MAX_RETRIES, INFERENCE_BACKOFF,
+    INFERENCE_MAX_CONCURRENCY and INFERENCE_MAX_QUEUE. The fake backend also
+    reads FAKE_LATENCY, FAKE_JITTER and FAKE_FAILURE_RATE.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = os.getenv("INFERENCE_BACKEND", "hf")
+            if name not in BACKENDS:
+                raise ValueError(f"INFERENCE_BACKEND must be one of {sorted(BACKENDS)}, got {name!r}")
+            kwargs = dict(
+                timeout=float(os.getenv("INFERENCE_TIMEOUT", "30")),
+                max_retries=int(os.getenv("INFERENCE_MAX_RETRIES", "2")),
+                backoff=float(os.getenv("INFERENCE_BACKOFF", "0.5")),
+                max_concurrency=int(os.getenv("INFERENCE_MAX_CONCURRENCY", "8")),
+                max_queue=int(os.getenv("INFERENCE_MAX_QUEUE", "32")),
+            )
+            if name == "hf":
+                kwargs["token"] = os.getenv("HUGGINGFACE_TOKEN")
+            else:
+                kwargs["latency"] = float(os.getenv("FAKE_LATENCY", "0.05"))
+                kwargs["jitter"] = float(os.getenv("FAKE_JITTER", "0"))
+                kwargs["failure_rate"] = float(os.getenv("FAKE_FAILURE_RATE", "0"))
+            _backend = BACKENDS[name](**kwargs)
+        return _backend
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Return the process-wide model router.
+
+    INFERENCE_MODELS lists the models or endpoint URLs to try, comma
+    separated (default: MODEL_NAME). HEDGE_DELAY is the hedge delay used
+    until a model has a p90 (seconds, default 2) and MODEL_COOLDOWN how long
+    a failing model is skipped (seconds, default 30).
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            models = [model.strip() for model in os.getenv("INFERENCE_MODELS", MODEL_NAME).split(",")]
+            _router = ModelRouter(
+                [model for model in models if model],
+                hedge_delay=float(os.getenv("HEDGE_DELAY", "2")),
+                cooldown=float(os.getenv("MODEL_COOLDOWN", "30")),
+            )
+        return _router
+
+# ---------------------- Sync Bridge ----------------------
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="inference-loop", daemon=True).start()
+        return _loop
+
+
+def submit(coro):
+    """Schedule `coro` on the background loop and return a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def run_sync(coro):
+    """Run `coro` on the background loop and block until it finishes."""
+    return submit(coro).result()
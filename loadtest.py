@@ -0,0 +1,292 @@
+"""Load generator for the full chat pipeline, driven by many simulated sessions.
+
+    python loadtest.py                                   # 1 to 100 sessions, 10 s each
+    python loadtest.py --sessions 10,50,200 --duration 30 --latency 0.8
+    python loadtest.py --mode async -o capacity.json     # the API's code path
+
+Each session runs what a chat turn runs in production, against a FakeBackend
+with the given latency:
+
+* ``threads`` (default): one thread per session making the same calls as the
+  Streamlit chat pane: screening, the token-budgeted context, the blocking
+  ``complete`` on the shared inference loop, context folding and logging;
+* ``async``: one task per session awaiting ``arun_chat``, as the API does.
+
+Sessions pause `think` seconds (+/- 50%) between turns. For every session
+count the harness reports throughput, latency percentiles per pipeline
+stage, how far the history writer falls behind (its peak backlog and batch
+write times) and any records that never reached the log. It also reports
+the capacity: the most sessions whose turns meet the p95 target with no
+lost records and under 1% of turns busy or failed.
+
+Everything runs in a scratch directory, so the real history, cache and
+metrics files are never touched.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# Before any module reads them: no metrics file, every sample kept, every turn a real call
+os.environ.setdefault("METRICS_FILE", "")
+os.environ.setdefault("METRICS_WINDOW", "1000000")
+os.environ.setdefault("RESPONSE_CACHE", "0")
+
+from benchmarks import SEED, _meta, dense_pii, no_pii
+from context import ChatContext
+from history_log import HISTORY_FILE, get_writer, history_backend, iter_export
+from inference import Busy, FakeBackend
+from metrics import get_metrics
+from pipeline import arun_chat, complete, fold_context, log_interaction, screen_prompt
+
+DEFAULT_SESSIONS = "1,5,10,25,50,100"
+
+# Share of turns that may be busy or fail at a sustainable load
+MAX_ERROR_RATE = 0.01
+
+# Stages shown in the summary table, in pipeline order
+STAGES = ("redact_prompt", "first_token", "inference", "redact_reply", "log_submit", "history_write", "turn")
+
+# ---------------------- Sessions ----------------------
+def make_prompt(rng: random.Random) -> str:
+    """A support-chat message of 40 to 400 characters, half of them carrying identifiers."""
+    generate = rng.choice((no_pii, dense_pii))
+    return generate(rng.randint(40, 400), rng.randrange(2 ** 32))
+
+
+def _pause(rng: random.Random, think: float, deadline: float) -> float:
+    return min(think * rng.uniform(0.5, 1.5), max(0.0, deadline - time.perf_counter()))
+
+
+def thread_session(session: int, deadline: float, args, backend: FakeBackend, tally: Counter):
+    """One Streamlit-style session: the chat pane's calls, turn after turn, until `deadline`."""
+    metrics = get_metrics()
+    rng = random.Random(f"{SEED}-{session}")
+    context = ChatContext()
+    on_text = (lambda text: None) if args.stream else None
+    time.sleep(rng.uniform(0, args.think))
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            screening = screen_prompt(make_prompt(rng), args.strict, args.sensitivity)
+            if screening.blocked:
+                tally["blocked"] += 1
+            else:
+                completion = complete(context.messages(screening.prompt), backend, on_text=on_text,
+                                      sensitivity=args.sensitivity, session=f"session-{session}")
+                context.add(screening.prompt, completion.safe_reply)
+                fold_context(context, backend, args.sensitivity)
+                log_interaction(screening.detection, completion.detection,
+                                screening.alerts + completion.alerts)
+                tally["logged"] += 1
+                metrics.observe("turn", time.perf_counter() - start)
+            tally["turns"] += 1
+        except Busy:
+            tally["busy"] += 1
+        except Exception:
+            tally["errors"] += 1
+        time.sleep(_pause(rng, args.think, deadline))
+
+
+async def async_session(session: int, deadline: float, args, backend: FakeBackend, tally: Counter):
+    """One API client: ``arun_chat`` turn after turn until `deadline`."""
+    rng = random.Random(f"{SEED}-{session}")
+    await asyncio.sleep(rng.uniform(0, args.think))
+    while time.perf_counter() < deadline:
+        try:
+            result = await arun_chat(make_prompt(rng), args.strict, True, backend, args.sensitivity,
+                                     session=f"session-{session}")
+            tally["blocked" if result.blocked else "logged"] += 1
+            tally["turns"] += 1
+        except Busy:
+            tally["busy"] += 1
+        except Exception:
+            tally["errors"] += 1
+        await asyncio.sleep(_pause(rng, args.think, deadline))
+
+# ---------------------- Runs ----------------------
+def logged_records() -> int:
+    """Records in the history, once everything submitted so far is written."""
+    get_writer().flush()
+    if history_backend() == "sqlite":
+        from history_db import get_store
+        return get_store().count()
+    return sum(1 for _ in iter_export(HISTORY_FILE))
+
+
+def _backend(args) -> FakeBackend:
+    return FakeBackend(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                       max_concurrency=args.max_concurrency, max_queue=args.max_queue)
+
+
+def run_level(sessions: int, args) -> dict:
+    """Drive `sessions` concurrent sessions for `args.duration` seconds and summarize."""
+    metrics = get_metrics()
+    metrics.reset()
+    writer = get_writer()
+    before = logged_records()
+    backend = _backend(args)
+    tallies = [Counter() for _ in range(sessions)]
+
+    # Sample the writer's queue to see how far logging falls behind
+    backlog = 0
+    sampling = threading.Event()
+
+    def sample():
+        nonlocal backlog
+        while not sampling.wait(0.05):
+            backlog = max(backlog, writer.backlog)
+
+    sampler = threading.Thread(target=sample, name="backlog-sampler", daemon=True)
+    sampler.start()
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if args.mode == "threads":
+        threads = [
+            threading.Thread(target=thread_session, args=(i, deadline, args, backend, tallies[i]),
+                             name=f"session-{i}", daemon=True)
+            for i in range(sessions)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        async def drive():
+            await asyncio.gather(*(async_session(i, deadline, args, backend, tallies[i])
+                                   for i in range(sessions)))
+
+        asyncio.run(drive())
+    elapsed = time.perf_counter() - start
+
+    # How long the writer needs to catch up once the sessions stop
+    drain_start = time.perf_counter()
+    writer.flush()
+    drain = time.perf_counter() - drain_start
+    written = logged_records() - before
+    sampling.set()
+    sampler.join()
+
+    tally = sum(tallies, Counter())
+    attempts = tally["turns"] + tally["busy"] + tally["errors"]
+    snapshot = metrics.snapshot()
+    return {
+        "sessions": sessions,
+        "seconds": elapsed,
+        "turns": tally["turns"],
+        "turns_per_s": tally["turns"] / elapsed if elapsed else 0.0,
+        "blocked": tally["blocked"],
+        "busy": tally["busy"],
+        "errors": tally["errors"],
+        "error_rate": (tally["busy"] + tally["errors"]) / attempts if attempts else 0.0,
+        "log": {
+            "submitted": tally["logged"],
+            "written": written,
+            "lost": tally["logged"] - written,
+            "peak_backlog": backlog,
+            "drain_s": drain,
+        },
+        "backend": backend.stats(),
+        "stages": snapshot["stages"],
+        "counters": snapshot["counters"],
+    }
+
+
+def capacity(levels: list[dict], slo: float) -> int:
+    """Most sessions whose turn p95 is within `slo` with no lost records and few errors."""
+    best = 0
+    for level in levels:
+        turn = level["stages"].get("turn")
+        if (turn and turn["p95"] <= slo and level["log"]["lost"] == 0
+                and level["error_rate"] <= MAX_ERROR_RATE):
+            best = max(best, level["sessions"])
+    return best
+
+# ---------------------- Report ----------------------
+def _ms(stage: dict | None, key: str) -> str:
+    return f"{stage[key] * 1000:.1f}" if stage else "-"
+
+
+def print_level(level: dict):
+    log = level["log"]
+    turn = level["stages"].get("turn")
+    print(f"{level['sessions']:>8} {level['turns']:>7} {level['turns_per_s']:>8.1f} "
+          f"{level['busy']:>6} {level['errors']:>6} {_ms(turn, 'p50'):>9} {_ms(turn, 'p95'):>9} "
+          f"{_ms(turn, 'p99'):>9} {log['peak_backlog']:>8} {log['lost']:>6}", file=sys.stderr)
+
+
+def print_stages(levels: list[dict]):
+    print(f"\n{'stage p50/p95/p99 (ms)':<24}" + "".join(f"{level['sessions']:>24}" for level in levels),
+          file=sys.stderr)
+    for stage in STAGES:
+        cells = []
+        for level in levels:
+            entry = level["stages"].get(stage)
+            cells.append(f"{_ms(entry, 'p50')}/{_ms(entry, 'p95')}/{_ms(entry, 'p99')}" if entry else "-")
+        print(f"{stage:<24}" + "".join(f"{cell:>24}" for cell in cells), file=sys.stderr)
+
+
+def run(args, meta: dict) -> dict:
+    levels = []
+    print(f"{'sessions':>8} {'turns':>7} {'turns/s':>8} {'busy':>6} {'errors':>6} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'backlog':>8} {'lost':>6}", file=sys.stderr)
+    for sessions in args.sessions:
+        level = run_level(sessions, args)
+        levels.append(level)
+        print_level(level)
+    print_stages(levels)
+    best = capacity(levels, args.slo)
+    print(f"\ncapacity: {best} session(s) with turn p95 <= {args.slo:g} s", file=sys.stderr)
+
+    return {"meta": meta, "capacity": best, "levels": levels}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the chat pipeline with simulated sessions.")
+    parser.add_argument("--sessions", default=DEFAULT_SESSIONS,
+                        type=lambda value: [int(n) for n in value.split(",")],
+                        help=f"Concurrent sessions per run, comma separated (default {DEFAULT_SESSIONS})")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run (default 10)")
+    parser.add_argument("--mode", choices=("threads", "async"), default="threads",
+                        help="Streamlit-style session threads or API-style tasks (default threads)")
+    parser.add_argument("--think", type=float, default=1.0, help="Mean pause between turns in seconds")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake backend latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Extra random latency, up to this")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of upstream calls that fail")
+    parser.add_argument("--max-concurrency", type=int, default=int(os.getenv("INFERENCE_MAX_CONCURRENCY", "8")))
+    parser.add_argument("--max-queue", type=int, default=int(os.getenv("INFERENCE_MAX_QUEUE", "32")))
+    parser.add_argument("--no-stream", dest="stream", action="store_false",
+                        help="Threads mode: wait for whole replies instead of streaming")
+    parser.add_argument("--strict", action="store_true", help="Strict mode: HIGH-risk prompts are blocked")
+    parser.add_argument("--sensitivity", choices=("Low", "Medium", "High"), default="High")
+    parser.add_argument("--slo", type=float, default=5.0, help="Turn p95 target in seconds (default 5)")
+    parser.add_argument("-o", "--output", help="Also write the full results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    meta = _meta(quick=False)
+    del meta["quick"]
+    meta["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            results = run(args, meta)
+        finally:
+            get_writer().close()
+            os.chdir(cwd)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,71 @@
-import re
 import streamlit as st
-from huggingface_hub import InferenceClient
 import os
-import json
-from datetime import datetime
-from enum import Enum
-
-# Hugging Face API token
-HF_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
-
-# Hugging Face client
-client = InferenceClient(token=HF_TOKEN)
-
-LOG_FILE = "chatbot_history.json"
+import gzip
+import io
+import time
+import uuid
+from datetime import date, datetime
+
+from context import ChatContext
+from history_log import (HISTORY_FILE, SEGMENT_TIME_FORMAT, clear_history, get_index, get_writer,
+                         history_backend, iter_export, iter_json_array, list_segments,
+                         read_segment_page, read_segment_stats, read_total_stats)
+from redaction import rule_for_alert
+from response_cache import get_cache
+from transcript import CHAT_VISIBLE_MESSAGES, ChatMessage, new_transcript, render_html, visible
+
+LOG_FILE = HISTORY_FILE
+
+HISTORY_PAGE_SIZES = [10, 25, 50, 100]
+
+HISTORY_LEVELS = ["HIGH", "MEDIUM", "SAFE"]
+
+# ---------------------- Shared Resources ----------------------
+# Created once per process and reused by every rerun and every session.
+@st.cache_resource
+def load_history():
+    """History writer, plus the byte-offset index over the JSONL log or the SQLite store.
+
+    Exactly one of the index and the store is set, depending on HISTORY_BACKEND.
+    """
+    writer = get_writer(LOG_FILE)
+    if history_backend() == "sqlite":
+        from history_db import get_store
+        return writer, None, get_store()
+    return writer, get_index(LOG_FILE), None
+
+
+@st.cache_resource
+def load_response_cache():
+    """Cache of redacted replies, keyed on the redacted request (None if disabled)."""
+    return get_cache()
+
+
+@st.cache_resource
+def load_backend():
+    """Inference backend with its pooled connections."""
+    # Deferred: only needed once the first message is sent
+    from inference import get_backend
+    return get_backend()
+
+
+def export_history(start: date | None = None, end: date | None = None) -> bytes:
+    """Gzipped JSON export of the retained history, optionally for a date range.
+
+    Runs only when the download button is clicked. Records are streamed
+    from the store, or the log and its segments, straight into the
+    compressor, so only the compressed export is ever held in memory.
+    """
+    history_writer.flush()
+    if history_store:
+        records = history_store.iter_records(start, end)
+    else:
+        records = iter_export(LOG_FILE, start, end)
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+        for chunk in iter_json_array(records):
+            f.write(chunk.encode("utf-8"))
+    return buffer.getvalue()
 
 # ---------------------- Page Configuration ----------------------
 st.set_page_config(
@@ -22,6 +75,9 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+history_writer, history_index, history_store = load_history()
+response_cache = load_response_cache()
+
 # ---------------------- Custom CSS ----------------------
 st.markdown("""
 <style>
@@ -175,133 +231,12 @@ footer {
 </style>
 """, unsafe_allow_html=True)
 
-# ---------------------- Severity Levels ----------------------
-class SeverityLevel(Enum):
-    LOW = "🟢"
-    MEDIUM = "🟡"
-    HIGH = "🔴"
-
-# ---------------------- Enhanced Sensitive Data Handler ----------------------
-def redact_sensitive_data(text: str) -> tuple[str, list[dict]]:
-    """Redacts sensitive data and returns (redacted_text, alerts with severity)."""
-    alerts = []
-
-    # 🔴 HIGH: Aadhaar (12 digits)
-    if re.search(r"\b\d{12}\b", text):
-        alerts.append({
-            "severity": SeverityLevel.HIGH.value,
-            "message": "Aadhaar number detected and redacted",
-            "level": "HIGH"
-        })
-        text = re.sub(r"\b\d{12}\b", "[REDACTED_AADHAAR]", text)
-
-    # 🔴 HIGH: PAN Card (ABCDE1234F format)
-    if re.search(r"\b[A-Z]{5}[0-9]{4}[A-Z]\b", text):
-        alerts.append({
-            "severity": SeverityLevel.HIGH.value,
-            "message": "PAN card detected and redacted",
-            "level": "HIGH"
-        })
-        text = re.sub(r"\b[A-Z]{5}[0-9]{4}[A-Z]\b", "[REDACTED_PAN]", text)
-
-    # 🔴 HIGH: Credit/Debit Card (13-19 digits with optional spaces/dashes)
-    if re.search(r"\b(?:\d{4}[\s\-]?){3}\d{1,7}\b", text):
-        alerts.append({
-            "severity": SeverityLevel.HIGH.value,
-            "message": "Card number detected and redacted",
-            "level": "HIGH"
-        })
-        text = re.sub(r"\b(?:\d{4}[\s\-]?){3}\d{1,7}\b", "[REDACTED_CARD]", text)
-
-    # 🔴 HIGH: CVV (3-4 digits preceded by cvv/cvc)
-    if re.search(r"\b(?:cvv|cvc)\s*:?\s*\d{3,4}\b", text, re.IGNORECASE):
-        alerts.append({
-            "severity": SeverityLevel.HIGH.value,
-            "message": "CVV detected and redacted",
-            "level": "HIGH"
-        })
-        text = re.sub(r"\b(?:cvv|cvc)\s*:?\s*\d{3,4}\b", "[REDACTED_CVV]", text, flags=re.IGNORECASE)
-
-    # 🟡 MEDIUM: Phone number (10 digits)
-    if re.search(r"\b\d{10}\b", text):
-        alerts.append({
-            "severity": SeverityLevel.MEDIUM.value,
-            "message": "Phone number detected and redacted",
-            "level": "MEDIUM"
-        })
-        text = re.sub(r"\b\d{10}\b", "[REDACTED_PHONE]", text)
-
-    # 🟡 MEDIUM: Email
-    if re.search(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", text):
-        alerts.append({
-            "severity": SeverityLevel.MEDIUM.value,
-            "message": "Email address detected and redacted",
-            "level": "MEDIUM"
-        })
-        text = re.sub(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", "[REDACTED_EMAIL]", text)
-
-    # 🟡 MEDIUM: Address patterns (simplified)
-    if re.search(r"\b\d{6}\b", text):
-        alerts.append({
-            "severity": SeverityLevel.MEDIUM.value,
-            "message": "Postal code detected and redacted",
-            "level": "MEDIUM"
-        })
-        text = re.sub(r"\b\d{6}\b", "[REDACTED_PINCODE]", text)
-
-    return text, alerts
-
-def mask_sensitive_data(text: str) -> str:
-    """Mask sensitive data for logging (partial visibility)."""
-    # Mask Aadhaar (123456789012 -> 123*****012)
-    text = re.sub(r"\b(\d{3})\d{6}(\d{3})\b", r"\1******\2", text)
-
-    # Mask PAN (ABCDE1234F -> ABC**1234*)
-    text = re.sub(r"\b([A-Z]{3})[A-Z]{2}(\d{4})[A-Z]\b", r"\1**\2*", text)
-
-    # Mask phone (9876543210 -> 987****210)
-    text = re.sub(r"\b(\d{3})\d{4}(\d{3})\b", r"\1****\2", text)
-
-    # Mask card (1234567890123456 -> 1234********3456)
-    text = re.sub(r"\b(\d{4})\d{8}(\d{4})\b", r"\1********\2", text)
-
-    # Mask email (john@gmail.com -> j***@gmail.com)
-    text = re.sub(r"([a-zA-Z0-9._%+-])[a-zA-Z0-9._%+-]*(@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})",
-                  r"\1***\2", text)
-
-    return text
-
-def log_interaction(prompt: str, answer: str, alerts: list[dict]):
-    """Log interactions with masked data and severity information."""
-    masked_prompt = mask_sensitive_data(prompt)
-    masked_answer = mask_sensitive_data(answer)
-    
-    record = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "prompt": masked_prompt,
-        "answer": masked_answer,
-        "alerts": alerts,
-        "severity_summary": {
-            "high": sum(1 for a in alerts if a.get("level") == "HIGH"),
-            "medium": sum(1 for a in alerts if a.get("level") == "MEDIUM"),
-            "low": sum(1 for a in alerts if a.get("level") == "LOW")
-        }
-    }
-
-    try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        data = []
-
-    data.append(record)
-
-    with open(LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-
 # ---------------------- Session State Initialization ----------------------
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = new_transcript()
+
+if "visible_messages" not in st.session_state:
+    st.session_state.visible_messages = CHAT_VISIBLE_MESSAGES
 
 if "strict_mode" not in st.session_state:
     st.session_state.strict_mode = False
@@ -309,17 +244,33 @@ if "strict_mode" not in st.session_state:
 if "enable_logging" not in st.session_state:
     st.session_state.enable_logging = True
 
+if "stream_responses" not in st.session_state:
+    st.session_state.stream_responses = True
+
 if "sensitivity_level" not in st.session_state:
     st.session_state.sensitivity_level = "High"
 
+if "chat_context" not in st.session_state:
+    st.session_state.chat_context = ChatContext()
+
+# Identifies this browser session to the inference queue, which serves sessions in turn
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 if "show_history" not in st.session_state:
     st.session_state.show_history = False
 
-if "history_data" not in st.session_state:
-    st.session_state.history_data = []
+if "history_page" not in st.session_state:
+    st.session_state.history_page = 0
+
+if "history_page_size" not in st.session_state:
+    st.session_state.history_page_size = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
 
 # ---------------------- Sidebar Settings ----------------------
-with st.sidebar:
+# Each fragment reruns on its own: a click in the sidebar doesn't redraw the
+# chat, and sending a message doesn't touch the sidebar or history viewer.
+@st.fragment
+def render_settings():
     st.markdown("### ⚙️ Settings")
     
     strict_mode = st.checkbox(
@@ -341,11 +292,18 @@ with st.sidebar:
         help="Save conversation history to file"
     )
     
+    stream_responses = st.checkbox(
+        "⚡ Stream Responses",
+        value=st.session_state.stream_responses,
+        help="Show the reply as it is generated (sensitive data is still redacted)"
+    )
+    
     sensitivity_level = st.radio(
         "🎚️ Sensitivity Level",
         options=["Low", "Medium", "High"],
-        index=2,
-        help="Detection strictness (affects future updates)"
+        index=["Low", "Medium", "High"].index(st.session_state.sensitivity_level),
+        help="Low: Aadhaar, PAN, cards and CVVs only. Medium: also phone numbers and emails. "
+             "High: also postal codes."
     )
     
     st.markdown("---")
@@ -353,6 +311,7 @@ with st.sidebar:
     if st.button("💾 Save Settings", type="primary", use_container_width=True):
         st.session_state.strict_mode = strict_mode
         st.session_state.enable_logging = enable_logging
+        st.session_state.stream_responses = stream_responses
         st.session_state.sensitivity_level = sensitivity_level
         
         mode_text = "🔒 Strict Mode (Blocks HIGH-risk data)" if strict_mode else "🔓 Relaxed Mode (Redacts data)"
@@ -361,54 +320,76 @@ with st.sidebar:
         
         🔐 Privacy Mode: **{mode_text}**  
         📝 Logging: **{'Enabled' if enable_logging else 'Disabled'}**  
+        ⚡ Streaming: **{'Enabled' if stream_responses else 'Disabled'}**  
         🎚️ Sensitivity: **{sensitivity_level}**
         """)
     
     if st.button("🗑️ Clear Chat", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages = new_transcript()
+        st.session_state.chat_context = ChatContext()
+        # The chat pane is its own fragment, so redraw the whole app
         st.rerun()
     
+    if response_cache:
+        cache_stats = response_cache.stats()
+        st.caption(f"♻️ Response cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses")
+    
     st.markdown("---")
     st.markdown("### 📜 Conversation History")
     
     # View history button
     if st.button("📖 View Full History", use_container_width=True):
-        try:
-            with open(LOG_FILE, "r", encoding="utf-8") as f:
-                history_data = json.load(f)
-            
-            if history_data:
-                st.session_state.show_history = True
-                st.session_state.history_data = history_data
-            else:
-                st.info("No conversation history found.")
-        except (FileNotFoundError, json.JSONDecodeError):
+        history_writer.flush()
+
+        if history_store.count() if history_store else history_index.refresh() or list_segments(LOG_FILE):
+            st.session_state.show_history = True
+            st.session_state.history_page = 0
+            st.rerun()
+        elif history_store or os.path.exists(LOG_FILE):
+            st.info("No conversation history found.")
+        else:
             st.warning("No history file found or file is empty.")
     
-    # Download history button
-    try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            history_json = f.read()
-        
+    # Download history button; the export is built only when clicked
+    if history_store:
+        archived, has_history = [], history_store.count() > 0
+    else:
+        archived = list_segments(LOG_FILE)
+        has_history = os.path.exists(LOG_FILE) or bool(archived)
+    if has_history:
+        export_range = st.date_input(
+            "📅 Export range",
+            value=[],
+            help="Leave empty to export all retained history"
+        )
+        start, end = (list(export_range) + [None, None])[:2]
         st.download_button(
             label="⬇️ Download History JSON",
-            data=history_json,
-            file_name=f"chatbot_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-            mime="application/json",
+            data=lambda: export_history(start, end or start),
+            file_name=f"chatbot_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json.gz",
+            mime="application/gzip",
+            on_click="ignore",
             use_container_width=True
         )
-    except FileNotFoundError:
-        pass
+        if archived:
+            oldest = datetime.strptime(archived[0][0], SEGMENT_TIME_FORMAT)
+            st.caption(f"🗄️ {len(archived)} archived segment(s) since {oldest:%Y-%m-%d}, included in the download")
     
     # Clear history button
     if st.button("🗑️ Clear History", use_container_width=True):
-        if os.path.exists(LOG_FILE):
-            os.remove(LOG_FILE)
+        history_writer.flush()
+        if history_store.clear() if history_store else clear_history(LOG_FILE):
+            if st.session_state.show_history:
+                st.session_state.show_history = False
+                st.rerun()
             st.success("History cleared successfully!")
-            st.session_state.show_history = False
         else:
             st.info("No history to clear.")
 
+
+with st.sidebar:
+    render_settings()
+
 # ---------------------- Main Header ----------------------
 st.markdown("""
 <div class="header-container">
@@ -449,7 +430,92 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ---------------------- History Viewer Modal ----------------------
-if st.session_state.show_history:
+# Pagination runs in widget callbacks, which update the cursor before the
+# fragment reruns, so no explicit rerun is needed.
+def turn_history_page(step: int):
+    st.session_state.history_page += step
+
+
+def change_history_page_size():
+    st.session_state.history_page_size = st.session_state.history_page_size_choice
+    st.session_state.history_page = 0
+
+
+def reset_history_page():
+    st.session_state.history_page = 0
+
+
+def render_history_filters():
+    """Search box, severity and date filters (SQLite store only)."""
+    search_col, level_col, date_col = st.columns([3, 2, 2])
+    with search_col:
+        st.text_input("🔎 Search", key="history_query", on_change=reset_history_page,
+                      placeholder="Words in the masked prompt or answer")
+    with level_col:
+        st.multiselect("Severity", options=HISTORY_LEVELS, key="history_levels",
+                       on_change=reset_history_page, placeholder="All levels")
+    with date_col:
+        st.date_input("Dates", value=[], key="history_dates", on_change=reset_history_page)
+
+
+def render_segment_picker() -> str | None:
+    """Choose the current log or one archived segment to page through (JSONL log only)."""
+    segments = {"Current log": None}
+    for first, last, segment in reversed(list_segments(LOG_FILE)):
+        first, last = (datetime.strptime(t, SEGMENT_TIME_FORMAT) for t in (first, last))
+        segments[f"Archived {first:%Y-%m-%d %H:%M} → {last:%Y-%m-%d %H:%M}"] = segment
+    if st.session_state.get("history_segment") not in segments:
+        st.session_state.history_segment = "Current log"
+    st.selectbox("Showing", options=list(segments), key="history_segment", on_change=reset_history_page)
+    return segments[st.session_state.history_segment]
+
+
+def search_history(page_size: int) -> tuple[int, list[tuple[int, dict]], bool]:
+    """Run the viewer's filters against the store for the current page.
+
+    Returns the match count (capped, see ``HistoryStore.search``), the page
+    and whether an older page exists. One row past the page is fetched to
+    tell, since a capped count cannot.
+    """
+    start, end = (list(st.session_state.get("history_dates") or []) + [None, None])[:2]
+    total, records = history_store.search(
+        st.session_state.get("history_query", ""),
+        st.session_state.get("history_levels") or None,  # nothing selected means every level
+        start,
+        end or start,
+        limit=page_size + 1,
+        offset=st.session_state.history_page * page_size,
+    )
+    return total, records[:page_size], len(records) > page_size
+
+
+def render_record(number: int, record: dict):
+    timestamp = record.get('timestamp', 'Unknown')
+    prompt = record.get('prompt', '')
+    answer = record.get('answer', '')
+    alerts = record.get('alerts', [])
+    severity_summary = record.get('severity_summary', {})
+    
+    with st.expander(f"💬 Conversation #{number} - {timestamp}", expanded=False):
+        st.markdown(f"**🕒 Time:** {timestamp}")
+        st.markdown(f"**👤 User:** {prompt}")
+        st.markdown(f"**🤖 Assistant:** {answer}")
+        
+        if alerts:
+            st.markdown("**⚠️ Alerts:**")
+            for alert in alerts:
+                color = "#dc2626" if alert.get('level') == 'HIGH' else "#f59e0b"
+                st.markdown(f"<span style='color: {color};'>{alert.get('severity', '')} {alert.get('message', '')}</span>", unsafe_allow_html=True)
+        
+        st.markdown(f"""
+        <div style='background: #f8fafc; padding: 8px; border-radius: 4px; margin-top: 8px; font-size: 12px;'>
+            📊 Summary: 🔴 {severity_summary.get('high', 0)} HIGH | 🟡 {severity_summary.get('medium', 0)} MEDIUM | 🟢 {severity_summary.get('low', 0)} LOW
+        </div>
+        """, unsafe_allow_html=True)
+
+
+@st.fragment
+def render_history_viewer():
     st.markdown("---")
     st.markdown("### 📜 Conversation History Viewer")
     
@@ -459,127 +525,201 @@ if st.session_state.show_history:
             st.session_state.show_history = False
             st.rerun()
     
-    if st.session_state.history_data:
-        # Statistics
-        total_convos = len(st.session_state.history_data)
-        total_high = sum(record.get('severity_summary', {}).get('high', 0) for record in st.session_state.history_data)
-        total_medium = sum(record.get('severity_summary', {}).get('medium', 0) for record in st.session_state.history_data)
+    if history_store:
+        total_convos = history_store.count()
+    else:
+        total_convos = history_index.refresh() + sum(
+            stats["conversations"] for stats in read_segment_stats(LOG_FILE).values())
+    if total_convos:
+        # Statistics over all retained history, kept up to date by the writer
+        stats = history_store.stats() if history_store else read_total_stats(LOG_FILE)
+        total_high = stats["alerts"]["high"]
+        total_medium = stats["alerts"]["medium"]
         
         st.markdown(f"""
         <div style='background: linear-gradient(135deg, #dbeafe 0%, #bfdbfe 100%); padding: 16px; border-radius: 8px; margin-bottom: 20px;'>
             <strong>📊 Statistics</strong><br/>
-            <span style='color: #1e40af;'>Total Conversations: {total_convos}</span> | 
+            <span style='color: #1e40af;'>Total Conversations: {stats['conversations']}</span> | 
             <span style='color: #dc2626;'>🔴 HIGH Alerts: {total_high}</span> | 
             <span style='color: #f59e0b;'>🟡 MEDIUM Alerts: {total_medium}</span>
         </div>
         """, unsafe_allow_html=True)
         
-        # Display each conversation
-        for idx, record in enumerate(reversed(st.session_state.history_data), 1):
-            timestamp = record.get('timestamp', 'Unknown')
-            prompt = record.get('prompt', '')
-            answer = record.get('answer', '')
-            alerts = record.get('alerts', [])
-            severity_summary = record.get('severity_summary', {})
-            
-            with st.expander(f"💬 Conversation #{len(st.session_state.history_data) - idx + 1} - {timestamp}", expanded=False):
-                st.markdown(f"**🕒 Time:** {timestamp}")
-                st.markdown(f"**👤 User:** {prompt}")
-                st.markdown(f"**🤖 Assistant:** {answer}")
-                
-                if alerts:
-                    st.markdown("**⚠️ Alerts:**")
-                    for alert in alerts:
-                        color = "#dc2626" if alert.get('level') == 'HIGH' else "#f59e0b"
-                        st.markdown(f"<span style='color: {color};'>{alert.get('severity', '')} {alert.get('message', '')}</span>", unsafe_allow_html=True)
-                
-                st.markdown(f"""
-                <div style='background: #f8fafc; padding: 8px; border-radius: 4px; margin-top: 8px; font-size: 12px;'>
-                    📊 Summary: 🔴 {severity_summary.get('high', 0)} HIGH | 🟡 {severity_summary.get('medium', 0)} MEDIUM | 🟢 {severity_summary.get('low', 0)} LOW
-                </div>
-                """, unsafe_allow_html=True)
+        # Pagination (newest first); session state only holds the cursor
+        page_size = st.session_state.history_page_size
+        segment = None
+        counted = True  # total_convos is exact, not a lower bound
+        if history_store:
+            from history_db import SEARCH_COUNT_LIMIT
+            render_history_filters()
+            search_start = time.perf_counter()
+            total_convos, records, has_older = search_history(page_size)
+            counted = total_convos <= SEARCH_COUNT_LIMIT
+            if not counted and not records and st.session_state.history_page:
+                # Past the end of an uncounted result; start over from the newest
+                st.session_state.history_page = 0
+                total_convos, records, has_older = search_history(page_size)
+            matching = f"{total_convos:,}" if counted else f"{SEARCH_COUNT_LIMIT:,}+"
+            st.caption(f"🔎 {matching} matching conversation(s) in "
+                       f"{(time.perf_counter() - search_start) * 1000:.0f} ms")
+            if not total_convos:
+                st.info("No conversations match these filters.")
+                st.markdown("---")
+                return
+        else:
+            segment = render_segment_picker()
+            if segment is None:
+                total_convos = history_index.refresh()
+            else:
+                total_convos = read_segment_stats(LOG_FILE).get(os.path.basename(segment), {}).get("conversations", 0)
+            if not total_convos:
+                st.info("No conversations here yet; older ones are in the archived segments.")
+                st.markdown("---")
+                return
+        total_pages = (total_convos + page_size - 1) // page_size
+        if counted and st.session_state.history_page > total_pages - 1:
+            st.session_state.history_page = total_pages - 1
+            if history_store:
+                total_convos, records, has_older = search_history(page_size)
+        if not history_store:
+            has_older = st.session_state.history_page < total_pages - 1
+        
+        nav_prev, nav_info, nav_size, nav_next = st.columns([1, 3, 2, 1])
+        with nav_prev:
+            st.button("⬅️ Newer", disabled=st.session_state.history_page == 0,
+                      on_click=turn_history_page, args=(-1,))
+        with nav_info:
+            of_pages = f" of **{total_pages}**" if counted else ""
+            st.markdown(f"Page **{st.session_state.history_page + 1}**{of_pages}")
+        with nav_size:
+            st.selectbox(
+                "Per page",
+                options=HISTORY_PAGE_SIZES,
+                index=HISTORY_PAGE_SIZES.index(page_size) if page_size in HISTORY_PAGE_SIZES else 0,
+                key="history_page_size_choice",
+                on_change=change_history_page_size,
+                label_visibility="collapsed"
+            )
+        with nav_next:
+            st.button("Older ➡️", disabled=not has_older,
+                      on_click=turn_history_page, args=(1,))
+        
+        # Display only the visible page
+        if segment is not None:
+            records = read_segment_page(segment, st.session_state.history_page, page_size, total_convos)
+        elif not history_store:
+            records = history_index.read_page(st.session_state.history_page, page_size)
+        for number, record in records:
+            render_record(number, record)
+    else:
+        st.info("No conversation history found.")
     
     st.markdown("---")
 
-# ---------------------- Chat Display ----------------------
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"], unsafe_allow_html=True)
-
-# ---------------------- Chat Input and Processing ----------------------
-if prompt := st.chat_input("💬 Type your message here... (All sensitive data is automatically protected)"):
-    # Display user message
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    with st.chat_message("user"):
-        st.markdown(prompt)
+
+if st.session_state.show_history:
+    render_history_viewer()
+
+# ---------------------- Chat Pane ----------------------
+def show_earlier_messages():
+    st.session_state.visible_messages += CHAT_VISIBLE_MESSAGES
+
+
+def show_message(message: ChatMessage, placeholder=None):
+    """Draw one transcript message; assistant badges are rendered here, not stored."""
+    if message.role == "user":
+        with st.chat_message("user"):
+            st.markdown(message.text)
+        return
+    if placeholder is None:
+        placeholder = st.chat_message("assistant").empty()
+    placeholder.markdown(render_html(message), unsafe_allow_html=message.kind in ("reply", "blocked"))
+
+
+@st.fragment
+def render_chat():
+    # Only the newest messages are drawn, so a rerun costs the same however long the chat is
+    transcript = st.session_state.messages
+    hidden = len(transcript) - st.session_state.visible_messages
+    if hidden > 0:
+        st.button(f"⬆️ Show {min(hidden, CHAT_VISIBLE_MESSAGES)} earlier message(s)",
+                  on_click=show_earlier_messages)
+    for message in visible(transcript, st.session_state.visible_messages):
+        show_message(message)
+
+    # Deferred so the page above renders before the inference stack loads
+    from pipeline import MAX_PROMPT_CHARS
+
+    # Keep the input pinned to the bottom of the page from inside the fragment
+    with st.bottom:
+        prompt = st.chat_input("💬 Type your message here... (All sensitive data is automatically protected)",
+                               max_chars=MAX_PROMPT_CHARS)
+
+    if prompt:
+        from inference import Busy
+        from metrics import get_metrics
+        from pipeline import complete, fold_context, log_interaction, screen_prompt
+
+        metrics = get_metrics()
+        turn_start = time.perf_counter()
+        st.session_state.visible_messages = CHAT_VISIBLE_MESSAGES
+        strict_mode = st.session_state.strict_mode
+        sensitivity = st.session_state.sensitivity_level
+        message_placeholder = None
     
-    # Process message
-    with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        
         try:
-            # Check for sensitive data
-            user_message, alerts = redact_sensitive_data(prompt)
-            
+            # Check for sensitive data; the transcript only ever holds the redacted prompt
+            screening = screen_prompt(prompt, strict_mode, sensitivity)
+            alerts = screening.alerts
+            user_message = ChatMessage("user", screening.prompt, "prompt",
+                                       tuple(rule_for_alert(alert) for alert in alerts), strict_mode, sensitivity)
+            transcript.append(user_message)
+            show_message(user_message)
+            message_placeholder = st.chat_message("assistant").empty()
+        
             # In strict mode, block messages with HIGH severity alerts
-            if st.session_state.strict_mode and any(alert['level'] == 'HIGH' for alert in alerts):
-                blocked_message = """
-                <div style='background: linear-gradient(135deg, #fee2e2 0%, #fecaca 100%); padding: 16px; border-radius: 8px; border-left: 4px solid #ef4444;'>
-                    <strong style='color: #dc2626;'>🚫 Message Blocked - Strict Privacy Mode</strong><br/>
-                    <p style='color: #991b1b; margin-top: 8px;'>Your message contains HIGH-risk sensitive data and has been blocked for your protection.</p>
-                    <p style='color: #7f1d1d; margin-top: 8px; font-size: 14px;'><strong>Detected:</strong></p>
-                """
-                for alert in alerts:
-                    if alert['level'] == 'HIGH':
-                        blocked_message += f"<span style='color: #dc2626;'>{alert['severity']} {alert['message']}</span><br/>"
-                blocked_message += "<p style='color: #7f1d1d; margin-top: 8px; font-size: 13px;'><em>💡 Tip: Disable strict mode in settings to allow redacted messages.</em></p>"
-                blocked_message += "</div>"
-                
-                message_placeholder.markdown(blocked_message, unsafe_allow_html=True)
-                st.session_state.messages.append({"role": "assistant", "content": blocked_message})
+            if screening.blocked:
+                reply = ChatMessage("assistant", "", "blocked", user_message.alerts, strict_mode, sensitivity)
             else:
-                # Proceed with normal chat
-                messages = [{"role": "user", "content": user_message}]
-                
-                response = client.chat_completion(
-                    messages=messages,
-                    model="meta-llama/Llama-3.2-3B-Instruct",
-                    max_tokens=256,
-                    temperature=0.7
-                )
-                
-                reply = response.choices[0].message.content
-                safe_reply, reply_alerts = redact_sensitive_data(reply)
+                # Proceed with normal chat: earlier turns as redacted text, within the token budget
+                chat_context = st.session_state.chat_context
+                messages = chat_context.messages(screening.prompt)
+            
+                # Streaming renders redacted partial output as tokens arrive
+                on_text = None
+                if st.session_state.stream_responses:
+                    on_text = lambda text: message_placeholder.markdown(text + "▌")
+                completion = complete(messages, load_backend(), on_text=on_text, sensitivity=sensitivity,
+                                      session=st.session_state.session_id)
+                safe_reply, reply_alerts = completion.safe_reply, completion.alerts
                 all_alerts = alerts + reply_alerts
+                chat_context.add(screening.prompt, safe_reply)
+                fold_context(chat_context, load_backend(), sensitivity)
 
                 # Log interaction only if logging is enabled
                 if st.session_state.enable_logging:
-                    masked_user = mask_sensitive_data(prompt)
-                    masked_reply = mask_sensitive_data(reply)
-                    log_interaction(masked_user, masked_reply, all_alerts)
-                
-                # Format alerts with severity
-                if all_alerts:
-                    alert_badge = "\n\n<div style='background: linear-gradient(135deg, #fee2e2 0%, #fecaca 100%); padding: 12px 16px; border-radius: 8px; border-left: 4px solid #ef4444; margin-top: 12px;'>"
-                    alert_badge += "<strong>🔒 Privacy Alerts Detected:</strong><br/>"
-                    for alert in all_alerts:
-                        color = "#dc2626" if alert['level'] == "HIGH" else "#f59e0b"
-                        alert_badge += f"<span style='color: {color}; font-weight: 600;'>{alert['severity']} {alert['message']}</span><br/>"
-                    alert_badge += f"<p style='color: #64748b; font-size: 12px; margin-top: 8px;'>Mode: {'🔒 Strict (Redacted)' if not st.session_state.strict_mode else '🔒 Strict'} | Sensitivity: {st.session_state.sensitivity_level}</p>"
-                    alert_badge += "</div>"
-                    full_reply = safe_reply + alert_badge
-                else:
-                    # GREEN badge for safe queries
-                    full_reply = safe_reply
-                    full_reply += "\n\n<div style='background: linear-gradient(135deg, #d1fae5 0%, #a7f3d0 100%); padding: 12px 16px; border-radius: 8px; border-left: 4px solid #10b981; margin-top: 12px;'>"
-                    full_reply += "<strong style='color: #047857;'>🟢 No Sensitive Data Detected - Message is Safe</strong>"
-                    full_reply += f"<p style='color: #065f46; font-size: 12px; margin-top: 4px;'>Mode: {'🔓 Relaxed' if not st.session_state.strict_mode else '🔒 Strict'} | Sensitivity: {st.session_state.sensitivity_level}</p>"
-                    full_reply += "</div>"
-
-                message_placeholder.markdown(full_reply, unsafe_allow_html=True)
-                st.session_state.messages.append({"role": "assistant", "content": full_reply})
+                    log_interaction(screening.detection, completion.detection, all_alerts)
+            
+                reply = ChatMessage("assistant", safe_reply, "reply",
+                                    tuple(rule_for_alert(alert) for alert in all_alerts), strict_mode, sensitivity)
+
+            with metrics.timer("render"):
+                show_message(reply, message_placeholder)
+            transcript.append(reply)
+            if not screening.blocked:
+                metrics.observe("turn", time.perf_counter() - turn_start)
+
+        except Busy as e:
+            # Too many turns already waiting: say so now rather than spin
+            error = ChatMessage("assistant", f"⏳ The assistant is busy right now. Please retry in {e.retry_after} s.",
+                                "error")
+            show_message(error, message_placeholder)
+            transcript.append(error)
 
         except Exception as e:
-            error_message = f"⚠️ Error: {str(e)}"
-            message_placeholder.markdown(error_message)
-            st.session_state.messages.append({"role": "assistant", "content": error_message})
+            error = ChatMessage("assistant", f"⚠️ Error: {str(e)}", "error")
+            show_message(error, message_placeholder)
+            transcript.append(error)
+
+
+render_chat()
@@ -0,0 +1,220 @@
+"""In-process latency summaries and counters for the chat pipeline.
+
+Each stage of a chat turn is timed into a sliding-window summary (p50, p95,
+p99 over the most recent samples, plus an all-time count and sum). Recording
+is an append under a lock, cheap enough to leave on in production; quantiles
+are only computed when the metrics are read.
+
+Exposed in Prometheus text format (``render_prometheus``, served at
+``/metrics`` by the API) and written to METRICS_FILE every METRICS_INTERVAL
+seconds, e.g. for node_exporter's textfile collector.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PREFIX = "chatbot"
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger(__name__)
+
+
+def _quantile(ordered: list[float], q: float) -> float:
+    """Nearest-rank quantile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Summary:
+    """Latency samples for one stage: a recent window plus running totals."""
+
+    def __init__(self, window: int = 1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+
+class Metrics:
+    """Registry of stage summaries and labelled counters."""
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._summaries = {}  # stage -> Summary
+        self._counters = {}   # (name, labels) -> value
+        self._help = {}       # counter name -> help text
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """Record one duration for `stage`."""
+        with self._lock:
+            summary = self._summaries.get(stage)
+            if summary is None:
+                summary = self._summaries[stage] = Summary(self.window)
+            summary.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Time the body of a ``with`` block into `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name: str, amount: float = 1, help: str = "", **labels):
+        """Add `amount` to the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if help:
+                self._help.setdefault(name, help)
+
+    def add_collector(self, collect):
+        """Read counters kept elsewhere on every snapshot and rendering.
+
+        `collect()` returns ``(name, labels, value, help)`` tuples, e.g. the
+        per-rule counters the redaction engine keeps itself.
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def reset(self):
+        """Drop every sample and counter, e.g. between load-test runs."""
+        with self._lock:
+            self._summaries.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> dict:
+        """Return ``{"stages": {stage: {count, sum, p50, p95, p99}}, "counters": {...}}``."""
+        stages, counters, _ = self._collect()
+        result = {"stages": {}, "counters": {}}
+        for stage, (ordered, count, total) in stages:
+            entry = {"count": count, "sum": total}
+            for q in QUANTILES:
+                entry[f"p{int(q * 100)}"] = _quantile(ordered, q)
+            result["stages"][stage] = entry
+        for (name, labels), value in counters:
+            result["counters"][name + _labels(labels)] = value
+        return result
+
+    def render_prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        stages, counters, help_text = self._collect()
+
+        name = f"{PREFIX}_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of each chat pipeline stage (quantiles over the recent window).",
+            f"# TYPE {name} summary",
+        ]
+        for stage, (ordered, count, total) in stages:
+            for q in QUANTILES:
+                lines.append(f"{name}{_labels((('stage', stage), ('quantile', q)))} {_quantile(ordered, q)!r}")
+            lines.append(f"{name}_sum{_labels((('stage', stage),))} {total!r}")
+            lines.append(f"{name}_count{_labels((('stage', stage),))} {count}")
+
+        by_name = {}
+        for (counter, labels), value in counters:
+            by_name.setdefault(counter, []).append((labels, value))
+        for counter, series in by_name.items():
+            full = f"{PREFIX}_{counter}_total"
+            if counter in help_text:
+                lines.append(f"# HELP {full} {help_text[counter]}")
+            lines.append(f"# TYPE {full} counter")
+            for labels, value in series:
+                lines.append(f"{full}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _collect(self):
+        """Copy the state under the lock; sorting happens outside it."""
+        with self._lock:
+            stages = [
+                (stage, list(summary.samples), summary.count, summary.total)
+                for stage, summary in self._summaries.items()
+            ]
+            counters = list(self._counters.items())
+            help_text = dict(self._help)
+            collectors = list(self._collectors)
+        for collect in collectors:
+            for name, labels, value, help in collect():
+                counters.append(((name, tuple(sorted(labels.items()))), value))
+                if help:
+                    help_text.setdefault(name, help)
+        stages = sorted((stage, (sorted(samples), count, total)) for stage, samples, count, total in stages)
+        return stages, sorted(counters), help_text
+
+    def write(self, path: str):
+        """Atomically write the Prometheus rendering to `path`."""
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+
+class MetricsFileWriter:
+    """Background thread that rewrites the metrics file every `interval` seconds."""
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 15.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the thread after one final write."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            stopped = self._stop.wait(self.interval)
+            try:
+                self.metrics.write(self.path)
+            except OSError:
+                logger.exception("Failed to write metrics to %s", self.path)
+            if stopped:
+                return
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """Return the process-wide registry, starting the file writer on first use.
+
+    Configured with METRICS_WINDOW (samples kept per stage), METRICS_FILE
+    (empty to disable the file) and METRICS_INTERVAL.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(window=int(os.getenv("METRICS_WINDOW", "1024")))
+            path = os.getenv("METRICS_FILE", "chatbot_metrics.prom")
+            if path:
+                writer = MetricsFileWriter(_metrics, path, float(os.getenv("METRICS_INTERVAL", "15")))
+                atexit.register(writer.close)
+        return _metrics
@@ -0,0 +1,301 @@
+"""Guarded chat pipeline shared by the Streamlit UI and the HTTP API.
+
+redact -> strict-mode check -> (cached, coalesced) inference -> redact reply -> log
+"""
+import asyncio
+import os
+import queue
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+from context import SUMMARY_MAX_TOKENS, ChatContext, Turn, summary_messages
+from history_log import get_writer
+from inference import (Busy, InferenceBackend, InferenceError, get_backend, get_router, run_sync,
+                       submit)
+from metrics import get_metrics
+from redaction import (DEFAULT_SENSITIVITY, Detection, StreamingRedactor, detect, get_rules,
+                       rule_for_alert, rule_stats, severity_summary)
+from response_cache import get_cache, make_key
+
+MAX_TOKENS = 256
+TEMPERATURE = 0.7
+
+# Summaries should restate the conversation, not get creative with it
+SUMMARY_TEMPERATURE = 0.2
+
+# Longest prompt accepted for a chat turn. Redaction copes with any length,
+# but a pasted document this size is not a chat message and would only
+# burn the model's context.
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "32000"))
+
+_DONE = object()
+
+# Completions in flight, by (event loop, cache key); identical requests await the first
+_inflight: dict[tuple, asyncio.Future] = {}
+
+
+@dataclass
+class Screening:
+    detection: Detection        # raw prompt and the sensitive spans in it
+    prompt: str                 # redacted prompt, as sent to the model
+    alerts: list[dict]          # alerts raised by the prompt
+    blocked: bool = False       # strict mode refused the prompt
+
+
+@dataclass
+class Completion:
+    detection: Detection        # raw model output and the sensitive spans in it
+    safe_reply: str             # reply with sensitive data redacted
+    alerts: list[dict]          # alerts raised by the reply
+    cached: bool = False
+    coalesced: bool = False     # shared the upstream call of an identical request
+
+
+@dataclass
+class ChatResult:
+    prompt: str                 # redacted prompt as sent to the model
+    alerts: list[dict]          # prompt alerts followed by reply alerts
+    blocked: bool = False       # strict mode refused the prompt
+    reply: str | None = None    # redacted reply, None when blocked
+    cached: bool = False
+
+
+class PromptTooLarge(ValueError):
+    """Raised by ``screen_prompt`` for prompts over MAX_PROMPT_CHARS."""
+
+# ---------------------- Metrics ----------------------
+def count_alerts(alerts: list[dict], source: str):
+    """Count alerts per rule; `source` is "prompt" or "reply"."""
+    metrics = get_metrics()
+    for alert in alerts:
+        metrics.inc("alerts", rule=rule_for_alert(alert), level=alert["level"], source=source,
+                    help="Sensitive data detections by rule.")
+
+
+def rule_counters():
+    """The redaction engine's own per-rule counters, as metric series."""
+    for row in rule_stats.snapshot(get_rules().names):
+        rule = {"rule": row["rule"]}
+        yield "rule_matches", rule, row["matches"], "Matches kept per redaction rule."
+        yield "rule_rejections", rule, row["rejected"], "Matches a redaction rule's validator turned down."
+        yield ("rule_profile_seconds", rule, row["profiled_seconds"],
+               "Time each rule took on its own, over a sample of scans.")
+        yield "rule_profile_chars", rule, row["profiled_chars"], "Characters in the sampled scans."
+    yield ("redaction_fallbacks", {}, rule_stats.fallbacks,
+           "Scans with a precedence conflict, decided rule by rule.")
+
+
+get_metrics().add_collector(rule_counters)
+
+# ---------------------- Screening ----------------------
+def screen_prompt(prompt: str, strict_mode: bool, sensitivity: str = DEFAULT_SENSITIVITY) -> Screening:
+    """Redact a prompt and decide whether strict mode blocks it.
+
+    Raises PromptTooLarge for prompts over MAX_PROMPT_CHARS.
+    """
+    metrics = get_metrics()
+    if len(prompt) > MAX_PROMPT_CHARS:
+        metrics.inc("rejected_prompts", help="Prompts refused for exceeding MAX_PROMPT_CHARS.")
+        raise PromptTooLarge(
+            f"Prompt is {len(prompt):,} characters; the limit is {MAX_PROMPT_CHARS:,}."
+        )
+    with metrics.timer("redact_prompt"):
+        detection = detect(prompt, sensitivity)
+        user_message, alerts = detection.redacted(), detection.alerts()
+    count_alerts(alerts, "prompt")
+    blocked = strict_mode and any(alert["level"] == "HIGH" for alert in alerts)
+    if blocked:
+        metrics.inc("blocked_prompts", help="Prompts refused by strict mode.")
+    return Screening(detection, user_message, alerts, blocked)
+
+# ---------------------- Inference ----------------------
+async def acomplete(messages: list[dict], backend: InferenceBackend | None = None,
+                    on_text: Callable[[str], None] | None = None,
+                    sensitivity: str = DEFAULT_SENSITIVITY, session: str | None = None) -> Completion:
+    """Run (or reuse) a chat completion for already-redacted `messages`.
+
+    With `on_text`, the reply is streamed and `on_text` is called with the
+    redacted text received so far each time it grows. The reply is
+    redacted at `sensitivity`, which is also part of the cache key.
+
+    A request identical to one already in flight waits for that one
+    instead of calling upstream again; it gets the whole reply at once.
+    `session` is passed to the backend's admission queue, which raises
+    ``Busy`` when full.
+    """
+    metrics = get_metrics()
+    cache = get_cache()
+    with metrics.timer("cache_lookup"):
+        cache_key = make_key(messages, get_router().key, MAX_TOKENS, TEMPERATURE, sensitivity,
+                             get_rules().version)
+        cached = cache.get(cache_key) if cache else None
+    if cached is not None:
+        # Cache entries are stored already redacted; no network call. Below
+        # High the reply still holds matches the level leaves in clear, so it
+        # is scanned again for the spans the log masks.
+        detection = detect(cached["reply"], sensitivity)
+        return Completion(detection, cached["reply"], cached["alerts"], cached=True)
+
+    loop = asyncio.get_running_loop()
+    inflight_key = (loop, cache_key)
+    leader = _inflight.get(inflight_key)
+    if leader is not None:
+        metrics.inc("coalesced_requests", help="Completions served by an identical request in flight.")
+        completion = await asyncio.shield(leader)
+        if on_text is not None:
+            on_text(completion.safe_reply)
+        return Completion(completion.detection, completion.safe_reply, completion.alerts, coalesced=True)
+
+    _inflight[inflight_key] = future = loop.create_future()
+    try:
+        completion = await _acomplete(messages, backend, on_text, sensitivity, session)
+    except BaseException as exc:
+        if isinstance(exc, Busy):
+            metrics.inc("busy_rejections", help="Completions turned away by a full admission queue.")
+        elif not isinstance(exc, Exception):
+            exc = InferenceError("Coalesced request was cancelled")
+        future.set_exception(exc)
+        future.exception()      # followers re-raise it; none may be waiting
+        raise
+    else:
+        future.set_result(completion)
+    finally:
+        del _inflight[inflight_key]
+
+    if cache:
+        cache.put(cache_key, {"reply": completion.safe_reply, "alerts": completion.alerts})
+    return completion
+
+
+async def _acomplete(messages, backend, on_text, sensitivity, session) -> Completion:
+    metrics = get_metrics()
+    backend = backend or get_backend()
+    start = time.perf_counter()
+    if on_text is not None:
+        # The redactor holds back any suffix that could still become sensitive data
+        redactor = StreamingRedactor(sensitivity)
+        reply = ""
+        safe_reply = ""
+        redact_time = 0.0
+        first = True
+        async for delta in get_router().stream(backend, messages, MAX_TOKENS, TEMPERATURE, session):
+            if first:
+                metrics.observe("first_token", time.perf_counter() - start)
+                first = False
+            reply += delta
+            fed = time.perf_counter()
+            released = redactor.feed(delta)
+            redact_time += time.perf_counter() - fed
+            if released:
+                safe_reply += released
+                on_text(safe_reply)
+        metrics.observe("inference", time.perf_counter() - start)
+        fed = time.perf_counter()
+        safe_reply += redactor.finish()
+        reply_alerts = redactor.alerts
+        detection = Detection(reply, tuple(redactor.spans), redactor.rules, tuple(redactor.unredacted))
+        metrics.observe("redact_reply", redact_time + time.perf_counter() - fed)
+    else:
+        reply = await get_router().chat(backend, messages, MAX_TOKENS, TEMPERATURE, session)
+        metrics.observe("inference", time.perf_counter() - start)
+        with metrics.timer("redact_reply"):
+            detection = detect(reply, sensitivity)
+            safe_reply, reply_alerts = detection.redacted(), detection.alerts()
+    count_alerts(reply_alerts, "reply")
+    return Completion(detection, safe_reply, reply_alerts)
+
+
+def complete(messages: list[dict], backend: InferenceBackend | None = None,
+             on_text: Callable[[str], None] | None = None,
+             sensitivity: str = DEFAULT_SENSITIVITY, session: str | None = None) -> Completion:
+    """Blocking ``acomplete`` for synchronous callers.
+
+    `on_text` is called on the calling thread, not the inference loop, so it
+    may touch thread-bound state such as Streamlit placeholders.
+    """
+    if on_text is None:
+        return run_sync(acomplete(messages, backend, sensitivity=sensitivity, session=session))
+    updates = queue.SimpleQueue()
+    future = submit(acomplete(messages, backend, on_text=updates.put, sensitivity=sensitivity,
+                              session=session))
+    future.add_done_callback(lambda _: updates.put(_DONE))
+    while (text := updates.get()) is not _DONE:
+        on_text(text)
+    return future.result()
+
+# ---------------------- Context ----------------------
+async def asummarize(summary: str, turns: list[Turn], backend: InferenceBackend | None = None,
+                     sensitivity: str = DEFAULT_SENSITIVITY) -> str:
+    """Fold `turns` into the rolling `summary` with the model.
+
+    The new summary is redacted like any reply before it can reach a
+    later request.
+    """
+    backend = backend or get_backend()
+    with get_metrics().timer("summarize"):
+        text = await get_router().chat(backend, summary_messages(summary, turns), SUMMARY_MAX_TOKENS,
+                                       SUMMARY_TEMPERATURE)
+    return detect(text.strip(), sensitivity).redacted()
+
+
+def fold_context(context: ChatContext, backend: InferenceBackend | None = None,
+                 sensitivity: str = DEFAULT_SENSITIVITY):
+    """Let `context` fold its oldest turns into the summary on the background inference loop."""
+    context.fold(lambda summary, turns: submit(asummarize(summary, turns, backend, sensitivity)))
+
+# ---------------------- Logging ----------------------
+def log_interaction(prompt: Detection, answer: Detection, alerts: list[dict]):
+    """Log interactions with masked data and severity information.
+
+    Masking is rendered from the spans found when the prompt and reply were
+    redacted; neither text is scanned again.
+    """
+    metrics = get_metrics()
+    with metrics.timer("mask"):
+        masked_prompt = prompt.masked()
+        masked_answer = answer.masked()
+
+    record = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "prompt": masked_prompt,
+        "answer": masked_answer,
+        "alerts": alerts,
+        "severity_summary": severity_summary(alerts)
+    }
+
+    with metrics.timer("log_submit"):
+        get_writer().submit(record)
+
+# ---------------------- Full Turn ----------------------
+async def arun_chat(prompt: str, strict_mode: bool = False, enable_logging: bool = True,
+                    backend: InferenceBackend | None = None,
+                    sensitivity: str = DEFAULT_SENSITIVITY, session: str | None = None) -> ChatResult:
+    """Run one guarded chat turn end to end."""
+    start = time.perf_counter()
+    screening = screen_prompt(prompt, strict_mode, sensitivity)
+    if screening.blocked:
+        return ChatResult(prompt=screening.prompt, alerts=screening.alerts, blocked=True)
+
+    completion = await acomplete([{"role": "user", "content": screening.prompt}], backend,
+                                 sensitivity=sensitivity, session=session)
+    all_alerts = screening.alerts + completion.alerts
+
+    if enable_logging:
+        log_interaction(screening.detection, completion.detection, all_alerts)
+    get_metrics().observe("turn", time.perf_counter() - start)
+
+    return ChatResult(
+        prompt=screening.prompt,
+        alerts=all_alerts,
+        reply=completion.safe_reply,
+        cached=completion.cached,
+    )
+
+
+def run_chat(prompt: str, strict_mode: bool = False, enable_logging: bool = True,
+             backend: InferenceBackend | None = None,
+             sensitivity: str = DEFAULT_SENSITIVITY, session: str | None = None) -> ChatResult:
+    """Blocking ``arun_chat`` for synchronous callers."""
+    return run_sync(arun_chat(prompt, strict_mode, enable_logging, backend, sensitivity, session))
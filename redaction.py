@@ -0,0 +1,1184 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter
+from dataclasses import dataclass, field
+from enum import Enum
+from functools import lru_cache
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# ---------------------- Severity Levels ----------------------
+class SeverityLevel(Enum):
+    LOW = "🟢"
+    MEDIUM = "🟡"
+    HIGH = "🔴"
+
+# ---------------------- Detection Rules ----------------------
+# Rules are declared in RULES_FILE as {"rules": [...]}, one object per rule.
+# Order is precedence: a rule earlier in the list is applied before the ones
+# after it (e.g. a 12-digit Aadhaar wins over the phone and PIN code rules).
+#
+#   name         identifier used in spans, metrics and the API
+#   pattern      regular expression, (?:...) groups only
+#   token        replacement in redacted text, e.g. [REDACTED_PAN]
+#   severity     HIGH, MEDIUM or LOW
+#   message      alert message; stored alerts are mapped back to rules by it
+#   mask         partial masking for logs, one of MASKS
+#   validator    optional checksum a match must pass, one of VALIDATORS.
+#                A match that fails it is left in the clear (no token, no
+#                alert), so the shipped rules use none: a mistyped or
+#                made-up number is still redacted. Add one only where false
+#                positives cost more than a missed identifier.
+#   sensitivity  lowest level that runs the rule: Low, Medium or High
+#   requires     patterns that must all occur somewhere in a text for the
+#                rule to match in it; cheap scans that rule it out early
+#   max_chars    longest possible match
+#   whitespace   true if a match can contain whitespace
+#   partial      suffix of streamed text that may still grow into a match
+#                (default: up to max_chars trailing characters); at most
+#                max_chars long, as it is what a stream holds back
+#   widen        {"chars": class, "reach": n}, for one rule at most: the
+#                pattern reads at most n `chars` before its anchor and a
+#                match is widened back over the whole run (email local parts)
+#
+# Every quantifier must be bounded, so each rule has a longest possible
+# match and does a bounded amount of work per start position; a scan is
+# linear in the text length. A replacement token must not complete a match
+# or a `requires` pattern of any rule.
+RULES_FILE = os.getenv(
+    "REDACTION_RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "redaction_rules.json")
+)
+
+# Seconds between checks of RULES_FILE for changes
+RULES_CHECK_INTERVAL = float(os.getenv("REDACTION_RULES_CHECK_INTERVAL", "2"))
+
+# Share of scans that also time each candidate rule on its own
+RULE_PROFILE_RATE = float(os.getenv("RULE_PROFILE_RATE", "0.01"))
+
+# A rule runs at its own level and every level above it
+SENSITIVITY_NAMES = ("Low", "Medium", "High")
+DEFAULT_SENSITIVITY = "High"
+
+# ---------------------- Validators ----------------------
+def luhn_valid(value: str) -> bool:
+    """Luhn (mod 10) checksum over the digits of `value`, as on payment cards."""
+    total = 0
+    for i, char in enumerate(reversed([char for char in value if char.isdecimal()])):
+        digit = int(char)
+        if i % 2:
+            digit = digit * 2 - 9 if digit > 4 else digit * 2
+        total += digit
+    return total % 10 == 0
+
+
+_VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8),
+    (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2),
+    (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0),
+)
+_VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0),
+    (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5),
+    (7, 0, 4, 6, 9, 1, 3, 2, 5, 8),
+)
+
+
+def verhoeff_valid(value: str) -> bool:
+    """Verhoeff checksum over the digits of `value`, as on Aadhaar numbers."""
+    check = 0
+    for i, char in enumerate(reversed([char for char in value if char.isdecimal()])):
+        check = _VERHOEFF_D[check][_VERHOEFF_P[i % 8][int(char)]]
+    return check == 0
+
+
+VALIDATORS = {"luhn": luhn_valid, "verhoeff": verhoeff_valid}
+
+# ---------------------- Masks ----------------------
+def _keep(head: int, tail: int):
+    """Mask all but the first `head` and last `tail` characters."""
+    def mask(value: str) -> str:
+        return value[:head] + "*" * (len(value) - head - tail) + value[len(value) - tail:]
+    return mask
+
+
+def _keep_digits(head: int, tail: int):
+    """Mask all digits but the first `head` and last `tail`; separators stay."""
+    def mask(value: str) -> str:
+        digits = [i for i, char in enumerate(value) if char.isdecimal()]
+        hidden = set(digits[head:len(digits) - tail])
+        return "".join("*" if i in hidden else char for i, char in enumerate(value))
+    return mask
+
+
+def _template(template: str):
+    """Keep the characters under a "#" in `template`, mask the rest."""
+    def mask(value: str) -> str:
+        return "".join(
+            char if template[i:i + 1] == "#" else "*" for i, char in enumerate(value)
+        )
+    return mask
+
+
+def _email(head: int):
+    """Keep the first `head` characters of the local part, and the domain."""
+    def mask(value: str) -> str:
+        local, at, domain = value.partition("@")
+        if not at:
+            return "*" * len(value)
+        return f"{local[:head]}***@{domain}"
+    return mask
+
+
+# Partial visibility for logs: enough to recognise a value, not to reuse it
+#   {"keep": [3, 3]}              9876543210 -> 987****210
+#   {"digits": [4, 4]}            1234 5678 9012 3456 -> 1234 **** **** 3456
+#   {"template": "###**####*"}    ABCDE1234F -> ABC**1234*
+#   {"email": 1}                  john@gmail.com -> j***@gmail.com
+MASKS = {"keep": _keep, "digits": _keep_digits, "template": _template, "email": _email}
+
+# ---------------------- Rule Registry ----------------------
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    pattern: str
+    token: str
+    severity: SeverityLevel
+    message: str
+    mask: Callable[[str], str]
+    validator: str | None
+    sensitivity: str
+    requires: tuple[str, ...]
+    max_chars: int
+    whitespace: bool
+    partial: str
+    widen: tuple[str, int] | None       # (character class, reach)
+
+
+_RULE_KEYS = {"name", "pattern", "token", "severity", "message", "mask", "validator", "sensitivity",
+              "requires", "max_chars", "whitespace", "partial", "widen"}
+
+
+def _compile(name: str, pattern) -> re.Pattern:
+    try:
+        return re.compile(pattern)
+    except (re.error, TypeError) as exc:
+        raise ValueError(f"rule {name!r}: invalid pattern {pattern!r}: {exc}") from None
+
+
+def _count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _mask_args_ok(kind: str, args) -> bool:
+    """Whether `args` fit the MASKS factory `kind`; checked at load, not at the first match."""
+    if kind in ("keep", "digits"):
+        return isinstance(args, list) and len(args) == 2 and all(_count(arg) for arg in args)
+    if kind == "template":
+        return isinstance(args, str)
+    return _count(args)
+
+
+def _parse_rule(entry: dict) -> Rule:
+    """Check one entry of the rules file. Raises ValueError naming the rule."""
+    if not isinstance(entry, dict):
+        raise ValueError(f"each rule must be an object, got {entry!r}")
+    name = entry.get("name")
+    if not isinstance(name, str) or not name.isidentifier():
+        raise ValueError(f"rule name must be an identifier, got {name!r}")
+    problems = []
+    missing = {"pattern", "token", "severity", "message", "max_chars"} - entry.keys()
+    if missing:
+        problems.append(f"missing {', '.join(sorted(missing))}")
+    if entry.keys() - _RULE_KEYS:
+        problems.append(f"unknown field(s) {', '.join(sorted(entry.keys() - _RULE_KEYS))}")
+    if problems:
+        raise ValueError(f"rule {name!r}: {'; '.join(problems)}")
+
+    pattern = _compile(name, entry["pattern"])
+    if pattern.groups:
+        problems.append("pattern may only use (?:...) groups")
+    elif pattern.fullmatch(""):
+        problems.append("pattern matches the empty string")
+    requires = entry.get("requires", [])
+    if not isinstance(requires, list):
+        problems.append("requires must be a list of patterns")
+        requires = []
+    for required in requires:
+        _compile(name, required)
+    max_chars = entry["max_chars"]
+    if not isinstance(max_chars, int) or isinstance(max_chars, bool) or max_chars < 1:
+        problems.append("max_chars must be a positive integer")
+        max_chars = 1
+    whitespace = entry.get("whitespace", False)
+    partial = entry.get("partial") or (
+        rf"(?s:.{{1,{max_chars}}})\Z" if whitespace else rf"\S{{1,{max_chars}}}\Z"
+    )
+    _compile(name, partial)
+    for key in ("token", "message"):
+        if not isinstance(entry[key], str) or not entry[key]:
+            problems.append(f"{key} must be a non-empty string")
+    if entry["severity"] not in SeverityLevel.__members__:
+        problems.append(f"severity must be one of {list(SeverityLevel.__members__)}")
+    sensitivity = entry.get("sensitivity", "High")
+    if sensitivity not in SENSITIVITY_NAMES:
+        problems.append(f"sensitivity must be one of {list(SENSITIVITY_NAMES)}")
+    validator = entry.get("validator")
+    if validator is not None and validator not in VALIDATORS:
+        problems.append(f"validator must be one of {list(VALIDATORS)}")
+
+    mask = None
+    spec = entry.get("mask", {"keep": [0, 0]})
+    if isinstance(spec, dict) and len(spec) == 1 and next(iter(spec)) in MASKS:
+        kind, args = next(iter(spec.items()))
+        if _mask_args_ok(kind, args):
+            mask = MASKS[kind](*args) if isinstance(args, list) else MASKS[kind](args)
+    if mask is None:
+        problems.append(
+            'mask must be one of {"keep": [head, tail]}, {"digits": [head, tail]}, '
+            '{"template": "#..."} or {"email": head}, with counts >= 0'
+        )
+
+    widen = entry.get("widen")
+    if widen is not None:
+        try:
+            widen = (widen["chars"], int(widen["reach"]))
+            re.compile(f"[{widen[0]}]")
+        except (KeyError, TypeError, ValueError, re.error):
+            problems.append('widen must be {"chars": <character class>, "reach": <int>}')
+    if problems:
+        raise ValueError(f"rule {name!r}: {'; '.join(problems)}")
+
+    return Rule(
+        name=name,
+        pattern=entry["pattern"],
+        token=entry["token"],
+        severity=SeverityLevel[entry["severity"]],
+        message=entry["message"],
+        mask=mask,
+        validator=validator,
+        sensitivity=sensitivity,
+        requires=tuple(requires),
+        max_chars=max_chars,
+        whitespace=bool(whitespace),
+        partial=partial,
+        widen=widen,
+    )
+
+
+class RuleStats:
+    """Per-rule counters, kept across reloads.
+
+    `matches` and `rejected` (matches a validator turned down) count every
+    scan. The combined matcher runs all rules at once, so time per rule is
+    sampled instead: a RULE_PROFILE_RATE share of scans also runs each
+    candidate rule on its own and records the seconds and characters.
+    """
+
+    def __init__(self):
+        self.matches = Counter()
+        self.rejected = Counter()
+        self.seconds = Counter()
+        self.chars = Counter()
+        self.fallbacks = 0          # scans decided rule by rule
+        self._lock = threading.Lock()
+
+    def record(self, spans: list, rejected: Counter, fallback: bool):
+        if not (spans or rejected or fallback):
+            return
+        with self._lock:
+            self.matches.update(span.category for span in spans)
+            self.rejected.update(rejected)
+            self.fallbacks += fallback
+
+    def profile(self, rules: "_RuleSet", text: str):
+        """Time each rule of `rules` over `text` on its own."""
+        timings = []
+        for name, pattern, _ in rules.sequential:
+            start = time.perf_counter()
+            for _ in pattern.finditer(text):
+                pass
+            timings.append((name, time.perf_counter() - start))
+        with self._lock:
+            for name, seconds in timings:
+                self.seconds[name] += seconds
+                self.chars[name] += len(text)
+
+    def merge(self, other: "RuleStats"):
+        with self._lock:
+            self.matches.update(other.matches)
+            self.rejected.update(other.rejected)
+            self.seconds.update(other.seconds)
+            self.chars.update(other.chars)
+            self.fallbacks += other.fallbacks
+
+    def snapshot(self, names: list[str]) -> list[dict]:
+        """Counters for each of `names`, with the sampled cost in microseconds per KB."""
+        with self._lock:
+            return [{
+                "rule": name,
+                "matches": self.matches[name],
+                "rejected": self.rejected[name],
+                "profiled_chars": self.chars[name],
+                "profiled_seconds": self.seconds[name],
+                "us_per_kb": self.seconds[name] * 1e6 * 1024 / self.chars[name] if self.chars[name] else None,
+            } for name in names]
+
+
+rule_stats = RuleStats()
+
+
+class RuleRegistry:
+    """One version of the rules, compiled once and shared by every scan.
+
+    Never changed after it is built: a reload swaps in a new registry, and a
+    scan or stream that started on the old one finishes on it.
+    """
+
+    def __init__(self, rules: list[Rule], version: str = "", mtime: int | None = None):
+        if not rules:
+            raise ValueError("no rules")
+        for key in ("name", "message"):
+            counts = Counter(getattr(rule, key) for rule in rules)
+            duplicates = [value for value, count in counts.items() if count > 1]
+            if duplicates:
+                raise ValueError(f"duplicate rule {key}(s): {duplicates}")
+        widening = [rule for rule in rules if rule.widen]
+        if len(widening) > 1:
+            raise ValueError(f"only one rule may widen its matches, not {[rule.name for rule in widening]}")
+
+        self.rules = list(rules)
+        self.version = version      # hash of the rules file, e.g. for cache keys
+        self.mtime = mtime
+        self.names = [rule.name for rule in rules]
+        self.rank = {name: rank for rank, name in enumerate(self.names)}
+        self.tokens = {rule.name: rule.token for rule in rules}
+        self.masks = {rule.name: rule.mask for rule in rules}
+        self.severity = {rule.name: rule.severity for rule in rules}
+        self.alerts = {
+            rule.name: {"severity": rule.severity.value, "message": rule.message, "level": rule.severity.name}
+            for rule in rules
+        }
+        self.by_message = {rule.message: rule.name for rule in rules}
+        self.levels = {
+            level: frozenset(
+                rule.name for rule in rules
+                if SENSITIVITY_NAMES.index(rule.sensitivity) <= SENSITIVITY_NAMES.index(level)
+            )
+            for level in SENSITIVITY_NAMES
+        }
+        self.every = frozenset(self.names)
+        # The levels' rule sets that come before every other rule: the others
+        # cannot change what those rules match, so one scan with every rule
+        # finds both the spans to redact and the rest to mask in logs.
+        self.ranked_first = frozenset(
+            names for names in self.levels.values() if names == frozenset(self.names[:len(names)])
+        )
+
+        # Longest match of any rule; text further than this from a position
+        # cannot change what matches there.
+        self.max_chars = max(rule.max_chars for rule in rules)
+
+        # Rules with the same prefilters are checked together, and each
+        # distinct prefilter is compiled, and scanned per text, once. A
+        # plain string needs no regex: a substring test is quicker.
+        checks = {}
+        groups = {}
+        for rule in rules:
+            for source in rule.requires:
+                if source not in checks:
+                    checks[source] = (
+                        (lambda text, source=source: source in text) if re.escape(source) == source
+                        else re.compile(source).search
+                    )
+            groups.setdefault(rule.requires, []).append(rule.name)
+        self._prefilters = [
+            ([(source, checks[source]) for source in requires], frozenset(names))
+            for requires, names in groups.items()
+        ]
+
+        self.widen = None
+        if widening:
+            rule = widening[0]
+            chars, reach = rule.widen
+            char = re.compile(f"[{chars}]")
+            self.widen = _Widen(
+                rule.name, frozenset(c for c in map(chr, range(128)) if char.match(c)),
+                char, re.compile(f"[{chars}]*"), re.compile(rule.pattern), reach,
+            )
+
+        # Each rule wrapped in a lookahead, so finditer reports overlapping matches
+        self.overlapping = [re.compile(f"(?=({rule.pattern}))") for rule in rules]
+        self.crossing = [(pattern, rule.max_chars)
+                         for pattern, rule in zip(self.overlapping, rules) if rule.whitespace]
+        # A suffix of the text seen so far that could still grow into a match
+        # once more text arrives. Leftmost search gives the earliest such start;
+        # none is longer than max_chars, so only the end of the text is searched.
+        self.partial = re.compile("|".join(f"(?:{rule.partial})" for rule in rules))
+
+        self.rule_set = lru_cache(maxsize=None)(self._rule_set)
+
+    def candidates(self, text: str) -> frozenset:
+        """Rules that could match somewhere in `text`, from a few cheap scans.
+
+        Each prefilter pattern is searched at most once and only while a rule
+        still needs it; each search stops at the first hit. A replacement
+        token never completes one, so a rule ruled out here cannot match on
+        the rule-by-rule path either.
+        """
+        seen = {}
+        names = frozenset()
+        for requires, group in self._prefilters:
+            for source, check in requires:
+                found = seen.get(source)
+                if found is None:
+                    found = seen[source] = bool(check(text))
+                if not found:
+                    break
+            else:
+                names |= group
+        return names
+
+    def level(self, sensitivity: str) -> frozenset:
+        """Names of the rules that run at `sensitivity`."""
+        try:
+            return self.levels[sensitivity]
+        except KeyError:
+            raise ValueError(
+                f"sensitivity must be one of {list(SENSITIVITY_NAMES)}, got {sensitivity!r}"
+            ) from None
+
+    def describe(self) -> list[dict]:
+        """The rules as configured, with their counters, e.g. for the API."""
+        stats = {row["rule"]: row for row in rule_stats.snapshot(self.names)}
+        return [{
+            "name": rule.name,
+            "token": rule.token,
+            "severity": rule.severity.name,
+            "sensitivity": rule.sensitivity,
+            "validator": rule.validator,
+            **{key: value for key, value in stats[rule.name].items() if key != "rule"},
+        } for rule in self.rules]
+
+    def _rule_set(self, names: frozenset) -> "_RuleSet":
+        return _RuleSet(self, names)
+
+
+@dataclass(frozen=True)
+class _Widen:
+    name: str
+    ascii: frozenset            # the ASCII characters in the class, for a quick check
+    char: re.Pattern            # one character of the class
+    run: re.Pattern             # a run of them
+    pattern: re.Pattern         # the rule's pattern
+    reach: int
+
+
+def load_rules(path: str) -> RuleRegistry:
+    """Read, check and compile a rules file. Raises OSError or ValueError."""
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        config = json.loads(raw)
+        if not isinstance(config, dict) or not isinstance(config.get("rules"), list):
+            raise ValueError('expected {"rules": [...]}')
+        rules = [_parse_rule(entry) for entry in config["rules"]]
+        return RuleRegistry(rules, hashlib.sha256(raw).hexdigest()[:16], mtime)
+    except ValueError as exc:
+        raise ValueError(f"{path}: {exc}") from None
+
+
+_rules = None
+_rules_lock = threading.Lock()
+_rules_checked = 0.0
+_rules_rejected = None      # mtime of a version of the file that failed to load
+
+
+def get_rules() -> RuleRegistry:
+    """Return the rules in force, reloading RULES_FILE when it changes.
+
+    The file is checked at most every RULES_CHECK_INTERVAL seconds. A
+    version that fails to load is logged once and the rules in force stay.
+    """
+    global _rules, _rules_checked, _rules_rejected
+    if _rules is not None and time.monotonic() - _rules_checked < RULES_CHECK_INTERVAL:
+        return _rules
+    with _rules_lock:
+        if _rules is not None and time.monotonic() - _rules_checked < RULES_CHECK_INTERVAL:
+            return _rules
+        _rules_checked = time.monotonic()
+        mtime = -1      # the file is gone, e.g. mid-deploy
+        try:
+            mtime = os.stat(RULES_FILE).st_mtime_ns
+            if _rules is None or mtime not in (_rules.mtime, _rules_rejected):
+                _rules = load_rules(RULES_FILE)
+                logger.info("Loaded %d redaction rules from %s", len(_rules.rules), RULES_FILE)
+        except (OSError, ValueError) as exc:
+            if _rules is None:
+                raise
+            if mtime != _rules_rejected:
+                logger.error("Keeping the redaction rules in force: %s", exc)
+            _rules_rejected = mtime
+        return _rules
+
+
+def reload_rules() -> RuleRegistry:
+    """Load RULES_FILE now. Raises OSError or ValueError, keeping the rules in force."""
+    global _rules, _rules_checked
+    rules = load_rules(RULES_FILE)
+    with _rules_lock:
+        _rules, _rules_checked = rules, time.monotonic()
+    logger.info("Loaded %d redaction rules from %s", len(rules.rules), RULES_FILE)
+    return rules
+
+# ---------------------- Combined Matcher ----------------------
+def _combine(rules: list[Rule]) -> re.Pattern:
+    """Build one alternation of named groups, in precedence order.
+
+    Consecutive rules that start with a word boundary share a single leading
+    ``\\b`` so the engine gives up on mid-word positions after one check
+    instead of one per rule.
+    """
+    branches = []  # [shares_boundary, [alternatives]]
+    for rule in rules:
+        pattern = rule.pattern
+        bounded = pattern.startswith(r"\b")
+        if bounded:
+            pattern = pattern[2:]
+        if branches and bounded and branches[-1][0]:
+            branches[-1][1].append(f"(?P<{rule.name}>{pattern})")
+        else:
+            branches.append([bounded, [f"(?P<{rule.name}>{pattern})"]])
+    return re.compile("|".join(
+        r"\b(?:" + "|".join(alts) + ")" if bounded else alts[0]
+        for bounded, alts in branches
+    ))
+
+
+class _RuleSet:
+    """Compiled patterns for a subset of a registry's rules, kept in precedence order."""
+
+    def __init__(self, registry: RuleRegistry, names):
+        rules = [rule for rule in registry.rules if rule.name in names]
+        patterns = [rule.pattern for rule in rules]
+        self.registry = registry
+        self.rank = {rule.name: rank for rank, rule in enumerate(rules)}
+        self.combined = _combine(rules)
+        self.validators = [VALIDATORS.get(rule.validator) for rule in rules]
+        # lower[rank] tries the rules below `rank` at the position where the
+        # validator of the rule at `rank` turned a match down
+        self.lower = [
+            _combine(rules[rank + 1:]) if rule.validator and rank + 1 < len(rules) else None
+            for rank, rule in enumerate(rules)
+        ]
+        # higher[rank] matches any rule that takes precedence over the rule at
+        # `rank`. Used to spot the rare case where a higher-precedence match
+        # starts inside a lower-precedence one (e.g. a phone number inside an
+        # email local part).
+        self.higher = [None] + [
+            re.compile("|".join(f"(?:{pattern})" for pattern in patterns[:rank]))
+            for rank in range(1, len(rules))
+        ]
+        # When every higher-precedence rule starts with a word boundary, only
+        # the word starts inside a match need checking rather than every position.
+        self.higher_bounded = [
+            all(pattern.startswith(r"\b") for pattern in patterns[:rank])
+            for rank in range(len(rules))
+        ]
+        self.sequential = [(rule.name, re.compile(rule.pattern), VALIDATORS.get(rule.validator))
+                           for rule in rules]
+        widen = registry.widen
+        self.widen = widen if widen is not None and widen.name in self.rank else None
+        self.widen_rank = self.rank[widen.name] if self.widen else len(rules)
+
+
+_WORD_START = re.compile(r"\b(?=\w)")
+_NON_WORD = re.compile(r"\W")
+
+
+def _widen(widen: _Widen | None, name: str, text: str, start: int, floor: int) -> int:
+    """Move the start of a widening rule's match back over its run, not past `floor`."""
+    if widen is not None and name == widen.name:
+        while start > floor and (text[start - 1] in widen.ascii or (
+            text[start - 1] > "\x7f" and widen.char.match(text, start - 1)
+        )):
+            start -= 1
+    return start
+
+
+def _widen_covers(widen: _Widen, text: str, pos: int) -> tuple[int, bool]:
+    """End of the widening rule's run at `pos`, and whether a widened match
+    of that rule reaches back to `pos` from the end of that run."""
+    end = widen.run.match(text, pos).end()
+    return end, widen.pattern.match(text, max(pos, end - widen.reach)) is not None
+
+# ---------------------- Detection ----------------------
+@dataclass(frozen=True)
+class Span:
+    """One piece of sensitive data found in a text."""
+    category: str               # rule name, e.g. "aadhaar"
+    severity: SeverityLevel
+    start: int                  # offsets into the scanned text
+    end: int
+
+
+def _span(registry: RuleRegistry, name: str, start: int, end: int) -> Span:
+    return Span(name, registry.severity[name], start, end)
+
+
+def _starts_higher_match(rules: _RuleSet, text: str, start: int, end: int, rank: int) -> bool:
+    """Whether a rule ranked above `rank` matches from a position inside (start, end)."""
+    higher = rules.higher[rank]
+    if higher is None:
+        return False
+    if rules.higher_bounded[rank]:
+        # A single-word match has no word start inside it
+        if _NON_WORD.search(text, start, end) is None:
+            return False
+        positions = (m.start() for m in _WORD_START.finditer(text, start + 1, end))
+    else:
+        positions = range(start + 1, end)
+    return any(higher.match(text, pos) for pos in positions)
+
+
+def _validated(rules: _RuleSet, text: str, rejected: Counter) -> Iterator[re.Match]:
+    """Matches of the combined pattern that pass their rule's validator.
+
+    A match its validator turns down is plain text: the rules below it get
+    their turn at the same position, and the scan goes on from there.
+    """
+    pos = 0
+    while pos is not None:
+        scan, pos = rules.combined.finditer(text, pos), None
+        for match in scan:
+            found = match.start()
+            retried = False
+            while match is not None:
+                rank = rules.rank[match.lastgroup]
+                validator = rules.validators[rank]
+                if validator is None or validator(match.group()):
+                    break
+                rejected[match.lastgroup] += 1
+                lower = rules.lower[rank]
+                match = lower.match(text, found) if lower is not None else None
+                retried = True
+            if not retried:
+                yield match
+                continue
+            # The scan would resume after the rejected match; restart it
+            if match is not None:
+                yield match
+            pos = match.end() if match is not None else found + 1
+            break
+
+
+def _detect_single_pass(rules: _RuleSet, text: str, rejected: Counter) -> list[Span] | None:
+    """Find every span with one scan of the combined pattern.
+
+    Returns None when a higher-precedence rule could match inside a
+    lower-precedence match, in which case rule-by-rule application decides.
+    """
+    spans = []
+    last = 0
+    run_end = 0  # end of the last run checked by _widen_covers
+    for match in _validated(rules, text, rejected):
+        name = match.lastgroup
+        rank = rules.rank[name]
+        start = _widen(rules.widen, name, text, match.start(), last)
+        end = match.end()
+        if _starts_higher_match(rules, text, start, end, rank):
+            return None
+        # A widening match further along the same run would be widened over
+        # this lower-precedence match
+        if rank > rules.widen_rank and start >= run_end:
+            run_end, covered = _widen_covers(rules.widen, text, start)
+            if covered:
+                return None
+        spans.append(_span(rules.registry, name, start, end))
+        last = end
+    return spans
+
+
+def _detect_sequential(rules: _RuleSet, text: str, rejected: Counter) -> list[Span]:
+    """Apply each rule in turn to the output of the previous one.
+
+    Later rules see earlier matches as their replacement tokens, as in
+    plain rule-by-rule substitution; the spans still refer to `text`.
+    """
+    tokens = rules.registry.tokens
+    spans = []
+    for name, pattern, validator in rules.sequential:
+        current = _render(text, spans, tokens)
+        # Token end positions in `current`, and the length difference
+        # between original and token up to and including each token
+        ends = []
+        shifts = [0]
+        for span in spans:
+            ends.append(span.start - shifts[-1] + len(tokens[span.category]))
+            shifts.append(shifts[-1] + span.end - span.start - len(tokens[span.category]))
+
+        found = []
+        last = 0
+        pos = 0
+        while (match := pattern.search(current, pos)) is not None:
+            if validator is not None and not validator(match.group()):
+                rejected[name] += 1
+                pos = match.start() + 1
+                continue
+            start = _widen(rules.widen, name, current, match.start(), last)
+            last = pos = match.end()
+            found.append(_span(
+                rules.registry,
+                name,
+                start + shifts[bisect_right(ends, start)],
+                last + shifts[bisect_right(ends, last)],
+            ))
+        if found:
+            spans = sorted(spans + found, key=lambda span: span.start)
+    return spans
+
+
+def _detect(registry: RuleRegistry, text: str, allowed: frozenset, offset: int = 0,
+            stats: RuleStats | None = rule_stats) -> list[Span]:
+    """Spans found by the `allowed` rules, in order, offsets shifted by `offset`.
+
+    The matches are counted into `stats`, unless that is None.
+    """
+    names = registry.candidates(text) & allowed
+    if not names:
+        return []
+    rules = registry.rule_set(names)
+    rejected = Counter()
+    spans = _detect_single_pass(rules, text, rejected)
+    fallback = spans is None
+    if fallback:
+        rejected.clear()
+        spans = _detect_sequential(rules, text, rejected)
+    if stats is not None:
+        stats.record(spans, rejected, fallback)
+        if RULE_PROFILE_RATE and random.random() < RULE_PROFILE_RATE:
+            stats.profile(rules, text)
+    if offset:
+        spans = _shift(registry, spans, offset)
+    return spans
+
+
+def _split(registry: RuleRegistry, text: str, allowed: frozenset, offset: int = 0,
+           stats: RuleStats | None = rule_stats) -> tuple[list[Span], list[Span]]:
+    """Spans of the `allowed` rules, and the spans of every other rule that
+    overlap none of them, e.g. to mask in logs what is not redacted."""
+    found = _detect(registry, text, registry.every, offset, stats)
+    if allowed == registry.every:
+        return found, []
+    if allowed in registry.ranked_first:
+        spans = [span for span in found if span.category in allowed]
+    else:
+        spans = _detect(registry, text, allowed, offset, stats=None)
+    return spans, _uncovered(found, spans)
+
+
+def _uncovered(found: list[Span], spans: list[Span]) -> list[Span]:
+    """The spans in `found` that overlap none of `spans` (both in order)."""
+    rest = []
+    i = 0
+    for span in found:
+        while i < len(spans) and spans[i].end <= span.start:
+            i += 1
+        if i == len(spans) or span.end <= spans[i].start:
+            rest.append(span)
+    return rest
+
+
+def _redact(registry: RuleRegistry, text: str, allowed: frozenset) -> str:
+    return _render(text, _detect(registry, text, allowed, stats=None), registry.tokens)
+
+
+def _shift(registry: RuleRegistry, spans: list[Span], offset: int) -> list[Span]:
+    return [_span(registry, span.category, offset + span.start, offset + span.end) for span in spans]
+
+
+def detect(text: str, sensitivity: str = DEFAULT_SENSITIVITY) -> "Detection":
+    """Scan `text` once; the result renders redacted, masked and alert views.
+
+    `sensitivity` picks the rules to redact, see SENSITIVITY_NAMES; what
+    the other rules find is still masked in the masked view.
+    """
+    registry = get_rules()
+    allowed = registry.level(sensitivity)
+    if len(text) > LONG_TEXT_CHARS:
+        spans, unredacted = [], []
+        for shown, hidden in _split_windows(registry, text, allowed):
+            spans += shown
+            unredacted += hidden
+    else:
+        spans, unredacted = _split(registry, text, allowed)
+    return Detection(text, tuple(spans), registry, tuple(unredacted))
+
+# ---------------------- Rendering ----------------------
+def _render(text: str, spans, replace) -> str:
+    """`text` with each span replaced by ``replace[category](value)``, or by
+    ``replace[category]`` when that is a string."""
+    parts = []
+    last = 0
+    for span in spans:
+        parts.append(text[last:span.start])
+        replacement = replace[span.category]
+        parts.append(replacement if isinstance(replacement, str) else replacement(text[span.start:span.end]))
+        last = span.end
+    if not parts:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+@dataclass(frozen=True)
+class Detection:
+    """A text and the sensitive spans found in it.
+
+    Every view (redacted, masked, alerts) is rendered from the spans, so a
+    text is only ever scanned once however many of them are needed. Views
+    use the rules the spans were found with, even after a reload.
+    """
+    text: str
+    spans: tuple[Span, ...] = ()
+    rules: RuleRegistry = field(default_factory=lambda: get_rules(), repr=False, compare=False)
+    # Found by rules that do not run at the sensitivity; masked, never redacted
+    unredacted: tuple[Span, ...] = ()
+
+    @property
+    def categories(self) -> list[str]:
+        """Names of the rules that matched, in rule order."""
+        return _categories(self.rules, self.spans)
+
+    def redacted(self) -> str:
+        """Each span replaced by its rule's token, e.g. [REDACTED_PAN]."""
+        return _render(self.text, self.spans, self.rules.tokens)
+
+    def masked(self) -> str:
+        """Each span, redacted or not, partially masked, for logging."""
+        spans = self.spans
+        if self.unredacted:
+            spans = sorted(spans + self.unredacted, key=lambda span: span.start)
+        return _render(self.text, spans, self.rules.masks)
+
+    def alerts(self) -> list[dict]:
+        """One alert per rule that matched, in rule order."""
+        return _alerts(self.rules, self.spans)
+
+
+def _categories(registry: RuleRegistry, spans) -> list[str]:
+    found = {span.category for span in spans}
+    return [name for name in registry.names if name in found]
+
+
+def _alerts(registry: RuleRegistry, spans) -> list[dict]:
+    return [dict(registry.alerts[name]) for name in _categories(registry, spans)]
+
+
+def severity_summary(alerts: list[dict]) -> dict:
+    """Count alerts per severity level, as stored with each history record."""
+    return {
+        "high": sum(1 for a in alerts if a.get("level") == "HIGH"),
+        "medium": sum(1 for a in alerts if a.get("level") == "MEDIUM"),
+        "low": sum(1 for a in alerts if a.get("level") == "LOW")
+    }
+
+# ---------------------- Enhanced Sensitive Data Handler ----------------------
+def redact_sensitive_data(text: str, sensitivity: str = DEFAULT_SENSITIVITY) -> tuple[str, list[dict]]:
+    """Redacts sensitive data and returns (redacted_text, alerts with severity)."""
+    detection = detect(text, sensitivity)
+    return detection.redacted(), detection.alerts()
+
+
+def mask_sensitive_data(text: str, sensitivity: str = DEFAULT_SENSITIVITY) -> str:
+    """Mask sensitive data for logging (partial visibility), whatever `sensitivity` redacts."""
+    return detect(text, sensitivity).masked()
+
+
+def rule_for_alert(alert: dict) -> str:
+    """Name of the rule that raised `alert` (e.g. "aadhaar")."""
+    return get_rules().by_message.get(alert.get("message"), "unknown")
+
+
+def alert_for_rule(name: str) -> dict:
+    """The alert `name`'s rule raises; the inverse of ``rule_for_alert``.
+
+    A rule no longer configured gets a generic alert.
+    """
+    alert = get_rules().alerts.get(name)
+    if alert is None:
+        return {"severity": SeverityLevel.MEDIUM.value, "message": f"{name} detected and redacted",
+                "level": SeverityLevel.MEDIUM.name}
+    return dict(alert)
+
+# ---------------------- Long Inputs ----------------------
+# Above LONG_TEXT_CHARS, text is scanned in windows of about WINDOW_CHARS.
+# Each window is scanned on its own, so the working copies are bounded by
+# the window and a precedence conflict only sends its own window down the
+# rule-by-rule path instead of the whole document.
+LONG_TEXT_CHARS = 64 * 1024
+WINDOW_CHARS = 16 * 1024
+
+# Windows end just after a whitespace character. Only the rules marked
+# "whitespace" can match across one, and \b reads the same on either side
+# of it, so a cut that none of their matches runs across gives exactly the
+# result of redacting the whole text.
+_WHITESPACE = re.compile(r"\s")
+
+
+def _crosses(registry: RuleRegistry, text: str, cut: int) -> bool:
+    """Whether a match of a rule marked "whitespace" runs across `cut`."""
+    for pattern, longest in registry.crossing:
+        for match in pattern.finditer(text, max(cut - longest, 0), cut + longest):
+            if match.start() >= cut:
+                break
+            if match.end(1) > cut:
+                return True
+    return False
+
+
+def _next_cut(registry: RuleRegistry, text: str, pos: int) -> int | None:
+    """First safe window boundary at or after `pos`, or None."""
+    for space in _WHITESPACE.finditer(text, pos):
+        cut = space.end()
+        if not _crosses(registry, text, cut):
+            return cut
+    return None
+
+
+def iter_windows(text: str, size: int = WINDOW_CHARS, registry: RuleRegistry | None = None) -> Iterator[str]:
+    """Split `text` into consecutive windows that can be redacted independently.
+
+    A window runs past `size` only when no safe boundary follows it (e.g.
+    one very long token).
+    """
+    registry = registry or get_rules()
+    start = 0
+    while len(text) - start > size:
+        cut = _next_cut(registry, text, start + size)
+        if cut is None:
+            break
+        yield text[start:cut]
+        start = cut
+    yield text[start:]
+
+
+def _split_windows(registry: RuleRegistry, text: str, allowed: frozenset,
+                   window: int = WINDOW_CHARS) -> Iterator[tuple[list[Span], list[Span]]]:
+    """``_split`` window by window."""
+    offset = 0
+    for piece in iter_windows(text, window, registry):
+        yield _split(registry, piece, allowed, offset)
+        offset += len(piece)
+
+# ---------------------- Streaming Redaction ----------------------
+# Most text a stream holds back before it releases some regardless of
+# whether the pieces redact exactly as the whole would
+STREAM_HOLD_CHARS = 4096
+
+# Only tried at word starts, so finding it is linear in the word length
+_TRAILING_WORD = re.compile(r"(?<!\w)\w+\Z")
+
+
+def _found_in(registry: RuleRegistry, spans: list[Span], starts: list[int], pos: int, end: int,
+              name: str) -> bool:
+    """Whether `pos` lies in one of `spans` (starting at `starts`) that ends
+    by `end` and whose rule ranks at least as high as `name`."""
+    i = bisect_right(starts, pos) - 1
+    return i >= 0 and pos < spans[i].end <= end and registry.rank[spans[i].category] <= registry.rank[name]
+
+
+class StreamingRedactor:
+    """Incrementally redact text that arrives in chunks (e.g. a token stream).
+
+    Only the short suffix that could still turn into a match is held back,
+    so a secret split across two chunks is never emitted unredacted. The
+    concatenated output equals ``redact_sensitive_data`` on the full text,
+    except that a run of email local-part characters is held back for its
+    last 64 characters only: when it turns out to precede an "@", the text
+    before those is already out, where a whole-text pass widens the token
+    over it. A stream keeps the rules it started with, even across a reload.
+
+    A run of overlapping matches, such as a list of grouped digits, is
+    released up to its last whole match, and no more than about
+    STREAM_HOLD_CHARS is held back at any time, so the work per chunk is
+    bounded however long the stream.
+    """
+
+    def __init__(self, sensitivity: str = DEFAULT_SENSITIVITY):
+        self.rules = get_rules()
+        self._allowed = self.rules.level(sensitivity)
+        self._pending = ""
+        self._released = 0      # length of the text settled so far
+        self._spans = []
+        self._unredacted = []
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk and return the newly settled, redacted text."""
+        self._pending += chunk
+        max_chars = self.rules.max_chars
+        partial = self.rules.partial.search(self._pending, max(len(self._pending) - max_chars, 0))
+        end = partial.start() if partial else len(self._pending)
+        # Overlapping matches can chain back through a long run of grouped
+        # digits; past `floor` the cut goes after the last whole match instead
+        floor = max(end - max_chars, 0)
+        candidates = self.rules.candidates(self._pending)
+        cut = end
+        while cut > floor:
+            settled = self._safe_cut(cut, candidates)
+            if settled == cut:
+                break
+            cut = settled
+        if cut <= floor:
+            cut = self._boundary(end, candidates)
+        if cut == 0:
+            return ""
+        settled, rest = self._pending[:cut], self._pending[cut:]
+        # Counted only once the cut holds, or a retried cut would count twice
+        stats = RuleStats()
+        spans, unredacted = _split(self.rules, settled, self._allowed, stats=stats)
+        redacted = _render(settled, spans, self.rules.tokens)
+        # Overlapping rules can still interact across the cut; if redacting the
+        # two halves separately disagrees with redacting the whole, wait.
+        # Every rule is checked too, as the masked view needs all their spans.
+        # Past STREAM_HOLD_CHARS the cut is taken anyway, so what is held (and
+        # scanned on every chunk) stays bounded.
+        if len(self._pending) <= STREAM_HOLD_CHARS and not self._consistent(settled, redacted, rest):
+            return ""
+        rule_stats.merge(stats)
+        self._pending = rest
+        self._settle(settled, spans, unredacted)
+        return redacted
+
+    def finish(self) -> str:
+        """Redact and return whatever is still held back."""
+        settled, self._pending = self._pending, ""
+        spans, unredacted = _split(self.rules, settled, self._allowed)
+        self._settle(settled, spans, unredacted)
+        return _render(settled, spans, self.rules.tokens)
+
+    @property
+    def spans(self) -> list[Span]:
+        """Spans found so far, with offsets into the whole streamed text."""
+        return list(self._spans)
+
+    @property
+    def unredacted(self) -> list[Span]:
+        """Spans of rules that do not run at the sensitivity, as in ``Detection``."""
+        return list(self._unredacted)
+
+    @property
+    def alerts(self) -> list[dict]:
+        """Alerts for everything redacted so far, in rule order."""
+        return _alerts(self.rules, self._spans)
+
+    def _settle(self, settled: str, spans: list[Span], unredacted: list[Span]):
+        self._spans.extend(_shift(self.rules, spans, self._released))
+        self._unredacted.extend(_shift(self.rules, unredacted, self._released))
+        self._released += len(settled)
+
+    def _consistent(self, settled: str, redacted: str, rest: str) -> bool:
+        """Whether redacting the text held in two pieces matches redacting it whole."""
+        if _redact(self.rules, self._pending, self._allowed) != redacted + _redact(self.rules, rest, self._allowed):
+            return False
+        return self._allowed == self.rules.every or _redact(self.rules, self._pending, self.rules.every) == (
+            _redact(self.rules, settled, self.rules.every) + _redact(self.rules, rest, self.rules.every)
+        )
+
+    def _boundary(self, end: int, candidates: frozenset) -> int:
+        """Last cut up to `end` after a non-word character that splits no
+        match, or 0 if there is none.
+
+        Unlike ``_safe_cut``, an overlapping match only stands in the way
+        if it could still be chosen: one inside a match that was found by a
+        rule ranked at least as high and ends by `end` cannot be.
+        """
+        text = self._pending
+        # reach[pos]: furthest end of a match starting before pos
+        reach = [0] * (end + 1)
+        scans = []
+        for names in {self.rules.every, self._allowed}:
+            spans = _detect(self.rules, text, names, stats=None)
+            scans.append((names, spans, [span.start for span in spans]))
+            for span in spans:
+                if span.start < end:
+                    reach[span.start + 1] = max(reach[span.start + 1], span.end)
+        for rule, pattern in zip(self.rules.rules, self.rules.overlapping):
+            if rule.name not in candidates:
+                continue
+            for match in pattern.finditer(text):
+                start = match.start()
+                if start >= end:
+                    break
+                if match.end(1) <= start + 1 or match.end(1) <= end and all(
+                    _found_in(self.rules, spans, starts, start, end, rule.name)
+                    for names, spans, starts in scans if rule.name in names
+                ):
+                    continue
+                reach[start + 1] = max(reach[start + 1], match.end(1))
+        cut = 0
+        furthest = 0
+        for pos in range(1, end + 1):
+            furthest = max(furthest, reach[pos])
+            if furthest <= pos and _NON_WORD.match(text, pos - 1):
+                cut = pos
+        return cut
+
+    def _safe_cut(self, cut: int, candidates: frozenset) -> int:
+        """Move `cut` left off any complete match or word it would split."""
+        # Every rule at every start position: once earlier matches are
+        # replaced, a rule can match somewhere a plain scan would skip over.
+        # Matches starting further back than the rule's longest can't reach `cut`.
+        for rule, pattern in zip(self.rules.rules, self.rules.overlapping):
+            if rule.name not in candidates:
+                continue
+            for match in pattern.finditer(self._pending, max(cut - rule.max_chars, 0)):
+                if match.start() >= cut:
+                    break
+                if match.end(1) > cut:
+                    return match.start()
+        # \b at the cut depends on the next character, so keep words whole.
+        # A word longer than any match is cut where it is rather than held
+        # back whole; feed() still waits if that cut changes the result.
+        if self._pending[cut - 1:cut + 1].isalnum() or (
+            cut == len(self._pending) and self._pending[cut - 1].isalnum()
+        ):
+            word = _TRAILING_WORD.search(self._pending, max(cut - self.rules.max_chars, 0), cut)
+            return word.start() if word else cut
+        return cut
+
+# ---------------------- Rules File Check ----------------------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check a redaction rules file before deploying it.")
+    parser.add_argument("path", nargs="?", default=RULES_FILE, help="rules file (default: RULES_FILE)")
+    args = parser.parse_args()
+    try:
+        registry = load_rules(args.path)
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"error: {exc}")
+    for rule in registry.rules:
+        print(f"{rule.name:<12} {rule.severity.name:<7} {rule.sensitivity:<7} {rule.token:<22} "
+              f"{rule.validator or '-'}")
+    print(f"{len(registry.rules)} rules OK, version {registry.version}")
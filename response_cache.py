@@ -0,0 +1,221 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_CLEAR = object()
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(messages: list[dict], model: str, max_tokens: int, temperature: float,
+             sensitivity: str = "High", rules: str = "") -> str:
+    """Cache key for a chat request.
+
+    `messages` must already be redacted: the key is a hash, but the cache
+    is still only ever fed redacted text. `sensitivity` is the level the
+    stored reply was redacted at, so a lower level never serves a reply to
+    a session expecting more redaction, and `rules` the version of the
+    redaction rules, so a reload never serves replies redacted by the old ones.
+    """
+    payload = json.dumps(
+        {"messages": messages, "model": model, "max_tokens": max_tokens, "temperature": temperature,
+         "sensitivity": sensitivity, "rules": rules},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache with a TTL in front of the inference call.
+
+    Values must be JSON-serializable. With `path` set, entries are also
+    written to a SQLite file so they survive restarts; a memory miss falls
+    through to disk before counting as a miss. Disk writes are queued to a
+    background thread, which also drops expired rows and trims the file to
+    `disk_max_entries` every `sweep_interval` seconds.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3600.0, path: str | None = None,
+                 disk_max_entries: int = 10000, sweep_interval: float = 60.0, batch_size: int = 64):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            writer = sqlite3.connect(path, check_same_thread=False)
+            # Readers never wait for the writer thread's transactions
+            writer.execute("PRAGMA journal_mode=WAL")
+            writer.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            writer.execute("CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)")
+            self._sweep(writer)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db_lock = threading.Lock()
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, args=(writer,), name="response-cache-writer",
+                                            daemon=True)
+            self._thread.start()
+
+    def get(self, key: str):
+        """Return the cached value for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            if self._db is None:
+                self.misses += 1
+                return None
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            value = json.loads(row[0])
+            self._store(key, value, row[1])
+            self.hits += 1
+            self.disk_hits += 1
+            return value
+
+    def put(self, key: str, value):
+        """Cache `value` under `key` for `ttl` seconds. Never blocks on disk I/O."""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, value, expires_at)
+        if self._db is not None:
+            self._queue.put((key, json.dumps(value, ensure_ascii=False), expires_at))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._db is not None:
+            # Queued, so writes submitted before it are cleared too
+            self._queue.put(_CLEAR)
+
+    def flush(self):
+        """Block until every queued disk write is done."""
+        if self._db is not None:
+            self._queue.join()
+
+    def close(self):
+        """Finish the queued disk writes and stop the writer thread."""
+        if self._db is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _store(self, key: str, value, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _run(self, db: sqlite3.Connection):
+        last_sweep = time.monotonic()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(db, batch)
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    self._sweep(db)
+                    last_sweep = time.monotonic()
+            except sqlite3.Error:
+                logger.exception("Failed to write %d response cache entries", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if batch[-1] is _STOP:
+                db.close()
+                return
+
+    def _write(self, db: sqlite3.Connection, batch: list):
+        rows = []
+        for item in batch:
+            if item is _CLEAR:
+                rows = []
+                db.execute("DELETE FROM responses")
+            elif item is not _STOP:
+                rows.append(item)
+        db.executemany("INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)", rows)
+        db.commit()
+
+    def _sweep(self, db: sqlite3.Connection):
+        """Drop expired rows, then all but the `disk_max_entries` latest to expire."""
+        db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        db.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,),
+        )
+        db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache | None:
+    """Return the process-wide response cache, or None if it is disabled.
+
+    Configured with RESPONSE_CACHE (set to 0 to disable), RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH (enables the on-disk tier) and
+    RESPONSE_CACHE_DISK_SIZE (rows kept on disk).
+    """
+    global _cache
+    if os.getenv("RESPONSE_CACHE", "1") == "0":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "512")),
+                ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+                path=os.getenv("RESPONSE_CACHE_PATH") or None,
+                disk_max_entries=int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "10000")),
+            )
+            atexit.register(_cache.close)
+        return _cache
@@ -0,0 +1,91 @@
+"""Local stand-in for a chat endpoint that injects delays and errors.
+
+Speaks the OpenAI-style ``/v1/chat/completions`` route that the Hugging Face
+client uses for endpoint URLs, so the real HuggingFaceBackend, hedging and
+fallback can be exercised offline:
+
+    STUB_NAME=slow STUB_LATENCY=3 uvicorn stub_server:app --port 8101
+    STUB_NAME=flaky STUB_FAILURE_RATE=0.5 uvicorn stub_server:app --port 8102
+    INFERENCE_MODELS=http://localhost:8101,http://localhost:8102 streamlit run main.py
+
+Each reply waits STUB_LATENCY (+ up to STUB_JITTER) seconds, then fails
+with a 503 for a STUB_FAILURE_RATE share of requests or echoes the last
+user message, prefixed with STUB_NAME.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+
+STUB_NAME = os.getenv("STUB_NAME", "stub")
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.05"))
+STUB_JITTER = float(os.getenv("STUB_JITTER", "0"))
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", "0"))
+
+# Characters per streamed chunk
+CHUNK_SIZE = 4
+
+app = FastAPI(title="Chat endpoint stub")
+
+
+def _reply(messages: list[dict]) -> str:
+    prompt = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    return f"[{STUB_NAME}] You said: {prompt}"
+
+
+def _chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "system_fingerprint": STUB_NAME,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(body: dict):
+    await asyncio.sleep(STUB_LATENCY + random.uniform(0, STUB_JITTER))
+    if random.random() < STUB_FAILURE_RATE:
+        raise HTTPException(status_code=503, detail=f"{STUB_NAME}: injected failure")
+
+    completion_id = uuid.uuid4().hex
+    model = body.get("model") or STUB_NAME
+    text = _reply(body.get("messages", []))
+    if body.get("stream"):
+        async def events():
+            yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+            for i in range(0, len(text), CHUNK_SIZE):
+                yield _chunk(completion_id, model, {"content": text[i:i + CHUNK_SIZE]})
+                await asyncio.sleep(0)
+            yield _chunk(completion_id, model, {}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "system_fingerprint": STUB_NAME,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "logprobs": None,
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "name": STUB_NAME}
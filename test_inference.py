@@ -0,0 +1,204 @@
+"""Checks for admission control, retries, hedging and model fallback, run
+against FakeBackend.
+
+    python -m pytest -q test_inference.py
+"""
+import asyncio
+import time
+
+import pytest
+
+import inference
+from inference import AdmissionController, Busy, FakeBackend, FakeUpstreamError, ModelRouter
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class Unauthorized(Exception):
+    """A non-retryable upstream 401."""
+
+    response = type("Response", (), {"status_code": 401})()
+
+
+class ModelBackend(FakeBackend):
+    """FakeBackend whose latency, and whether it fails, depend on the model.
+
+    Records when each call starts and which ones were cancelled or closed.
+    """
+
+    def __init__(self, latencies: dict[str, float], failing=(), flaky: int = 0, **kwargs):
+        super().__init__(latency=0, **kwargs)
+        self.latencies = latencies
+        self.failing = set(failing)
+        self.flaky = flaky          # attempts that fail with a retryable 503 first
+        self.started = []           # (model, perf_counter)
+        self.cancelled = []
+        self.closed = []
+        self.failed = asyncio.Event()
+
+    async def _call(self, model: str):
+        self.started.append((model, time.perf_counter()))
+        if model in self.failing:
+            raise Unauthorized()
+        if self.flaky:
+            self.flaky -= 1
+            self.failed.set()
+            raise FakeUpstreamError()
+        try:
+            await asyncio.sleep(self.latencies.get(model, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+
+    async def _chat(self, messages, model, max_tokens, temperature) -> str:
+        await self._call(model)
+        return f"from {model}"
+
+    async def _stream(self, messages, model, max_tokens, temperature):
+        try:
+            await self._call(model)
+            yield "from "
+            yield model
+        finally:
+            self.closed.append(model)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+# ---------------------- Admission ----------------------
+def test_full_queue_raises_busy():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=1)
+        await admission.acquire("a")
+        waiting = asyncio.create_task(admission.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(Busy) as busy:
+            await admission.acquire("c")
+        assert busy.value.retry_after >= 1
+        assert (admission.active, admission.queued, admission.rejected) == (1, 1, 1)
+        admission.release()
+        await waiting
+        admission.release()
+        assert (admission.active, admission.queued) == (0, 0)
+
+    run(scenario())
+
+
+def test_slots_go_round_robin_across_sessions():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=10)
+        await admission.acquire()
+        order = []
+
+        async def call(session, name):
+            async with admission.slot(session):
+                order.append(name)
+
+        calls = [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]
+        tasks = [asyncio.create_task(call(session, name)) for session, name in calls]
+        await asyncio.sleep(0)
+        admission.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert run(scenario()) == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=1)
+        await admission.acquire()
+        waiting = asyncio.create_task(admission.acquire("a"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert admission.queued == 0
+        admission.release()
+        assert admission.active == 0
+
+    run(scenario())
+
+# ---------------------- Retries ----------------------
+def test_retry_is_not_turned_away_by_a_full_queue(monkeypatch):
+    monkeypatch.setattr(inference.random, "uniform", lambda low, high: high)
+
+    async def scenario():
+        backend = ModelBackend({}, flaky=1, backoff=0.05, max_concurrency=1, max_queue=0)
+        call = asyncio.create_task(backend.chat(MESSAGES, "m", 16, 0.7, session="a"))
+        # Take the only slot while the failed attempt backs off
+        await backend.failed.wait()
+        while backend.admission.active:
+            await asyncio.sleep(0)
+        await backend.admission.acquire("b")
+        await asyncio.sleep(0.1)
+        assert not call.done()
+        assert (backend.admission.queued, backend.admission.rejected) == (1, 0)
+        with pytest.raises(Busy):
+            await backend.chat(MESSAGES, "m", 16, 0.7, session="c")
+        backend.admission.release()
+        assert await call == "from m"
+        assert backend.retries == 1
+
+    run(scenario())
+
+
+def test_permanent_failure_is_not_retried():
+    async def scenario():
+        backend = ModelBackend({}, failing=["m"], backoff=0)
+        with pytest.raises(Exception, match="after 1 attempt"):
+            await backend.chat(MESSAGES, "m", 16, 0.7)
+        assert (len(backend.started), backend.retries, backend.failures) == (1, 0, 1)
+
+    run(scenario())
+
+# ---------------------- Hedging and Fallback ----------------------
+def test_slow_call_is_hedged_to_the_next_model():
+    async def scenario():
+        backend = ModelBackend({"slow": 5.0, "fast": 0.0})
+        router = ModelRouter(["slow", "fast"], hedge_delay=0.05)
+        start = time.perf_counter()
+        reply = await router.chat(backend, MESSAGES, 16, 0.7)
+        assert reply == "from fast"
+        assert time.perf_counter() - start < 1.0
+        started = dict(backend.started)
+        assert started["fast"] - started["slow"] >= 0.05
+        assert backend.cancelled == ["slow"]
+        assert backend.admission.active == 0
+
+    run(scenario())
+
+
+def test_fast_call_is_not_hedged():
+    async def scenario():
+        backend = ModelBackend({"first": 0.0, "second": 0.0})
+        router = ModelRouter(["first", "second"], hedge_delay=0.5)
+        assert await router.chat(backend, MESSAGES, 16, 0.7) == "from first"
+        assert [model for model, _ in backend.started] == ["first"]
+
+    run(scenario())
+
+
+def test_losing_stream_is_cancelled_and_closed():
+    async def scenario():
+        backend = ModelBackend({"slow": 5.0, "fast": 0.0})
+        router = ModelRouter(["slow", "fast"], hedge_delay=0.05)
+        chunks = [chunk async for chunk in router.stream(backend, MESSAGES, 16, 0.7)]
+        assert "".join(chunks) == "from fast"
+        assert backend.cancelled == ["slow"]
+        assert sorted(backend.closed) == ["fast", "slow"]
+        assert backend.admission.active == 0
+
+    run(scenario())
+
+
+def test_failing_model_cools_down():
+    async def scenario():
+        backend = ModelBackend({}, failing=["bad"])
+        router = ModelRouter(["bad", "good"], hedge_delay=5.0, cooldown=30.0)
+        assert await router.chat(backend, MESSAGES, 16, 0.7) == "from good"
+        assert router.candidates() == ["good", "bad"]
+        assert await router.chat(backend, MESSAGES, 16, 0.7) == "from good"
+        assert [model for model, _ in backend.started] == ["bad", "good", "good"]
+
+    run(scenario())
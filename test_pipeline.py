@@ -0,0 +1,65 @@
+"""Checks for the guarded chat pipeline, run against FakeBackend.
+
+    python -m pytest -q test_pipeline.py
+"""
+import asyncio
+
+import pytest
+
+import pipeline
+from inference import FakeBackend
+from response_cache import ResponseCache
+
+
+class Recorder:
+    """Stands in for the history writer and keeps what it is given."""
+
+    def __init__(self):
+        self.records = []
+
+    def submit(self, record: dict):
+        self.records.append(record)
+
+
+@pytest.fixture
+def history(monkeypatch):
+    recorder = Recorder()
+    cache = ResponseCache()
+    monkeypatch.setattr(pipeline, "get_writer", lambda: recorder)
+    monkeypatch.setattr(pipeline, "get_cache", lambda: cache)
+    return recorder
+
+# ---------------------- Inference ----------------------
+def test_identical_requests_share_one_upstream_call(monkeypatch):
+    monkeypatch.setattr(pipeline, "get_cache", lambda: None)
+    backend = FakeBackend(reply="Call 9876543210", latency=0.05)
+    messages = [{"role": "user", "content": "how do I reach you?"}]
+
+    async def both():
+        return await asyncio.gather(pipeline.acomplete(messages, backend), pipeline.acomplete(messages, backend))
+
+    first, second = asyncio.run(both())
+    assert backend.calls == 1
+    assert (first.coalesced, second.coalesced) == (False, True)
+    assert first.safe_reply == second.safe_reply == "Call [REDACTED_PHONE]"
+    assert not pipeline._inflight
+
+# ---------------------- Logging ----------------------
+@pytest.mark.parametrize("sensitivity", ["Low", "Medium", "High"])
+def test_cached_reply_is_masked_in_the_log(history, sensitivity):
+    backend = FakeBackend(reply="Call 9876543210 or mail john@example.com", latency=0)
+    first = pipeline.run_chat("how do I reach you?", backend=backend, sensitivity=sensitivity)
+    second = pipeline.run_chat("how do I reach you?", backend=backend, sensitivity=sensitivity)
+    assert (first.cached, second.cached) == (False, True)
+    assert backend.calls == 1
+    assert second.reply == first.reply
+    for record in history.records:
+        assert "9876543210" not in record["answer"] and "john@example.com" not in record["answer"]
+
+
+def test_cached_low_sensitivity_reply_logs_like_a_fresh_one(history):
+    backend = FakeBackend(reply="Call 9876543210 or mail john@example.com", latency=0)
+    pipeline.run_chat("how do I reach you?", backend=backend, sensitivity="Low")
+    pipeline.run_chat("how do I reach you?", backend=backend, sensitivity="Low")
+    answers = [record["answer"] for record in history.records]
+    assert answers == ["Call 987****210 or mail j***@example.com"] * 2
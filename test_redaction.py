@@ -0,0 +1,211 @@
+"""Fixed-case checks for the redaction engine: baseline outputs, masking,
+streaming, windowed long texts and loading the rules file.
+
+    python -m pytest -q test_redaction.py
+"""
+import json
+import os
+
+import pytest
+
+import redaction
+from redaction import (StreamingRedactor, detect, get_rules, iter_windows, load_rules, mask_sensitive_data,
+                       redact_sensitive_data, reload_rules, rule_for_alert, rule_stats)
+
+# (text, redacted text, rules alerted), as the original single-file app redacted them
+BASELINE = [
+    ("My Aadhaar is 123456789012 and PAN ABCDE1234F.",
+     "My Aadhaar is [REDACTED_AADHAAR] and PAN [REDACTED_PAN].", ["aadhaar", "pan"]),
+    ("Card 4111 1111 1111 1111, CVV: 123, expires soon.",
+     "Card [REDACTED_CARD], [REDACTED_CVV], expires soon.", ["card", "cvv"]),
+    ("Call me on 9876543210 or write to john.doe@example.com",
+     "Call me on [REDACTED_PHONE] or write to [REDACTED_EMAIL]", ["phone", "email"]),
+    ("Ship to PIN 560001, flat 4B.", "Ship to PIN [REDACTED_PINCODE], flat 4B.", ["pincode"]),
+    ("card 4111-1111-1111-1111 cvc 9876", "card [REDACTED_CARD] [REDACTED_CVV]", ["card", "cvv"]),
+    ("ids 123456789012345678 and 12345", "ids [REDACTED_CARD] and 12345", ["card"]),
+    ("mail a+b@mail.co.in; cc x_y@z.org.", "mail [REDACTED_EMAIL]; cc [REDACTED_EMAIL]", ["email"]),
+    ("CVV123 and cvv 12", "[REDACTED_CVV] and cvv 12", ["cvv"]),
+    ("aadhaar 1234 5678 9012 and phone 98765 43210", "aadhaar 1234 5678 9012 and phone 98765 43210", []),
+    ("Nothing sensitive here.", "Nothing sensitive here.", []),
+]
+
+MASKED = [
+    ("My Aadhaar is 123456789012 and PAN ABCDE1234F.", "My Aadhaar is 123******012 and PAN ABC**1234*."),
+    ("Call me on 9876543210 or write to john.doe@example.com",
+     "Call me on 987****210 or write to j***@example.com"),
+    ("Card 4111 1111 1111 1111, CVV: 123, expires soon.", "Card 4111 **** **** 1111, CVV: ***, expires soon."),
+    ("Ship to PIN 560001, flat 4B.", "Ship to PIN 560***, flat 4B."),
+]
+
+TEXT = "\n".join(text for text, _, _ in BASELINE)
+REDACTED = "\n".join(redacted for _, redacted, _ in BASELINE)
+
+
+@pytest.fixture
+def rules_file(tmp_path, monkeypatch):
+    """A private copy of the shipped rules file, checked on every get_rules() call."""
+    path = tmp_path / "rules.json"
+    with open(redaction.RULES_FILE, encoding="utf-8") as f:
+        path.write_text(f.read(), encoding="utf-8")
+    monkeypatch.setattr(redaction, "RULES_FILE", str(path))
+    monkeypatch.setattr(redaction, "RULES_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(redaction, "_rules", None)
+    monkeypatch.setattr(redaction, "_rules_rejected", None)
+    return path
+
+
+def write_rules(path, edit=None, text: str | None = None):
+    """Rewrite the rules file, after `edit(rules)` if given, with a new mtime."""
+    if text is None:
+        config = json.loads(path.read_text(encoding="utf-8"))
+        if edit:
+            edit({rule["name"]: rule for rule in config["rules"]})
+        text = json.dumps(config)
+    mtime = path.stat().st_mtime_ns if path.exists() else 0
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+# ---------------------- Redaction and Masking ----------------------
+@pytest.mark.parametrize("text,redacted,rules", BASELINE)
+def test_redaction_matches_baseline(text, redacted, rules):
+    out, alerts = redact_sensitive_data(text)
+    assert out == redacted
+    assert [rule_for_alert(alert) for alert in alerts] == rules
+
+
+@pytest.mark.parametrize("text,masked", MASKED)
+def test_masking(text, masked):
+    assert mask_sensitive_data(text) == masked
+
+
+def test_views_share_one_scan():
+    detection = detect(TEXT)
+    assert detection.redacted() == REDACTED
+    assert detection.masked() == mask_sensitive_data(TEXT)
+
+
+def test_low_sensitivity_still_masks_everything():
+    text = "PAN ABCDE1234F, call 9876543210 or mail john@example.com"
+    detection = detect(text, "Low")
+    assert detection.redacted() == "PAN [REDACTED_PAN], call 9876543210 or mail john@example.com"
+    assert detection.categories == ["pan"]
+    assert detection.masked() == detect(text, "High").masked()
+
+# ---------------------- Streaming ----------------------
+@pytest.mark.parametrize("size", [1, 3, 7, 64])
+@pytest.mark.parametrize("sensitivity", ["Low", "High"])
+def test_stream_matches_whole_text(size, sensitivity):
+    redactor = StreamingRedactor(sensitivity)
+    out = "".join(redactor.feed(TEXT[i:i + size]) for i in range(0, len(TEXT), size)) + redactor.finish()
+    detection = detect(TEXT, sensitivity)
+    assert out == detection.redacted()
+    assert redactor.spans == list(detection.spans)
+    assert redactor.unredacted == list(detection.unredacted)
+
+
+def test_stream_never_releases_a_split_secret():
+    redactor = StreamingRedactor()
+    released = [redactor.feed(chunk) for chunk in ("card 4111 11", "11 1111 1", "111 and done")]
+    released.append(redactor.finish())
+    assert "".join(released) == "card [REDACTED_CARD] and done"
+    assert not any("4111" in chunk for chunk in released)
+
+
+@pytest.mark.parametrize("unit", ["1234 5678 ", "1111 ", "1234-5678-", "CVC 1234 5678 9012 3456 "])
+def test_stream_releases_runs_of_grouped_digits(unit):
+    text = unit * (8000 // len(unit))
+    redactor = StreamingRedactor()
+    out = "".join(redactor.feed(text[i:i + 4]) for i in range(0, len(text), 4))
+    tail = redactor.finish()
+    assert out + tail == detect(text).redacted()
+    # Released as it goes, rather than all held back until finish()
+    assert len(tail) < 2 * get_rules().max_chars
+
+# ---------------------- Long Texts ----------------------
+def test_long_text_is_redacted_in_windows():
+    copies = redaction.LONG_TEXT_CHARS // len(TEXT) + 2
+    text = "\n".join([TEXT] * copies)
+    assert len(text) > redaction.LONG_TEXT_CHARS
+    assert detect(text).redacted() == "\n".join([REDACTED] * copies)
+    windows = list(iter_windows(text))
+    assert len(windows) > 1 and "".join(windows) == text
+    assert "".join(detect(window).redacted() for window in windows) == detect(text).redacted()
+
+
+@pytest.mark.parametrize("size", [1, 10, 50])
+def test_small_windows_match_whole_text(size):
+    windows = list(iter_windows(TEXT, size))
+    assert "".join(windows) == TEXT
+    assert "".join(detect(window).redacted() for window in windows) == REDACTED
+
+# ---------------------- Rules File ----------------------
+def test_validator_leaves_failing_numbers_in_clear(rules_file):
+    write_rules(rules_file, lambda rules: rules["card"].update(validator="luhn"))
+    rejected = {row["rule"]: row["rejected"] for row in rule_stats.snapshot(["card"])}["card"]
+    out, _ = redact_sensitive_data("good 4111 1111 1111 1111 bad 4111 1111 1111 1112")
+    assert out == "good [REDACTED_CARD] bad 4111 1111 1111 1112"
+    assert {row["rule"]: row["rejected"] for row in rule_stats.snapshot(["card"])}["card"] > rejected
+
+
+def test_edited_rules_file_is_picked_up(rules_file):
+    before = get_rules().version
+    write_rules(rules_file, lambda rules: rules["pan"].update(token="[PAN]"))
+    assert get_rules().version != before
+    assert redact_sensitive_data("PAN ABCDE1234F")[0] == "PAN [PAN]"
+
+
+def test_reload_rules(rules_file, monkeypatch):
+    get_rules()
+    monkeypatch.setattr(redaction, "RULES_CHECK_INTERVAL", 3600)
+    write_rules(rules_file, lambda rules: rules["phone"].update(token="[PHONE]"))
+    assert redact_sensitive_data("9876543210")[0] == "[REDACTED_PHONE]"
+    assert reload_rules() is get_rules()
+    assert redact_sensitive_data("9876543210")[0] == "[PHONE]"
+
+
+def test_stream_keeps_its_rules_across_a_reload(rules_file):
+    redactor = StreamingRedactor()
+    assert redactor.feed("PAN ABCDE") == "PAN "
+    write_rules(rules_file, lambda rules: rules["pan"].update(token="[PAN]"))
+    reload_rules()
+    assert redactor.feed("1234F ok") + redactor.finish() == "[REDACTED_PAN] ok"
+
+
+@pytest.mark.parametrize("text", [
+    "{not json",
+    '{"rules": {}}',
+    '{"rules": [{"name": "x"}]}',
+])
+def test_bad_rules_file_keeps_rules_in_force(rules_file, text):
+    version = get_rules().version
+    write_rules(rules_file, text=text)
+    assert get_rules().version == version
+    with pytest.raises(ValueError):
+        reload_rules()
+    assert redact_sensitive_data("PAN ABCDE1234F")[0] == "PAN [REDACTED_PAN]"
+
+
+def test_missing_rules_file_keeps_rules_in_force(rules_file):
+    version = get_rules().version
+    rules_file.unlink()
+    assert get_rules().version == version
+    with pytest.raises(OSError):
+        reload_rules()
+
+
+@pytest.mark.parametrize("field,value", [
+    ("pattern", "(\\d{4})"),
+    ("pattern", "[unclosed"),
+    ("pattern", "\\d*"),
+    ("mask", {"keep": 3}),
+    ("mask", {"digits": [3, "4"]}),
+    ("mask", {"nope": 1}),
+    ("validator", "md5"),
+    ("sensitivity", "Extreme"),
+    ("max_chars", 0),
+    ("colour", "red"),
+])
+def test_bad_rule_is_rejected(rules_file, field, value):
+    write_rules(rules_file, lambda rules: rules["phone"].update({field: value}))
+    with pytest.raises(ValueError, match="phone"):
+        load_rules(str(rules_file))
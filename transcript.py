@@ -0,0 +1,90 @@
+"""Compact chat transcript for session state, rendered to HTML only on display.
+
+Each message is a small slotted record: redacted text, the rule names of
+its alerts and the mode it was sent in. The alert badges are built from
+the templates below each time a message is drawn, so session state holds
+no HTML. The transcript keeps the newest CHAT_TRANSCRIPT_LIMIT messages;
+older turns live on in the conversation history.
+"""
+import os
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+
+from redaction import alert_for_rule
+
+# Messages kept per session; the oldest are dropped first
+CHAT_TRANSCRIPT_LIMIT = int(os.getenv("CHAT_TRANSCRIPT_LIMIT", "200"))
+
+# Messages drawn on each rerun; earlier ones are shown on request
+CHAT_VISIBLE_MESSAGES = int(os.getenv("CHAT_VISIBLE_MESSAGES", "20"))
+
+
+@dataclass(slots=True)
+class ChatMessage:
+    role: str                       # "user" or "assistant"
+    text: str                       # redacted prompt or reply, or the error text
+    kind: str = "reply"             # "prompt" (user), or "reply", "blocked" or "error" (assistant)
+    alerts: tuple[str, ...] = ()    # rule names of the alerts, e.g. ("pan", "phone")
+    strict: bool = False            # strict mode when the message was sent
+    sensitivity: str = "High"
+
+
+def new_transcript() -> deque:
+    return deque(maxlen=CHAT_TRANSCRIPT_LIMIT)
+
+
+def visible(transcript: deque, count: int) -> list[ChatMessage]:
+    """The newest `count` messages, oldest first."""
+    return list(islice(transcript, max(len(transcript) - count, 0), None))
+
+# ---------------------- Templates ----------------------
+BLOCKED_TEMPLATE = """
+                    <div style='background: linear-gradient(135deg, #fee2e2 0%, #fecaca 100%); padding: 16px; border-radius: 8px; border-left: 4px solid #ef4444;'>
+                        <strong style='color: #dc2626;'>🚫 Message Blocked - Strict Privacy Mode</strong><br/>
+                        <p style='color: #991b1b; margin-top: 8px;'>Your message contains HIGH-risk sensitive data and has been blocked for your protection.</p>
+                        <p style='color: #7f1d1d; margin-top: 8px; font-size: 14px;'><strong>Detected:</strong></p>
+                    {alerts}<p style='color: #7f1d1d; margin-top: 8px; font-size: 13px;'><em>💡 Tip: Disable strict mode in settings to allow redacted messages.</em></p></div>"""
+
+BLOCKED_ALERT_TEMPLATE = "<span style='color: #dc2626;'>{severity} {message}</span><br/>"
+
+ALERT_BADGE_TEMPLATE = (
+    "\n\n<div style='background: linear-gradient(135deg, #fee2e2 0%, #fecaca 100%); padding: 12px 16px; border-radius: 8px; border-left: 4px solid #ef4444; margin-top: 12px;'>"
+    "<strong>🔒 Privacy Alerts Detected:</strong><br/>"
+    "{alerts}"
+    "<p style='color: #64748b; font-size: 12px; margin-top: 8px;'>Mode: {mode} | Sensitivity: {sensitivity}</p>"
+    "</div>"
+)
+
+ALERT_TEMPLATE = "<span style='color: {color}; font-weight: 600;'>{severity} {message}</span><br/>"
+
+SAFE_BADGE_TEMPLATE = (
+    "\n\n<div style='background: linear-gradient(135deg, #d1fae5 0%, #a7f3d0 100%); padding: 12px 16px; border-radius: 8px; border-left: 4px solid #10b981; margin-top: 12px;'>"
+    "<strong style='color: #047857;'>🟢 No Sensitive Data Detected - Message is Safe</strong>"
+    "<p style='color: #065f46; font-size: 12px; margin-top: 4px;'>Mode: {mode} | Sensitivity: {sensitivity}</p>"
+    "</div>"
+)
+
+
+def render_html(message: ChatMessage) -> str:
+    """Markdown with inline HTML for an assistant message."""
+    alerts = [alert_for_rule(rule) for rule in message.alerts]
+    if message.kind == "blocked":
+        return BLOCKED_TEMPLATE.format(alerts="".join(
+            BLOCKED_ALERT_TEMPLATE.format(**alert) for alert in alerts if alert["level"] == "HIGH"
+        ))
+    if message.kind != "reply":
+        return message.text
+    if alerts:
+        return message.text + ALERT_BADGE_TEMPLATE.format(
+            alerts="".join(
+                ALERT_TEMPLATE.format(color="#dc2626" if alert["level"] == "HIGH" else "#f59e0b", **alert)
+                for alert in alerts
+            ),
+            mode="🔒 Strict" if message.strict else "🔒 Strict (Redacted)",
+            sensitivity=message.sensitivity,
+        )
+    return message.text + SAFE_BADGE_TEMPLATE.format(
+        mode="🔒 Strict" if message.strict else "🔓 Relaxed",
+        sensitivity=message.sensitivity,
+    )